@@ -0,0 +1,281 @@
+"""アーカイブした結果のオフライン解析
+
+各シャードの room_member_archive を chunk_size 行ずつ読んで NumPy の配列にし、
+live_id・難易度ごとのスコアの分布と外れ値をまとめて計算する。
+分布は bin_width 点刻みのヒストグラムとして足し込むので、メモリに載るのは1チャンク分で済む。
+ヒストグラムは max_score 点までで、それ以上のスコアは最後のビンにまとめる。
+外れ値は次のどちらかに当たる結果。
+- validation.live_notes の表と判定数の合計・理論値が合わない
+- 同じ live_id・難易度の平均から標準偏差の z 倍より離れている
+
+NumPy はこの解析とテストにしか使わないので、API サーバーは無くても起動できる。
+
+    python -m app.analysis --chunk-size 100000 > analysis.jsonl
+"""
+
+import argparse
+import itertools
+import json
+from typing import Iterator, NamedTuple, Optional
+
+from sqlalchemy import text
+
+from . import config, validation
+from .db import begin
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CHUNK_SIZE: int = 100000
+BIN_WIDTH: int = 1000  # ヒストグラムの刻み (点)。パーセンタイルはこの精度の近似になる
+# ヒストグラムの上限 (点)。これ以上のスコアはまとめて最後のビンに数える。
+# 不正なスコアの大きさでビンの数 (メモリ) が決まらないようにするため
+MAX_SCORE: int = 10_000_000
+OUTLIER_Z: float = 4.0
+MAX_OUTLIERS: int = 1000
+
+# チャンクの列
+ROOM_ID, USER_ID, LIVE_ID, DIFFICULTY = 0, 1, 2, 3
+JUDGES = slice(4, 9)  # perfect, great, good, bad, miss
+SCORE = 9
+COLUMNS = 10
+
+_ARCHIVED_RESULTS = "SELECT `m`.`room_id`, `m`.`user_id`, `r`.`live_id`, `m`.`select_difficulty`, COALESCE(`m`.`judge_perfect`, 0), COALESCE(`m`.`judge_great`, 0), COALESCE(`m`.`judge_good`, 0), COALESCE(`m`.`judge_bad`, 0), COALESCE(`m`.`judge_miss`, 0), `m`.`score` FROM `room_member_archive` AS `m` JOIN `room_archive` AS `r` ON `r`.`id`=`m`.`room_id` WHERE `m`.`score` IS NOT NULL AND (`m`.`room_id` > :room_id OR (`m`.`room_id`=:room_id AND `m`.`user_id` > :user_id)) ORDER BY `m`.`room_id`, `m`.`user_id` LIMIT :limit"
+
+
+class ScoreDistribution(NamedTuple):
+    live_id: int
+    difficulty: int
+    count: int
+    mean: float
+    std: float
+    p50: int
+    p90: int
+    p99: int
+    max: int
+
+
+class Outlier(NamedTuple):
+    room_id: int
+    user_id: int
+    live_id: int
+    difficulty: int
+    score: int
+    reason: str
+
+
+def _require_numpy() -> None:
+    if np is None:
+        raise RuntimeError("app.analysis requires numpy (pip install numpy)")
+
+
+def iter_chunks(chunk_size: int = CHUNK_SIZE) -> Iterator["np.ndarray"]:
+    """全シャードのアーカイブを (行数, COLUMNS) の int64 配列で chunk_size 行ずつ返す"""
+    _require_numpy()
+    for shard in range(config.SHARDS):
+        args = {"room_id": 0, "user_id": 0, "limit": chunk_size}
+        while True:
+            with begin(shard) as conn:
+                rows = conn.execute(text(_ARCHIVED_RESULTS), args).fetchall()
+            if not rows:
+                break
+            yield np.fromiter(
+                itertools.chain.from_iterable(rows),
+                dtype=np.int64,
+                count=len(rows) * COLUMNS,
+            ).reshape(len(rows), COLUMNS)
+            if len(rows) < chunk_size:
+                break
+            args["room_id"], args["user_id"] = rows[-1][ROOM_ID], rows[-1][USER_ID]
+
+
+class ScoreHistogram:
+    """live_id・難易度ごとのスコアのヒストグラムと合計をチャンク単位で足し込む"""
+
+    def __init__(self, bin_width: int = BIN_WIDTH, max_score: int = MAX_SCORE):
+        _require_numpy()
+        self.bin_width = bin_width
+        self.keys: list[tuple[int, int]] = []  # グループ番号 -> (live_id, difficulty)
+        self._groups: dict[tuple[int, int], int] = {}
+        # 最後のビンは max_score 以上のスコアをまとめて数える
+        n_bins = max_score // bin_width + 2
+        self.counts = np.zeros((0, n_bins), dtype=np.int64)  # [グループ, ビン]
+        self.sums = np.zeros(0, dtype=np.float64)
+        self.squares = np.zeros(0, dtype=np.float64)
+        self.maxes = np.zeros(0, dtype=np.int64)
+
+    def add(self, chunk: "np.ndarray") -> None:
+        groups = self.group_of(chunk)
+        scores = chunk[:, SCORE]
+        n_groups, n_bins = self.counts.shape
+        bins = np.minimum(np.maximum(scores, 0) // self.bin_width, n_bins - 1)
+        self.counts += np.bincount(
+            groups * n_bins + bins, minlength=n_groups * n_bins
+        ).reshape(n_groups, n_bins)
+        self.sums += np.bincount(groups, weights=scores, minlength=n_groups)
+        self.squares += np.bincount(
+            groups, weights=scores.astype(np.float64) ** 2, minlength=n_groups
+        )
+        np.maximum.at(self.maxes, groups, scores)
+
+    def group_of(self, chunk: "np.ndarray") -> "np.ndarray":
+        """各行のグループ番号。初めて見た live_id・難易度には番号を振る"""
+        # 2列のまま np.unique(axis=0) にかけると遅いので1つの整数にまとめる
+        packed = chunk[:, LIVE_ID] << 8 | chunk[:, DIFFICULTY]
+        keys, inverse = np.unique(packed, return_inverse=True)
+        index = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys.tolist()):
+            live_id, difficulty = key >> 8, key & 0xFF
+            group = self._groups.get((live_id, difficulty))
+            if group is None:
+                group = self._groups[live_id, difficulty] = len(self.keys)
+                self.keys.append((live_id, difficulty))
+            index[i] = group
+        if len(self.keys) > self.counts.shape[0]:
+            self._grow(len(self.keys))
+        return index[inverse.reshape(-1)]
+
+    def _grow(self, n_groups: int) -> None:
+        self.counts = np.pad(
+            self.counts, ((0, n_groups - self.counts.shape[0]), (0, 0))
+        )
+        extra = n_groups - len(self.sums)
+        self.sums = np.pad(self.sums, (0, extra))
+        self.squares = np.pad(self.squares, (0, extra))
+        self.maxes = np.pad(self.maxes, (0, extra))
+
+    def distributions(self) -> list[ScoreDistribution]:
+        totals = self.counts.sum(axis=1)
+        means = self.sums / np.maximum(totals, 1)
+        stds = np.sqrt(np.maximum(self.squares / np.maximum(totals, 1) - means**2, 0))
+        cumulative = self.counts.cumsum(axis=1)
+        percentiles = {}
+        for q in (50, 90, 99):
+            # 累積が q% に届くビンの上端 (そのビンの最大の点) を返す。
+            # 最後のビンに届いたときはそのグループの最大値になる
+            ranks = np.ceil(totals * q / 100).astype(np.int64)
+            bins = (cumulative < ranks[:, None]).sum(axis=1)
+            percentiles[q] = np.minimum((bins + 1) * self.bin_width - 1, self.maxes)
+        return [
+            ScoreDistribution(
+                live_id,
+                difficulty,
+                int(totals[g]),
+                float(means[g]),
+                float(stds[g]),
+                int(percentiles[50][g]),
+                int(percentiles[90][g]),
+                int(percentiles[99][g]),
+                int(self.maxes[g]),
+            )
+            for g, (live_id, difficulty) in enumerate(self.keys)
+        ]
+
+
+def find_outliers(
+    chunk: "np.ndarray", histogram: ScoreHistogram, z: float = OUTLIER_Z
+) -> list[Outlier]:
+    """chunk の中の外れ値。histogram は全チャンクを足し込んだ後のもの"""
+    outliers = []
+    reasons = np.full(len(chunk), "", dtype=object)
+
+    if validation.live_notes:
+        live_ids = np.fromiter(validation.live_notes, dtype=np.int64)
+        notes = np.array(list(validation.live_notes.values()), dtype=np.int64)
+        order = np.argsort(live_ids)
+        live_ids, notes = live_ids[order], notes[order]
+        position = np.searchsorted(live_ids, chunk[:, LIVE_ID])
+        position = np.minimum(position, len(live_ids) - 1)
+        known = live_ids[position] == chunk[:, LIVE_ID]
+        note_count, max_score = notes[position, 0], notes[position, 1]
+        reasons[known & (chunk[:, SCORE] > max_score)] = "score_above_max"
+        reasons[known & (chunk[:, JUDGES].sum(axis=1) != note_count)] = (
+            "note_count_mismatch"
+        )
+
+    groups = histogram.group_of(chunk)
+    totals = histogram.counts.sum(axis=1)
+    means = histogram.sums / np.maximum(totals, 1)
+    stds = np.sqrt(np.maximum(histogram.squares / np.maximum(totals, 1) - means**2, 0))
+    deviation = np.abs(chunk[:, SCORE] - means[groups])
+    far = (stds[groups] > 0) & (deviation > z * stds[groups])
+    reasons[far & (reasons == "")] = "z_score"
+
+    for i in np.flatnonzero(reasons != ""):
+        row = chunk[i]
+        outliers.append(
+            Outlier(
+                int(row[ROOM_ID]),
+                int(row[USER_ID]),
+                int(row[LIVE_ID]),
+                int(row[DIFFICULTY]),
+                int(row[SCORE]),
+                reasons[i],
+            )
+        )
+    return outliers
+
+
+def analyze(
+    chunk_size: int = CHUNK_SIZE,
+    bin_width: int = BIN_WIDTH,
+    z: float = OUTLIER_Z,
+    max_outliers: Optional[int] = MAX_OUTLIERS,
+    max_score: Optional[int] = None,
+) -> tuple[list[ScoreDistribution], list[Outlier], int]:
+    """(分布, 外れ値 (先頭 max_outliers 件), 外れ値の総数) を返す
+
+    外れ値は平均と標準偏差が出揃ってから判定するので、アーカイブを2回読む。
+    max_score を省略すると validation.live_notes の理論値の最大 (表が空なら MAX_SCORE) にする。
+    """
+    if max_score is None:
+        notes = validation.live_notes.values()
+        max_score = max((n.max_score for n in notes), default=MAX_SCORE)
+    histogram = ScoreHistogram(bin_width, max_score)
+    for chunk in iter_chunks(chunk_size):
+        histogram.add(chunk)
+    outliers = []
+    total = 0
+    for chunk in iter_chunks(chunk_size):
+        found = find_outliers(chunk, histogram, z)
+        total += len(found)
+        outliers += found
+        if max_outliers is not None:
+            del outliers[max_outliers:]
+    return histogram.distributions(), outliers, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="アーカイブしたスコアを解析する")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--bin-width", type=int, default=BIN_WIDTH)
+    parser.add_argument("--z", type=float, default=OUTLIER_Z)
+    parser.add_argument("--max-outliers", type=int, default=MAX_OUTLIERS)
+    parser.add_argument(
+        "--max-score", type=int, default=None, help="ヒストグラムの上限 (点)"
+    )
+    args = parser.parse_args()
+
+    validation.load_live_notes()
+    distributions, outliers, total = analyze(
+        args.chunk_size, args.bin_width, args.z, args.max_outliers, args.max_score
+    )
+    for distribution in distributions:
+        print(json.dumps({"type": "distribution", **distribution._asdict()}))
+    for outlier in outliers:
+        print(json.dumps({"type": "outlier", **outlier._asdict()}))
+    print(
+        json.dumps(
+            {
+                "type": "summary",
+                "rows": sum(d.count for d in distributions),
+                "outliers": total,
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
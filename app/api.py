@@ -1,23 +1,278 @@
+import asyncio
+import time
 from enum import Enum
+from functools import lru_cache
 from lib2to3.pytree import Base
+from typing import Any, Callable, Coroutine, Optional
 
-from fastapi import Depends, FastAPI, HTTPException
+import anyio
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.routing import APIRoute
 from fastapi.security.http import HTTPAuthorizationCredentials, HTTPBearer
-from pydantic import BaseModel
-
-from . import model
+from pydantic import BaseModel, conint, conlist
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from . import config, db, model, ranking, validation
+from .db import pool_stats, run, track_queries
+from .events import event_bus
+from .matchmaker import matchmaker
+from .metrics import registry
 from .model import (
     JoinRoomResult,
     LiveDifficulty,
+    RankingUser,
     ResultUser,
     RoomInfo,
     RoomUser,
     SafeUser,
     WaitRoomStatus,
 )
+from .notify import room_hub
 
 app = FastAPI()
 
+LONG_POLL_TIMEOUT_MAX: float = 60
+USER_CREATE_BATCH_MAX: int = 10000
+ROOM_LIST_LIMIT_MAX: int = 1000
+SSE_KEEPALIVE_INTERVAL: float = 15
+
+
+@app.on_event("startup")
+async def warm_up():
+    """起動時にプールとキャッシュを温める。uvicorn はこれが終わってから accept を始める"""
+    validation.load_live_notes()
+    if not config.WARM_UP:
+        return
+    await run(db.warm_up)
+    await db.warm_up_async()
+    await run(model.warm_room_cache)
+    for route in app.routes:
+        _route_path(getattr(route, "endpoint", None))
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    model.room_sweeper.start()
+    model.room_reaper.start()
+    event_bus.start()
+    matchmaker.start()
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await matchmaker.stop()
+    model.room_sweeper.stop()
+    model.room_reaper.stop()
+    # 溜まっているスコアとランキングの書き直しを書き出してからイベントバスを止める
+    model.score_writer.stop()
+    ranking.play_retries.stop()
+    # 発火していないタイムアウトは room.deadline_at に残っているので、
+    # 他のワーカー (か再起動後のこのワーカー) の room_sweeper が確定させる
+    model.room_timer.stop()
+    event_bus.stop()
+
+
+http_requests = registry.counter("http_requests_total", "処理したリクエスト数")
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "リクエストの処理時間"
+)
+http_requests_in_flight = registry.gauge(
+    "http_requests_in_flight", "処理中のリクエスト数"
+).labels()
+# DB_QUERY_STATS=1 のときだけ数える
+db_queries = registry.counter("db_queries_total", "リクエスト中に実行したクエリ数")
+db_time = registry.counter(
+    "db_time_seconds_total", "リクエスト中にクエリにかかった時間"
+)
+threadpool_tasks = registry.gauge("threadpool_tasks", "スレッドプールのタスク数")
+rooms = registry.gauge("rooms", "状態ごとのルーム数")
+rooms_by_members = registry.gauge("rooms_by_members", "参加人数ごとの未解散のルーム数")
+room_timers_pending = registry.gauge(
+    "room_timers_pending", "待機中のタイムアウトタイマー数"
+).labels()
+room_timer_lag = registry.gauge(
+    "room_timer_lag_seconds", "タイムアウトの発火の遅れ"
+).labels()
+db_pool = registry.gauge("db_pool", "コネクションプールの使用状況")
+cache_hit_rate = registry.gauge("cache_hit_rate", "キャッシュのヒット率")
+rooms_reaped = registry.counter("rooms_reaped_total", "リーパーが処理した行数")
+scores_rejected = registry.counter(
+    "scores_rejected_total", "検証で弾いた /room/end のスコア数"
+)
+singleflight_calls = registry.counter(
+    "singleflight_calls_total", "同時の同じ読み出しをまとめる層への呼び出し数"
+)
+singleflight_shared = registry.counter(
+    "singleflight_shared_total",
+    "実行中の読み出しに相乗りして DB を読まなかった呼び出し数",
+)
+singleflight_shared_rate = registry.gauge(
+    "singleflight_shared_rate", "相乗りした呼び出しの割合"
+)
+oldest_live_room_age = registry.gauge(
+    "oldest_live_room_age_seconds", "未解散で最も古いルームの経過秒数"
+).labels()
+
+
+class MetricsRoute(APIRoute):
+    """リクエストの数と処理時間を記録するルート
+
+    ミドルウェアで包むとリクエストごとに send を包む関数とラベルの子の検索が要るので、
+    ルートのハンドラを起動時に1度だけ包み、子メトリクスもルートごとに持っておく。
+    パスにマッチしなかったリクエストは記録しない。
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        return instrument_handler(super().get_route_handler(), self.path)
+
+
+def instrument_handler(
+    handler: Callable[[Request], Coroutine[Any, Any, Response]], path: str
+) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+    """handler を path のリクエストとして数と処理時間を記録するように包む
+
+    リクエストごとの処理を減らすため、ラベルの子は (method, status) ごとに覚えておき、
+    処理中のリクエスト数とリクエスト数はメソッドを呼ばずに直接足す。
+    """
+    children = {}  # (method, status) -> (処理時間, リクエスト数)
+    in_flight = http_requests_in_flight
+    perf_counter = time.perf_counter
+
+    async def metrics_handler(request: Request) -> Response:
+        start = perf_counter()
+        status = 500  # レスポンスを返す前に例外で抜けたとき
+        in_flight.value += 1
+        try:
+            response = await handler(request)
+            status = response.status_code
+            return response
+        except StarletteHTTPException as e:
+            status = e.status_code
+            raise
+        except RequestValidationError:
+            status = 422
+            raise
+        finally:
+            in_flight.value -= 1
+            key = (request.scope["method"], status)
+            metrics = children.get(key)
+            if metrics is None:
+                metrics = children[key] = (
+                    http_request_duration.labels(method=key[0], path=path),
+                    http_requests.labels(method=key[0], path=path, status=str(status)),
+                )
+            metrics[0].observe(perf_counter() - start)
+            metrics[1].value += 1
+
+    return metrics_handler
+
+
+app.router.route_class = MetricsRoute
+
+
+@lru_cache(maxsize=None)
+def _route_path(endpoint) -> str:
+    """メトリクスのラベルに使うパス。/room/{room_id}/events のようにテンプレートのまま返す"""
+    for route in app.routes:
+        if getattr(route, "endpoint", None) is endpoint:
+            return route.path
+    return "unmatched"
+
+
+class QueryStatsMiddleware:
+    """リクエスト中のクエリの数と時間を数え、レスポンスヘッダとメトリクスに載せる
+
+    全てのクエリと全てのリクエストに手間が掛かるので、DB_QUERY_STATS=1 のときだけ使う。
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        with track_queries() as stats:
+
+            async def send_with_stats(message: Message) -> None:
+                if message["type"] == "http.response.start":
+                    message["headers"] = [
+                        *message.get("headers", ()),
+                        (b"x-db-queries", b"%d" % stats.queries),
+                        (b"server-timing", b"db;dur=%.3f" % (stats.db_time * 1000)),
+                    ]
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_stats)
+            finally:
+                query_count, query_time = _query_metrics(scope.get("endpoint"))
+                query_count.inc(stats.queries)
+                query_time.inc(stats.db_time)
+
+
+@lru_cache(maxsize=None)
+def _query_metrics(endpoint) -> tuple:
+    """(クエリ数, クエリ時間) の子メトリクス"""
+    path = _route_path(endpoint)
+    return db_queries.labels(path=path), db_time.labels(path=path)
+
+
+if config.DB_QUERY_STATS:
+    app.add_middleware(QueryStatsMiddleware)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus 形式のメトリクス"""
+    threadpool = anyio.to_thread.current_default_thread_limiter().statistics()
+    threadpool_tasks.labels(state="running").set(threadpool.borrowed_tokens)
+    threadpool_tasks.labels(state="waiting").set(threadpool.tasks_waiting)
+
+    room_counts = await run(model.count_rooms)
+    rooms.clear()
+    rooms_by_members.clear()
+    for status in WaitRoomStatus:
+        rooms.labels(status=status.name).set(0)
+    for status, joined_user_count, count in room_counts:
+        rooms.labels(status=status.name).inc(count)
+        if status != WaitRoomStatus.Dissolution:
+            rooms_by_members.labels(members=str(joined_user_count)).inc(count)
+    room_timers_pending.set(model.room_timer.pending)
+    room_timer_lag.set(model.room_timer.lag)
+    reaper = model.reaper_stats
+    rooms_reaped.labels(kind="expired").value = reaper.expired
+    rooms_reaped.labels(kind="archived_rooms").value = reaper.archived_rooms
+    rooms_reaped.labels(kind="archived_members").value = reaper.archived_members
+    if reaper.last is not None and reaper.last.oldest_live_room_age is not None:
+        oldest_live_room_age.set(reaper.last.oldest_live_room_age)
+
+    for name, value in pool_stats.as_dict().items():
+        db_pool.labels(stat=name).set(value)
+    for name, cache in [
+        ("user", model.user_cache),
+        ("room", model.room_cache),
+        ("room_list", model.room_list_cache),
+        ("result", model.result_cache),
+        ("ranking", ranking.leaderboards.cache),
+    ]:
+        cache_hit_rate.labels(cache=name).set(cache.stats.hit_rate)
+    for name, flight in [
+        ("room_state", model.room_state_flight),
+        ("room_status", model.room_status_flight),
+        ("room_users", model.room_users_flight),
+        ("result", model.result_flight),
+        ("room_list", model.room_list_flight),
+    ]:
+        singleflight_calls.labels(call=name).value = flight.stats.calls
+        singleflight_shared.labels(call=name).value = flight.stats.shared
+        singleflight_shared_rate.labels(call=name).set(flight.stats.shared_rate)
+    return registry.render()
+
+
 # Sample APIs
 
 
@@ -39,12 +294,29 @@ class UserCreateResponse(BaseModel):
 
 
 @app.post("/user/create", response_model=UserCreateResponse)
-def user_create(req: UserCreateRequest):
+async def user_create(req: UserCreateRequest):
     """新規ユーザー作成"""
-    token = model.create_user(req.user_name, req.leader_card_id)
+    token = await run(model.create_user, req.user_name, req.leader_card_id)
     return UserCreateResponse(user_token=token)
 
 
+class UserCreateBatchRequest(BaseModel):
+    users: conlist(UserCreateRequest, min_items=1, max_items=USER_CREATE_BATCH_MAX)
+
+
+class UserCreateBatchResponse(BaseModel):
+    user_tokens: list[str]  # users と同じ順
+
+
+@app.post("/user/create_batch", response_model=UserCreateBatchResponse)
+async def user_create_batch(req: UserCreateBatchRequest):
+    """ユーザーをまとめて作成する"""
+    tokens = await run(
+        model.create_users, [(u.user_name, u.leader_card_id) for u in req.users]
+    )
+    return UserCreateBatchResponse(user_tokens=tokens)
+
+
 bearer = HTTPBearer()
 
 
@@ -55,12 +327,19 @@ def get_auth_token(cred: HTTPAuthorizationCredentials = Depends(bearer)) -> str:
     return cred.credentials
 
 
-@app.get("/user/me", response_model=SafeUser)
-def user_me(token: str = Depends(get_auth_token)):
-    user = model.get_user_by_token(token)
+async def get_current_user(token: str = Depends(get_auth_token)) -> SafeUser:
+    """token に対応するユーザー。キャッシュにあればDBを見ない"""
+    found, user = model.get_cached_user(token)
+    if not found:
+        user = await run(model.get_user_by_token, token)
     if user is None:
         raise HTTPException(status_code=404)
-    # print(f"user_me({token=}, {user=})")
+    return user
+
+
+@app.get("/user/me", response_model=SafeUser)
+async def user_me(user: SafeUser = Depends(get_current_user)):
+    # print(f"user_me({user=})")
     return user
 
 
@@ -69,14 +348,47 @@ class Empty(BaseModel):
 
 
 @app.post("/user/update", response_model=Empty)
-def update(req: UserCreateRequest, token: str = Depends(get_auth_token)):
+async def update(req: UserCreateRequest, token: str = Depends(get_auth_token)):
     """Update user attributes"""
     # print(req)
-    model.update_user(token, req.user_name, req.leader_card_id)
+    await run(model.update_user, token, req.user_name, req.leader_card_id)
     return {}
 
 
+class PersonalBestResponse(BaseModel):
+    live_id: int
+    select_difficulty: LiveDifficulty
+    score: int  # 自己ベスト
+    play_count: int
+
+
+@app.get("/user/best", response_model=list[PersonalBestResponse])
+async def user_best(
+    live_id: Optional[int] = None, user: SafeUser = Depends(get_current_user)
+):
+    """自己ベスト。live_id を省略すると全曲分"""
+    bests = await run(ranking.get_personal_bests, user.id, live_id)
+    return [
+        PersonalBestResponse(
+            live_id=best.live_id,
+            select_difficulty=best.difficulty,
+            score=best.score,
+            play_count=best.play_count,
+        )
+        for best in bests
+    ]
+
+
 # Room APIs
+#
+# FAST_JSON が有効なら、よくポーリングされるエンドポイントは ORJSONResponse を直接返す。
+# response_model による検証と jsonable_encoder を通らないので、返す dict は
+# response_model と同じ形にしておくこと (test_room_fast_json で比べている)
+
+
+def _as_dict(obj: BaseModel) -> dict:
+    """モデル層で作ったモデルを検証し直さずに dict にする。フィールドは JSON にできる値だけ"""
+    return {name: getattr(obj, name) for name in obj.__fields__}
 
 
 class RoomCreateRequest(BaseModel):
@@ -90,10 +402,13 @@ class RoomCreateResponse(BaseModel):
 
 class RoomListRequest(BaseModel):
     live_id: int
+    limit: Optional[conint(ge=1, le=ROOM_LIST_LIMIT_MAX)] = None  # 最大件数
+    cursor: Optional[int] = None  # 前回のレスポンスの next_cursor
 
 
 class RoomListResponse(BaseModel):
     room_info_list: list[RoomInfo]
+    next_cursor: Optional[int] = None  # 続きがあれば次のリクエストに添える
 
 
 class RoomJoinRequest(BaseModel):
@@ -136,70 +451,236 @@ class RoomLeaveRequest(BaseModel):
     room_id: int
 
 
+class RoomWaitLongPollRequest(BaseModel):
+    room_id: int
+    version: Optional[int] = None  # 前回受け取った version
+    timeout: float = 30
+
+
+class RoomWaitLongPollResponse(RoomWaitResponse):
+    version: int
+
+
+class RoomResultLongPollRequest(BaseModel):
+    room_id: int
+    timeout: float = 30
+
+
+class RoomMatchmakeRequest(BaseModel):
+    live_id: int
+    select_difficulty: LiveDifficulty
+    timeout: float = 30
+
+
+class RoomMatchmakeResponse(BaseModel):
+    room_id: Optional[int]  # マッチしなかった場合は null
+
+
 @app.post("/room/create", response_model=RoomCreateResponse)
-def room_create(req: RoomCreateRequest, token: str = Depends(get_auth_token)):
-    user = model.get_user_by_token(token)
-    if user is None:
-        raise HTTPException(status_code=404)
-    room_id = model.create_room(req.live_id, user.id)
+async def room_create(
+    req: RoomCreateRequest, user: SafeUser = Depends(get_current_user)
+):
+    room_id = await run(model.create_room, req.live_id, user.id)
     # ルーム立てた人を入場させる
-    model.join_room(room_id, user.id, req.select_difficulty)
+    await run(model.join_room, room_id, user.id, req.select_difficulty)
     return RoomCreateResponse(room_id=room_id)
 
 
+@app.post("/room/matchmake", response_model=RoomMatchmakeResponse)
+async def room_matchmake(
+    req: RoomMatchmakeRequest, user: SafeUser = Depends(get_current_user)
+):
+    """同じ楽曲・難易度を選んだ人とマッチングしてルームに入る。マッチするまで最大 timeout 秒待つ"""
+    room_id = await matchmaker.matchmake(
+        user.id,
+        req.live_id,
+        req.select_difficulty,
+        min(req.timeout, LONG_POLL_TIMEOUT_MAX),
+    )
+    return RoomMatchmakeResponse(room_id=room_id)
+
+
 @app.post("/room/list", response_model=RoomListResponse)
-def room_list(req: RoomListRequest):
-    room_info_list = model.list_room(req.live_id)
-    return RoomListResponse(room_info_list=room_info_list)
+async def room_list(req: RoomListRequest):
+    room_info_list = await run(model.list_room, req.live_id, req.limit, req.cursor)
+    next_cursor = None
+    if req.limit is not None and len(room_info_list) == req.limit:
+        next_cursor = room_info_list[-1].room_id
+    if config.FAST_JSON:
+        return ORJSONResponse(
+            {
+                "room_info_list": [_as_dict(info) for info in room_info_list],
+                "next_cursor": next_cursor,
+            }
+        )
+    return RoomListResponse(room_info_list=room_info_list, next_cursor=next_cursor)
 
 
 @app.post("/room/join", response_model=RoomJoinResponse)
-def room_join(req: RoomJoinRequest, token: str = Depends(get_auth_token)):
-    user = model.get_user_by_token(token)
-    if user is None:
-        raise HTTPException(status_code=404)
-    join_room_result = model.join_room(req.room_id, user.id, req.select_difficulty)
+async def room_join(req: RoomJoinRequest, user: SafeUser = Depends(get_current_user)):
+    join_room_result = await run(
+        model.join_room, req.room_id, user.id, req.select_difficulty
+    )
     return RoomJoinResponse(join_room_result=join_room_result)
 
 
 @app.post("/room/wait", response_model=RoomWaitResponse)
-def room_wait(req: RoomWaitRequest, token: str = Depends(get_auth_token)):
-    user = model.get_user_by_token(token)
-    if user is None:
+async def room_wait(req: RoomWaitRequest, token: str = Depends(get_auth_token)):
+    found, user = model.get_cached_user(token)
+    if found and user is None:
         raise HTTPException(status_code=404)
-    status = model.get_room_status(req.room_id)
-    room_user_list = model.get_room_users(req.room_id, user.id)
+    result = await run(model.wait_room, req.room_id, token, config.FAST_JSON)
+    if result is None:
+        raise HTTPException(status_code=404)
+    status, room_user_list = result
+    if config.FAST_JSON:
+        return ORJSONResponse({"status": status, "room_user_list": room_user_list})
     return RoomWaitResponse(status=status, room_user_list=room_user_list)
 
 
+@app.post("/room/wait/long_poll", response_model=RoomWaitLongPollResponse)
+async def room_wait_long_poll(
+    req: RoomWaitLongPollRequest, token: str = Depends(get_auth_token)
+):
+    """ルームの状態か参加者が req.version から変わるまで、最大 timeout 秒待って返す"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + min(req.timeout, LONG_POLL_TIMEOUT_MAX)
+    async with room_hub.listen(req.room_id) as listener:
+        while True:
+            result = await run(model.get_room_state, req.room_id, token)
+            if result is None:
+                raise HTTPException(status_code=404)
+            state, me_id = result
+            if state is None:
+                return RoomWaitLongPollResponse(
+                    status=WaitRoomStatus.Dissolution, room_user_list=[], version=-1
+                )
+            remaining = deadline - loop.time()
+            if state.version != req.version or remaining <= 0:
+                return RoomWaitLongPollResponse(
+                    status=state.status,
+                    room_user_list=model.room_users(state, me_id),
+                    version=state.version,
+                )
+            await listener.wait(remaining)
+
+
 @app.post("/room/start", response_model=Empty)
-def room_start(req: RoomStartRequest):
-    model.start_room(req.room_id)
+async def room_start(req: RoomStartRequest):
+    await run(model.start_room, req.room_id)
     return {}
 
 
 @app.post("/room/end", response_model=Empty)
-def room_end(req: RoomEndRequest, token: str = Depends(get_auth_token)):
+async def room_end(req: RoomEndRequest, user: SafeUser = Depends(get_current_user)):
     if len(req.judge_count_list) != 5:
         raise HTTPException(
             status_code=400,
             detail="The number of elements of judge_count_list must be 5.",
         )
-    user = model.get_user_by_token(token)
-    model.end_room(req.room_id, user.id, req.judge_count_list, req.score)
+    try:
+        await run(model.end_room, req.room_id, user.id, req.judge_count_list, req.score)
+    except validation.InvalidScore as e:
+        scores_rejected.labels(reason=e.reason).inc()
+        raise HTTPException(status_code=400, detail=str(e))
     return {}
 
 
 @app.post("/room/result", response_model=RoomResultResponse)
-def room_result(req: RoomResultRequest):
-    result_user_list = model.result_room(req.room_id)
+async def room_result(req: RoomResultRequest):
+    result_user_list = await run(model.result_room, req.room_id)
+    if config.FAST_JSON:
+        return ORJSONResponse(
+            {"result_user_list": [_as_dict(user) for user in result_user_list]}
+        )
     return RoomResultResponse(result_user_list=result_user_list)
 
 
-@app.post("/room/leave", response_model=Empty)
-def room_leave(req: RoomLeaveRequest, token: str = Depends(get_auth_token)):
-    user = model.get_user_by_token(token)
-    if user is None:
+@app.post("/room/result/long_poll", response_model=RoomResultResponse)
+async def room_result_long_poll(req: RoomResultLongPollRequest):
+    """全員の結果が揃うまで、最大 timeout 秒待って返す"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + min(req.timeout, LONG_POLL_TIMEOUT_MAX)
+    async with room_hub.listen(req.room_id) as listener:
+        while True:
+            result_user_list = await run(model.result_room, req.room_id)
+            remaining = deadline - loop.time()
+            if result_user_list or remaining <= 0:
+                return RoomResultResponse(result_user_list=result_user_list)
+            await listener.wait(remaining)
+
+
+@app.get("/room/{room_id}/events")
+async def room_events(room_id: int, token: str = Depends(get_auth_token)):
+    """ルームの状態を Server-Sent Events で送る
+
+    状態か参加者が変わるたびに wait イベント (RoomWaitResponse) を送り、
+    全員の結果が揃ったら result イベント (RoomResultResponse) を送って終了する。
+    """
+    result = await run(model.get_room_state, room_id, token)
+    if result is None or result[0] is None:
         raise HTTPException(status_code=404)
-    model.leave_room(req.room_id, user.id)
+
+    async def stream():
+        version = None
+        async with room_hub.listen(room_id) as listener:
+            while True:
+                result = await run(model.get_room_state, room_id, token)
+                if result is None or result[0] is None:
+                    return
+                state, me_id = result
+                if state.version != version:
+                    version = state.version
+                    response = RoomWaitResponse(
+                        status=state.status,
+                        room_user_list=model.room_users(state, me_id),
+                    )
+                    yield f"event: wait\ndata: {response.json()}\n\n"
+                if state.status != WaitRoomStatus.Waiting:
+                    result_user_list = await run(model.result_room, room_id)
+                    if result_user_list:
+                        response = RoomResultResponse(result_user_list=result_user_list)
+                        yield f"event: result\ndata: {response.json()}\n\n"
+                        return
+                if not await listener.wait(SSE_KEEPALIVE_INTERVAL):
+                    yield ": keepalive\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+@app.post("/room/leave", response_model=Empty)
+async def room_leave(req: RoomLeaveRequest, user: SafeUser = Depends(get_current_user)):
+    await run(model.leave_room, req.room_id, user.id)
     return {}
+
+
+# Ranking APIs
+
+
+class RankingResponse(BaseModel):
+    live_id: int
+    select_difficulty: LiveDifficulty
+    ranking: list[RankingUser]
+    play_count: int  # この曲・難易度が遊ばれた延べ人数
+    average_score: float
+    max_score: int
+
+
+@app.get("/ranking/{live_id}", response_model=RankingResponse)
+async def ranking_get(
+    live_id: int,
+    select_difficulty: LiveDifficulty = LiveDifficulty.normal,
+    limit: int = Query(ranking.RANKING_SIZE, ge=1, le=ranking.RANKING_SIZE),
+):
+    """自己ベストの上位 limit 件と曲ごとの集計"""
+    ranking_users, stats = await run(
+        model.get_ranking, live_id, select_difficulty, limit
+    )
+    return RankingResponse(
+        live_id=live_id,
+        select_difficulty=select_difficulty,
+        ranking=ranking_users,
+        play_count=stats.play_count,
+        average_score=stats.score_sum / stats.play_count if stats.play_count else 0.0,
+        max_score=stats.max_score,
+    )
@@ -0,0 +1,164 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+V = TypeVar("V")
+
+
+class CacheStats:
+    """キャッシュのヒット率"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit: bool) -> None:
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def as_dict(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate}
+
+
+class LRUCache(Generic[V]):
+    """スレッドセーフな上限付き LRU キャッシュ
+
+    ttl を指定するとエントリは ttl 秒で失効する。
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._data: "OrderedDict[Hashable, tuple[V, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[V]:
+        """値を返し、ヒット・ミスを記録する"""
+        value = self.peek(key)
+        self.stats.record(value is not None)
+        return value
+
+    def peek(self, key: Hashable) -> Optional[V]:
+        """ヒット・ミスを記録せずに値を返す"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: V, ttl: Optional[float] = None) -> None:
+        """ttl を指定するとこのエントリだけ既定の ttl を上書きする"""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else float("inf")
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Optional[V]:
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return None if entry is None else entry[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class FlightStats:
+    """SingleFlight の呼び出し数と、実行中の呼び出しに相乗りした数"""
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+
+    @property
+    def shared_rate(self) -> float:
+        return self.shared / self.calls if self.calls else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "shared": self.shared,
+            "shared_rate": self.shared_rate,
+        }
+
+
+class _Flight:
+    def __init__(self):
+        self.thread = threading.get_ident()
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight(Generic[V]):
+    """同じキーで同時に来た呼び出しを1回の実行にまとめる
+
+    実行中の呼び出しがあれば、後から来た呼び出しはその完了を待って同じ結果 (例外) を受け取る。
+    結果のオブジェクトは呼び出し元の間で共有されるので、書き換えないこと。
+    実行中の呼び出しと同じスレッドからの呼び出し (ASYNC_DB ではどれもイベントループのスレッドで動く)
+    は待つと先に進めなくなるので、相乗りせずに自分で実行する。
+    """
+
+    def __init__(self):
+        self.stats = FlightStats()
+        self._flights: dict[Hashable, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[..., V], *args) -> V:
+        me = threading.get_ident()
+        with self._lock:
+            self.stats.calls += 1
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leader = True
+            else:
+                leader = False
+                if flight.thread != me:
+                    self.stats.shared += 1
+        if not leader:
+            if flight.thread == me:
+                return fn(*args)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn(*args)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            self.forget(key, flight)
+            flight.done.set()
+
+    def forget(self, key: Hashable, flight: Optional[_Flight] = None) -> None:
+        """実行中の呼び出しを忘れ、以降の呼び出しには新しく実行させる
+
+        書き込みの後に呼ぶと、書き込みより前に始まった読み出しに相乗りしなくなる。
+        """
+        with self._lock:
+            if flight is None or self._flights.get(key) is flight:
+                self._flights.pop(key, None)
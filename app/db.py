@@ -1,5 +1,263 @@
-from sqlalchemy import create_engine
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator, Optional, TypeVar
 
-from . import config
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import QueuePool, StaticPool
+from starlette.concurrency import run_in_threadpool
 
-engine = create_engine(config.DATABASE_URI, future=True, echo=True)
+from . import config, sqlite
+
+T = TypeVar("T")
+
+
+class PoolStats:
+    """コネクションプールの使用状況"""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.checkout_time = 0.0  # コネクションの取得を待った合計秒数
+        self.max_checkout_time = 0.0
+        self.in_use = 0  # 貸し出し中のコネクション数
+        self.overflow = 0  # pool_size を超えて貸し出し中のコネクション数
+
+    def record_checkout(self, elapsed: float) -> None:
+        self.checkouts += 1
+        self.checkout_time += elapsed
+        if elapsed > self.max_checkout_time:
+            self.max_checkout_time = elapsed
+
+    def as_dict(self) -> dict:
+        return {
+            "checkouts": self.checkouts,
+            "checkout_time": self.checkout_time,
+            "max_checkout_time": self.max_checkout_time,
+            "in_use": self.in_use,
+            "overflow": self.overflow,
+        }
+
+
+class QueryStats:
+    """track_queries() の間に実行したクエリの数と時間"""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0  # 秒
+
+
+_POOL_OPTIONS = dict(
+    pool_size=config.DB_POOL_SIZE,
+    max_overflow=config.DB_MAX_OVERFLOW,
+    pool_timeout=config.DB_POOL_TIMEOUT,
+    pool_recycle=config.DB_POOL_RECYCLE,
+    pool_pre_ping=config.DB_POOL_PRE_PING,
+    echo=config.DB_ECHO,
+)
+
+
+def _create_engine(shard: int) -> Engine:
+    """shard 番目のシャードのエンジン。シャード 0 はシャードしないテーブルも持つ"""
+    if config.STORAGE == "mysql":
+        uri = config.DATABASE_URI
+        if shard > 0:
+            uri = config.SHARD_DATABASE_URIS[shard - 1]
+        engine = create_engine(uri, future=True, **_POOL_OPTIONS)
+        if config.SHARDS > 1:
+
+            @event.listens_for(engine, "connect")
+            def _connect(dbapi_conn, record):
+                # このシャードの AUTO_INCREMENT は shard + 1 から SHARDS おきに払い出す
+                cursor = dbapi_conn.cursor()
+                cursor.execute(
+                    f"SET SESSION auto_increment_increment={config.SHARDS}, auto_increment_offset={shard + 1}"
+                )
+                cursor.close()
+
+        return engine
+    if config.STORAGE == "sqlite":
+        path = config.SQLITE_PATH if shard == 0 else f"{config.SQLITE_PATH}.{shard}"
+        engine = create_engine(
+            f"sqlite:///{path}",
+            future=True,
+            poolclass=QueuePool,
+            connect_args={"check_same_thread": False, "timeout": 30},
+            **_POOL_OPTIONS,
+        )
+    elif config.STORAGE == "sqlite_memory":
+        # テスト用。全スレッドで1つのコネクションを共有し、_sqlite_locks で全ルームの処理を順番に行う
+        engine = create_engine(
+            "sqlite://",
+            future=True,
+            poolclass=StaticPool,
+            connect_args={"check_same_thread": False},
+            echo=config.DB_ECHO,
+        )
+    else:
+        raise ValueError(f"unknown STORAGE: {config.STORAGE}")
+    sqlite.setup(engine, shard, config.SHARDS)
+    return engine
+
+
+if config.ASYNC_DB and config.SHARDS > 1:
+    # 非同期エンジンはシャード 0 だけで auto_increment の設定も無いので、シャードの id の
+    # 払い出しが崩れ、シャード 1 以降は run_sync の中でイベントループを塞いでしまう
+    raise ValueError("ASYNC_DB=1 cannot be combined with SHARDS > 1")
+if config.ASYNC_DB and config.STORAGE == "memory":
+    raise ValueError("ASYNC_DB=1 cannot be combined with STORAGE=memory")
+
+if config.STORAGE == "memory":
+    # MemoryStorage は DB に繋がない
+    engine = None
+    shard_engines = []
+else:
+    engine = _create_engine(0)
+    shard_engines = [engine] + [_create_engine(i) for i in range(1, config.SHARDS)]
+async_engine = (
+    create_async_engine(config.ASYNC_DATABASE_URI, **_POOL_OPTIONS)
+    if config.ASYNC_DB
+    else None
+)
+pool_stats = PoolStats()
+async_pool_stats = PoolStats()
+
+# track_queries() で集計中の QueryStats
+_query_stats: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+
+@contextmanager
+def track_queries() -> Iterator[QueryStats]:
+    """この中で (run() 経由を含めて) 実行したクエリの数と時間を数える"""
+    stats = QueryStats()
+    token = _query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _query_stats.reset(token)
+
+
+def instrument(engine: Engine, stats: PoolStats) -> None:
+    """engine のクエリを track_queries() に、コネクションの貸し出しを stats に記録する"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        query_stats = _query_stats.get()
+        if query_stats is not None:
+            query_stats.queries += 1
+            query_stats.db_time += elapsed
+
+    @event.listens_for(engine, "checkout")
+    def _checkout(dbapi_conn, record, proxy):
+        stats.in_use += 1
+        stats.overflow = _overflow(engine.pool)
+
+    @event.listens_for(engine, "checkin")
+    def _checkin(dbapi_conn, record):
+        stats.in_use -= 1
+        stats.overflow = _overflow(engine.pool)
+
+
+def _overflow(pool) -> int:
+    return max(0, pool.overflow()) if isinstance(pool, QueuePool) else 0
+
+
+for shard_engine in shard_engines:
+    instrument(shard_engine, pool_stats)
+if async_engine is not None:
+    instrument(async_engine.sync_engine, async_pool_stats)
+
+# run() の中でモデル関数が使うコネクション
+_bound_conn: ContextVar[Optional[Connection]] = ContextVar("bound_conn", default=None)
+
+# SQLite は書き込めるのが同時に1トランザクションだけなので、プロセス内で順番に実行する
+_sqlite_locks = [
+    threading.RLock() if shard_engine.dialect.name == "sqlite" else None
+    for shard_engine in shard_engines
+]
+
+
+def warm_up(connections: int = config.DB_POOL_SIZE) -> None:
+    """各シャードのプールに connections 本のコネクションを張っておく"""
+    for shard in range(len(shard_engines)):
+        conns = [_connect(shard) for _ in range(connections)]
+        for conn in conns:
+            conn.close()
+
+
+async def warm_up_async(connections: int = config.DB_POOL_SIZE) -> None:
+    if async_engine is None:
+        return
+    conns = [await async_engine.connect() for _ in range(connections)]
+    for conn in conns:
+        await conn.close()
+
+
+def is_transient_error(e: Exception) -> bool:
+    """接続断・デッドロック・プールの取得待ちのタイムアウトなど、やり直せば通りうるエラーか"""
+    if isinstance(e, (OperationalError, PoolTimeoutError)):
+        return True
+    return isinstance(e, DBAPIError) and e.connection_invalidated
+
+
+def shard_of(room_id: int) -> int:
+    """ルームが置かれているシャード。シャード i は SHARDS で割って i + 1 余る id を払い出す"""
+    return (room_id - 1) % len(shard_engines)
+
+
+def _connect(shard: int) -> Connection:
+    """shard 番目のシャードのプールからコネクションを借り、借りるまでの時間を pool_stats に記録する"""
+    start = time.perf_counter()
+    conn = shard_engines[shard].connect()
+    pool_stats.record_checkout(time.perf_counter() - start)
+    return conn
+
+
+@contextmanager
+def begin(shard: int = 0):
+    """shard 番目のシャードで engine.begin() する
+
+    シャード 0 は run() 経由なら非同期ドライバのコネクションを使う。
+    """
+    conn = _bound_conn.get() if shard == 0 else None
+    lock = _sqlite_locks[shard]
+    if conn is None and lock is not None:
+        with lock, _connect(shard) as conn, conn.begin():
+            yield conn
+    elif conn is None:
+        with _connect(shard) as conn, conn.begin():
+            yield conn
+    else:
+        with conn.begin():
+            yield conn
+
+
+async def run(fn: Callable[..., T], *args) -> T:
+    """同期のモデル関数をイベントループを塞がずに実行する
+
+    ASYNC_DB が有効なら非同期ドライバのコネクション上で (run_sync)、
+    無効ならスレッドプールで実行する。
+    """
+    if async_engine is None:
+        return await run_in_threadpool(fn, *args)
+    start = time.perf_counter()
+    async with async_engine.connect() as conn:
+        async_pool_stats.record_checkout(time.perf_counter() - start)
+        return await conn.run_sync(_call_with_conn, fn, *args)
+
+
+def _call_with_conn(conn: Connection, fn: Callable[..., T], *args) -> T:
+    token = _bound_conn.set(conn)
+    try:
+        return fn(*args)
+    finally:
+        _bound_conn.reset(token)
@@ -0,0 +1,165 @@
+import logging
+import threading
+from enum import IntEnum
+from typing import Callable, NamedTuple, Optional
+
+from sqlalchemy import text
+
+from . import config
+from .db import begin
+
+logger = logging.getLogger(__name__)
+
+
+class RoomEventType(IntEnum):
+    Joined = 1  # 入室した
+    Left = 2  # 退室した
+    Started = 3  # ライブが開始された
+    ScoreSubmitted = 4  # スコアが送信された
+    TimedOut = 5  # タイムアウトでスコアが確定した
+    Dissolved = 6  # 結果が揃って解散された
+
+
+class RoomEvent(NamedTuple):
+    room_id: int
+    type: RoomEventType
+    user_id: Optional[int] = None
+
+
+Subscriber = Callable[[RoomEvent], None]
+
+
+class EventBus:
+    """ルームの状態遷移を購読者に配る
+
+    publish() は状態の変更をコミットした後に呼ぶ。
+    """
+
+    def __init__(self):
+        self._subscribers: list[Subscriber] = []
+
+    def subscribe(self, subscriber: Subscriber) -> None:
+        self._subscribers.append(subscriber)
+
+    def publish(self, event: RoomEvent) -> None:
+        raise NotImplementedError
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    def _dispatch(self, event: RoomEvent) -> None:
+        for subscriber in self._subscribers:
+            try:
+                subscriber(event)
+            except Exception:
+                logger.exception("event bus: subscriber failed on %s", event)
+
+
+class LocalEventBus(EventBus):
+    """同じプロセスの購読者にだけ配る"""
+
+    def publish(self, event: RoomEvent) -> None:
+        self._dispatch(event)
+
+
+class MySQLEventBus(EventBus):
+    """room_event テーブルを介して全ワーカーに配る
+
+    各ワーカーは自分が最後に読んだ id より大きいイベントをポーリングする。
+    自分が publish したイベントも同じ経路で受け取る。
+    AUTO_INCREMENT の採番順とコミット順が入れ替わるとイベントを取りこぼしうるが、
+    待ち受け側はタイムアウトで状態を読み直すので遅れるだけで済む。
+    """
+
+    def __init__(
+        self,
+        poll_interval: float,
+        batch_size: int = 1000,
+        retention: int = 60,
+        prune_every: int = 1000,
+    ):
+        super().__init__()
+        self._poll_interval = poll_interval
+        self._batch_size = batch_size
+        self._retention = retention
+        # この回数ポーリングするごとに古いイベントを消す
+        self._prune_every = prune_every
+        self._last_id: Optional[int] = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def publish(self, event: RoomEvent) -> None:
+        query = "INSERT INTO `room_event` (room_id, type, user_id) VALUES (:room_id, :type, :user_id)"
+        with begin() as conn:
+            conn.execute(
+                text(query),
+                {
+                    "room_id": event.room_id,
+                    "type": int(event.type),
+                    "user_id": event.user_id,
+                },
+            )
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        with begin() as conn:
+            query = "SELECT COALESCE(MAX(`id`), 0) FROM `room_event`"
+            self._last_id = conn.execute(text(query)).scalar()
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="room-event-poller", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def poll(self) -> int:
+        """新しいイベントを配り、配った件数を返す"""
+        query = "SELECT `id`, `room_id`, `type`, `user_id` FROM `room_event` WHERE `id`>:last_id ORDER BY `id` LIMIT :limit"
+        with begin() as conn:
+            rows = conn.execute(
+                text(query), {"last_id": self._last_id, "limit": self._batch_size}
+            ).fetchall()
+        for row in rows:
+            self._dispatch(RoomEvent(row.room_id, RoomEventType(row.type), row.user_id))
+            self._last_id = row.id
+        return len(rows)
+
+    def prune(self) -> None:
+        query = "DELETE FROM `room_event` WHERE `created_at` < NOW() - INTERVAL :retention SECOND"
+        with begin() as conn:
+            conn.execute(text(query), {"retention": self._retention})
+
+    def _run(self) -> None:
+        polls = 0
+        while not self._stopped.is_set():
+            try:
+                # 溜まっている間は待たずに読み続ける
+                if self.poll() < self._batch_size:
+                    self._stopped.wait(self._poll_interval)
+                polls += 1
+                if polls % self._prune_every == 0:
+                    self.prune()
+            except Exception:
+                logger.exception("event bus: poll failed")
+                self._stopped.wait(self._poll_interval)
+
+
+def create_event_bus() -> EventBus:
+    if config.EVENT_BUS == "mysql" and config.STORAGE == "memory":
+        # room_event テーブルを置く DB が無い
+        raise ValueError("EVENT_BUS=mysql cannot be combined with STORAGE=memory")
+    if config.EVENT_BUS == "mysql":
+        return MySQLEventBus(config.EVENT_POLL_INTERVAL)
+    return LocalEventBus()
+
+
+event_bus = create_event_bus()
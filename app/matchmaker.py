@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict, deque
+from typing import Optional
+
+from . import model
+from .db import run
+from .model import MAX_USER_COUNT, LiveDifficulty
+
+logger = logging.getLogger(__name__)
+
+MATCHMAKE_TICK: float = 0.2
+MATCHMAKE_MAX_WAIT: float = 3.0  # これ以上待った人がいれば満員でなくてもルームを作る
+MATCHMAKE_MIN_USER_COUNT: int = 2
+
+
+class Ticket:
+    def __init__(
+        self, user_id: int, select_difficulty: LiveDifficulty, future: asyncio.Future
+    ):
+        self.user_id = user_id
+        self.select_difficulty = select_difficulty
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.cancelled = False
+        self.matching = False  # ルーム作成中
+
+
+class Matchmaker:
+    """live_id・難易度ごとの待ち行列から一定間隔でまとめてルームを作る
+
+    待ち行列はプロセスごとに持つ。全てイベントループ上で動かす。
+    """
+
+    def __init__(
+        self,
+        tick: float = MATCHMAKE_TICK,
+        max_wait: float = MATCHMAKE_MAX_WAIT,
+        min_user_count: int = MATCHMAKE_MIN_USER_COUNT,
+    ):
+        self._tick = tick
+        self._max_wait = max_wait
+        self._min_user_count = min_user_count
+        self._queues: defaultdict[tuple[int, LiveDifficulty], deque[Ticket]] = (
+            defaultdict(deque)
+        )
+        self._tickets: dict[int, Ticket] = {}  # user_id -> 待っているチケット
+        self._task: Optional[asyncio.Task] = None
+        self._leaving: set[asyncio.Task] = set()  # 返せなかったルームから抜ける処理
+        self.rooms_created = 0
+
+    @property
+    def waiting(self) -> int:
+        """待ち行列にいる人数"""
+        return len(self._tickets)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def matchmake(
+        self,
+        user_id: int,
+        live_id: int,
+        select_difficulty: LiveDifficulty,
+        timeout: float,
+    ) -> Optional[int]:
+        """マッチしたルームの id を返す。timeout 秒以内にマッチしなければ None
+
+        切断などで id を返せずに抜けたときは待ち行列から外し、既に入れられたルームからは抜ける。
+        """
+        old = self._tickets.pop(user_id, None)
+        if old is not None and not old.matching:
+            old.cancelled = True
+        future = asyncio.get_running_loop().create_future()
+        ticket = Ticket(user_id, select_difficulty, future)
+        self._queues[(live_id, select_difficulty)].append(ticket)
+        self._tickets[user_id] = ticket
+        delivered = False
+        try:
+            try:
+                room_id = await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                if not ticket.matching:
+                    return None
+                # ルーム作成中なら入れられたルームを返す
+                room_id = await future
+            delivered = True
+            return room_id
+        finally:
+            if self._tickets.get(user_id) is ticket:
+                del self._tickets[user_id]
+            if not delivered:
+                ticket.cancelled = True
+                if ticket.matching:
+                    future.add_done_callback(
+                        lambda future: self._leave_undelivered(future, user_id)
+                    )
+
+    async def match_once(self) -> int:
+        """待ち行列からルームを作り、作ったルーム数を返す"""
+        now = time.monotonic()
+        groups = []
+        for key, queue in list(self._queues.items()):
+            live_id, _ = key
+            tickets = [ticket for ticket in queue if not ticket.cancelled]
+            queue.clear()
+            while len(tickets) >= MAX_USER_COUNT:
+                groups.append((live_id, tickets[:MAX_USER_COUNT]))
+                tickets = tickets[MAX_USER_COUNT:]
+            if (
+                len(tickets) >= self._min_user_count
+                and now - tickets[0].enqueued_at >= self._max_wait
+            ):
+                groups.append((live_id, tickets))
+                tickets = []
+            if tickets:
+                queue.extend(tickets)
+            else:
+                del self._queues[key]
+        for _, tickets in groups:
+            for ticket in tickets:
+                ticket.matching = True
+        await asyncio.gather(*(self._create_room(*group) for group in groups))
+        return len(groups)
+
+    async def _create_room(self, live_id: int, tickets: list[Ticket]) -> None:
+        members = [(ticket.user_id, ticket.select_difficulty) for ticket in tickets]
+        try:
+            room_id = await run(model.create_matched_room, live_id, members)
+        except Exception as e:
+            for ticket in tickets:
+                ticket.future.set_exception(e)
+            return
+        self.rooms_created += 1
+        for ticket in tickets:
+            ticket.future.set_result(room_id)
+
+    def _leave_undelivered(self, future: asyncio.Future, user_id: int) -> None:
+        if future.cancelled() or future.exception() is not None:
+            return
+        task = asyncio.ensure_future(run(model.leave_room, future.result(), user_id))
+        self._leaving.add(task)
+        task.add_done_callback(self._leaving.discard)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._tick)
+            try:
+                await self.match_once()
+            except Exception:
+                logger.exception("matchmaker: match failed")
+
+
+matchmaker = Matchmaker()
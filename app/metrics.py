@@ -0,0 +1,125 @@
+import bisect
+from typing import Callable, Iterable
+
+# Prometheus の既定と同じバケット (秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Counter:
+    """単調増加するカウンタ
+
+    ロックは取らない。GIL の下での += は稀に取りこぼしうるが、監視用途なので許容する。
+    """
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Gauge:
+    """増減する値"""
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Histogram:
+    """バケットごとの件数と合計。Counter と同じくロックは取らない"""
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最後は +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Family:
+    """ラベルの値ごとに同じ種類のメトリクスを持つ"""
+
+    def __init__(self, name: str, help: str, type: str, factory: Callable):
+        self.name = name
+        self.help = help
+        self.type = type
+        self._factory = factory
+        self._children: dict[Labels, object] = {}
+
+    def labels(self, **labels: str):
+        key = tuple(labels.items())
+        child = self._children.get(key)
+        if child is None:
+            # 同時に作られても setdefault でどちらか一方に揃う
+            child = self._children.setdefault(key, self._factory())
+        return child
+
+    def clear(self) -> None:
+        self._children.clear()
+
+    def collect(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        for labels, child in list(self._children.items()):
+            if isinstance(child, Histogram):
+                cumulative = 0
+                bounds = [str(b) for b in child.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, child.counts):
+                    cumulative += count
+                    bucket_labels = _format_labels(labels + (("le", bound),))
+                    yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+                yield f"{self.name}_sum{_format_labels(labels)} {child.sum}"
+                yield f"{self.name}_count{_format_labels(labels)} {cumulative}"
+            else:
+                yield f"{self.name}{_format_labels(labels)} {child.value}"
+
+
+class Registry:
+    def __init__(self):
+        self._families: list[Family] = []
+
+    def counter(self, name: str, help: str) -> Family:
+        return self._register(Family(name, help, "counter", Counter))
+
+    def gauge(self, name: str, help: str) -> Family:
+        return self._register(Family(name, help, "gauge", Gauge))
+
+    def histogram(
+        self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> Family:
+        return self._register(
+            Family(name, help, "histogram", lambda: Histogram(buckets))
+        )
+
+    def render(self) -> str:
+        """Prometheus のテキスト形式で出力する"""
+        lines = []
+        for family in self._families:
+            lines.extend(family.collect())
+        return "\n".join(lines) + "\n"
+
+    def _register(self, family: Family) -> Family:
+        self._families.append(family)
+        return family
+
+
+registry = Registry()
@@ -1,21 +1,47 @@
 import json
-import threading
-import time
+import logging
 import uuid
-from enum import Enum, IntEnum
+from collections import defaultdict
+from enum import Enum
 from sys import int_info
-from typing import Optional
+from typing import NamedTuple, Optional
 
 from fastapi import HTTPException
 from pydantic import BaseModel, NoneIsAllowedError
-from sqlalchemy import text
-from sqlalchemy.exc import NoResultFound
 
-from .db import engine
+from . import config, ranking, validation
+from .cache import LRUCache, SingleFlight
+from .events import RoomEvent, RoomEventType, event_bus
+from .scheduler import PeriodicTask, RoomTimer
+from .storage import (
+    MAX_USER_COUNT,
+    DuplicateToken,
+    JoinRoomResult,
+    LiveDifficulty,
+    ScoreSubmission,
+    WaitRoomStatus,
+    storage,
+)
+from .write_behind import WriteBehindQueue
+
+logger = logging.getLogger(__name__)
 
-MAX_USER_COUNT: int = 4
 TIMEOUT_FROM_START: int = 150  # 曲の最長は 135
 TIMEOUT_FROM_END: int = 10
+SWEEP_INTERVAL: int = 5
+ROOM_CACHE_SIZE: int = 10000
+ROOM_LIST_CACHE_SIZE: int = 10000
+ROOM_LIST_CACHE_TTL: float = 1.0
+RESULT_CACHE_SIZE: int = 10000
+USER_CACHE_SIZE: int = 100000
+USER_CACHE_TTL: int = 60
+INVALID_TOKEN_CACHE_TTL: int = 10
+USER_INSERT_CHUNK_SIZE: int = 1000  # 1つの INSERT 文で入れるユーザー数
+USER_INSERT_RETRIES: int = 3  # token が衝突したときに作り直す回数
+WAITING_ROOM_TTL: int = 600  # 開始されないまま待機中のルームを解散するまでの秒数
+LIVE_ROOM_TTL: int = 3600  # 結果が取得されないままライブ中のルームを解散するまでの秒数
+ARCHIVE_DELAY: int = 60  # 解散したルームをアーカイブに移すまでの秒数
+REAP_INTERVAL: int = 30
 
 
 class InvalidToken(Exception):
@@ -33,70 +59,104 @@ class SafeUser(BaseModel):
         orm_mode = True
 
 
+# token -> SafeUser のキャッシュ。存在しない token は _INVALID_TOKEN として覚えておく
+user_cache: LRUCache[SafeUser] = LRUCache(USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_INVALID_TOKEN = SafeUser(id=0, name="", leader_card_id=0)
+# id -> SafeUser のキャッシュ。ランキングの名前などに使う (ルーム状態を作るときは引き直す)
+profile_cache: LRUCache[SafeUser] = LRUCache(USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
 def create_user(name: str, leader_card_id: int) -> str:
     """Create new user and returns their token"""
-    token = str(uuid.uuid4())
-    # NOTE: tokenが衝突したらリトライする必要がある.
-    with engine.begin() as conn:
-        result = conn.execute(
-            text(
-                "INSERT INTO `user` (name, token, leader_card_id) VALUES (:name, :token, :leader_card_id)"
-            ),
-            {"name": name, "token": token, "leader_card_id": leader_card_id},
-        )
-        # print(result)
-    return token
+    return create_users([(name, leader_card_id)])[0]
 
 
-def _get_user_by_token(conn, token: str) -> Optional[SafeUser]:
-    # TODO: 実装
-    result = conn.execute(
-        text("SELECT `id`,`name`,`leader_card_id` FROM `user` WHERE `token`=:token"),
-        dict(token=token),
-    )
-    try:
-        row = result.one()
-    except NoResultFound:
-        return None
-    return SafeUser.from_orm(row)
+def create_users(users: list[tuple[str, int]]) -> list[str]:
+    """(name, leader_card_id) の一覧からユーザーをまとめて作り、同じ順に token を返す
 
+    USER_INSERT_CHUNK_SIZE 件ずつ複数行の INSERT 文で入れる。
+    token が衝突したらそのチャンクの token を作り直して入れ直す。
+    """
+    tokens = []
+    for start in range(0, len(users), USER_INSERT_CHUNK_SIZE):
+        tokens += _insert_users(users[start : start + USER_INSERT_CHUNK_SIZE])
+    for token in tokens:
+        user_cache.pop(token)
+    return tokens
 
-def get_user_by_token(token: str) -> Optional[SafeUser]:
-    with engine.begin() as conn:
-        return _get_user_by_token(conn, token)
 
+def _insert_users(users: list[tuple[str, int]]) -> list[str]:
+    for attempt in range(USER_INSERT_RETRIES + 1):
+        tokens = [str(uuid.uuid4()) for _ in users]
+        try:
+            storage.insert_users(users, tokens)
+            return tokens
+        except DuplicateToken:
+            if attempt == USER_INSERT_RETRIES:
+                raise
 
-def update_user(token: str, name: str, leader_card_id: int) -> None:
-    # このコードを実装してもらう
-    with engine.begin() as conn:
-        # TODO: 実装
-        result = conn.execute(
-            text(
-                "UPDATE `user` SET `name`=:name, `leader_card_id`=:leader_card_id WHERE `token`=:token"
-            ),
-            {"token": token, "name": name, "leader_card_id": leader_card_id},
-        )
 
+def _safe_user(row) -> Optional[SafeUser]:
+    return None if row is None else SafeUser.from_orm(row)
 
-# Room
 
+def get_cached_user(token: str) -> tuple[bool, Optional[SafeUser]]:
+    """DBを見ずにキャッシュだけを引く。(キャッシュにあったか, ユーザー) を返す"""
+    user = user_cache.get(token)
+    if user is None:
+        return False, None
+    return True, (None if user is _INVALID_TOKEN else user)
 
-class LiveDifficulty(IntEnum):
-    normal = 1
-    hard = 2
 
+def get_user_by_token(token: str) -> Optional[SafeUser]:
+    found, user = get_cached_user(token)
+    if found:
+        return user
+    user = _safe_user(storage.get_user_by_token(token))
+    _store_user(token, user)
+    return user
+
+
+def _store_user(token: str, user: Optional[SafeUser]) -> None:
+    if user is None:
+        user_cache.set(token, _INVALID_TOKEN, ttl=INVALID_TOKEN_CACHE_TTL)
+    else:
+        user_cache.set(token, user)
+        profile_cache.set(user.id, user)
+
+
+def get_users(user_ids: list[int], cached: bool = True) -> dict[int, SafeUser]:
+    """id -> SafeUser。キャッシュに無いものだけを1クエリで引く。存在しない id は含まない
+
+    cached=False ならキャッシュを見ずに全員を引き直す (引いた値でキャッシュは更新する)。
+    """
+    users = {}
+    missing = []
+    for user_id in user_ids:
+        user = profile_cache.get(user_id) if cached else None
+        if user is None:
+            missing.append(user_id)
+        else:
+            users[user_id] = user
+    if missing:
+        for row in storage.get_users(missing):
+            user = users[row.id] = SafeUser.from_orm(row)
+            profile_cache.set(user.id, user)
+    return users
 
-class JoinRoomResult(IntEnum):
-    Ok = 1  # 入場OK
-    RoomFull = 2  # 満員
-    Disbanded = 3  # 解散済み
-    OtherError = 4  # その他エラー
+
+def update_user(token: str, name: str, leader_card_id: int) -> None:
+    # このコードを実装してもらう
+    user = storage.update_user(token, name, leader_card_id)
+    user_cache.pop(token)
+    if user is None:
+        return
+    profile_cache.pop(user.id)
+    # 参加中のルームのキャッシュに古い名前が残らないようにする
+    storage.bump_rooms_of_user(user.id)
 
 
-class WaitRoomStatus(IntEnum):
-    Waiting = 1  # ホストがライブ開始ボタン押すのを待っている
-    LiveStart = 2  # ライブ画面遷移OK
-    Dissolution = 3  # 解散された
+# Room
 
 
 class RoomInfo(BaseModel):
@@ -121,248 +181,532 @@ class ResultUser(BaseModel):
     score: int  # 獲得スコア
 
 
+class RankingUser(BaseModel):
+    rank: int  # 順位。同点は同じ順位
+    user_id: int  # ユーザー識別子
+    name: str  # ユーザー名
+    leader_card_id: int  # 設定アバター
+    score: int  # 自己ベスト
+
+
+class RoomMember(NamedTuple):
+    user_id: int
+    name: str
+    leader_card_id: int
+    select_difficulty: LiveDifficulty
+
+
+class RoomState(NamedTuple):
+    """プロセス内にキャッシュするルームの状態
+
+    room.version が一致する間は storage の内容と同じとみなす。
+    """
+
+    version: int
+    status: WaitRoomStatus
+    live_id: int
+    host_id: int
+    members: tuple[RoomMember, ...]
+
+
+room_cache: LRUCache[RoomState] = LRUCache(ROOM_CACHE_SIZE)
+# 解散済みルームの結果
+result_cache: LRUCache[list[ResultUser]] = LRUCache(RESULT_CACHE_SIZE)
+# (live_id, limit, cursor) -> 入場可能なルーム一覧
+room_list_cache: LRUCache[list[RoomInfo]] = LRUCache(
+    ROOM_LIST_CACHE_SIZE, ttl=ROOM_LIST_CACHE_TTL
+)
+
+# 同じルーム・同じ一覧を同時に読みに来たリクエストは1回の読み出しを共有する。
+# 共有するのはルーム単位の結果だけで、is_me などのリクエストごとの値は後から付ける
+room_state_flight: SingleFlight[Optional[RoomState]] = SingleFlight()
+room_status_flight: SingleFlight[Optional[WaitRoomStatus]] = SingleFlight()
+room_users_flight: SingleFlight[Optional[RoomState]] = SingleFlight()
+result_flight: SingleFlight[list[ResultUser]] = SingleFlight()
+room_list_flight: SingleFlight[list[RoomInfo]] = SingleFlight()
+
+
+def _forget_room_flights(event: RoomEvent) -> None:
+    # 変更より前に始まった読み出しに、変更を知って読みに来たリクエストを相乗りさせない
+    for flight in (
+        room_state_flight,
+        room_status_flight,
+        room_users_flight,
+        result_flight,
+    ):
+        flight.forget(event.room_id)
+
+
+# notify より先に登録し、イベントで起きたロングポーリングが古い読み出しを受け取らないようにする。
+# 他のワーカーの変更はこの購読で忘れる
+event_bus.subscribe(_forget_room_flights)
+
+
+def _publish(event: RoomEvent) -> None:
+    """コミットした変更を配る
+
+    EVENT_BUS=mysql だと自分のイベントもポーリングで受け取るまで届かないので、
+    このプロセスの読み出しは届くのを待たずにここで忘れる。
+    """
+    _forget_room_flights(event)
+    event_bus.publish(event)
+
+
 def create_room(live_id: int, host_id: int) -> int:
-    with engine.begin() as conn:
-        query = "INSERT INTO `room` (live_id, host_id, status) VALUES (:live_id, :host_id, :status)"
-        result = conn.execute(
-            text(query),
-            {
-                "live_id": live_id,
-                "host_id": host_id,
-                "status": int(WaitRoomStatus.Waiting),
-            },
+    return storage.create_room(live_id, host_id)
+
+
+def list_room(
+    live_id: int, limit: Optional[int] = None, cursor: Optional[int] = None
+) -> list[RoomInfo]:
+    """入場可能なルームを room_id 順に返す
+
+    cursor を指定すると room_id が cursor より大きいルームだけを返す。
+    結果は ROOM_LIST_CACHE_TTL 秒キャッシュし、キャッシュが切れた直後に同時に来た
+    同じ条件の呼び出しは1回の読み出しを共有する。
+    """
+    key = (live_id, limit, cursor)
+    room_info_list = room_list_cache.get(key)
+    if room_info_list is not None:
+        return room_info_list
+    return room_list_flight.do(key, _list_rooms, live_id, limit, cursor)
+
+
+def _list_rooms(
+    live_id: int, limit: Optional[int], cursor: Optional[int]
+) -> list[RoomInfo]:
+    rows = storage.list_rooms(live_id, limit, cursor)
+    room_info_list = [
+        RoomInfo(
+            room_id=row.id,
+            live_id=row.live_id,
+            joined_user_count=row.joined_user_count,
+            max_user_count=MAX_USER_COUNT,
         )
-    return result.lastrowid
-
-
-def list_room(live_id: int) -> list[RoomInfo]:
-    with engine.begin() as conn:
-        args = {"status": int(WaitRoomStatus.Waiting)}
-        query = "SELECT `room_id`,`live_id`,count(`room_id`) AS `joined_user_count` FROM room,room_member WHERE `id`=`room_id` AND `status`=:status "
-        if live_id != 0:
-            query += "AND `live_id`=:live_id "
-            args["live_id"] = live_id
-        query += "GROUP BY `room_id`"
-        result = conn.execute(text(query), args)
-
-        return [
-            RoomInfo(
-                room_id=row.room_id,
-                live_id=row.live_id,
-                joined_user_count=row.joined_user_count,
-                max_user_count=MAX_USER_COUNT,
-            )
-            for row in result.fetchall()
-        ]
+        for row in rows
+    ]
+    room_list_cache.set((live_id, limit, cursor), room_info_list)
+    return room_info_list
 
 
 def join_room(
     room_id: int, user_id: int, select_difficulty: LiveDifficulty
 ) -> JoinRoomResult:
-    with engine.begin() as conn:
-        try:
-            query = "SELECT * FROM `room` WHERE `id`=:room_id FOR UPDATE"
-            result = conn.execute(text(query), {"room_id": room_id})
-            if result is None:
-                return JoinRoomResult.Disbanded
-            status = _get_room_status(conn, room_id)
-            if status != WaitRoomStatus.Waiting:
-                return JoinRoomResult.OtherError
-            members = _get_number_of_room_members(conn, room_id)
-            if members >= MAX_USER_COUNT:
-                return JoinRoomResult.RoomFull
-            _insert_into_room_member(conn, room_id, user_id, select_difficulty)
-            return JoinRoomResult.Ok
-        except Exception as e:
-            return JoinRoomResult.OtherError
+    try:
+        result, rows = storage.join_room(room_id, user_id, select_difficulty)
+    except Exception as e:
+        return JoinRoomResult.OtherError
+    if result != JoinRoomResult.Ok:
+        return result
+    # 入室はコミット済みなので、キャッシュを作り損ねても失敗を返さない。
+    # キャッシュは古い version のまま残るので、次の読み出しで作り直される
+    try:
+        _store_room_state(room_id, _room_state_from_rows(rows))
+    except Exception:
+        logger.exception("join_room: failed to cache room %d", room_id)
+    _publish(RoomEvent(room_id, RoomEventType.Joined, user_id))
+    return JoinRoomResult.Ok
+
+
+def create_matched_room(live_id: int, members: list[tuple[int, LiveDifficulty]]) -> int:
+    """マッチングで集まったメンバーのルームを一度に作る。先頭のメンバーがホストになる"""
+    room_id, rows = storage.create_matched_room(live_id, members)
+    _store_room_state(room_id, _room_state_from_rows(rows))
+    for user_id, _ in members:
+        _publish(RoomEvent(room_id, RoomEventType.Joined, user_id))
+    return room_id
 
 
 def get_room_status(room_id: int) -> Optional[WaitRoomStatus]:
-    with engine.begin() as conn:
-        return _get_room_status(conn, room_id)
+    return room_status_flight.do(room_id, storage.get_room_status, room_id)
 
 
 def get_room_users(room_id: int, req_user_id: int) -> list[RoomUser]:
-    with engine.begin() as conn:
-        return _get_room_users(conn, room_id, req_user_id)
+    state = room_users_flight.do(room_id, _load_room_state, room_id)
+    return [] if state is None else room_users(state, req_user_id)
+
+
+def _load_room_state(room_id: int) -> Optional[RoomState]:
+    return _room_state_from_rows(storage.get_room_rows(room_id))
+
+
+def get_room_state(
+    room_id: int, token: str
+) -> Optional[tuple[Optional[RoomState], int]]:
+    """認証とルーム状態の取得を行い (ルーム状態, リクエストしたユーザーのid) を返す
+
+    キャッシュがあれば room.version だけを確認し、無ければルームの状態を読み直す。
+    token が不正なら None を、ルームが存在しなければルーム状態に None を返す。
+    同じルームへの同時の呼び出しはルーム状態の読み出しを共有する。
+    """
+    found, me = get_cached_user(token)
+    if not found and storage.users_colocated(room_id):
+        # ユーザーと同じシャードのルームなら、認証とルームの読み出しを1つのコネクションで行う
+        return _fetch_user_and_room_state(room_id, token)
+    if not found:
+        me = get_user_by_token(token)
+    if me is None:
+        return None
+    return room_state_flight.do(room_id, _fetch_room_state, room_id), me.id
+
+
+def _fetch_room_state(room_id: int) -> Optional[RoomState]:
+    cached = room_cache.peek(room_id)
+    rows = storage.get_room_rows(room_id, _version_of(cached))
+    return _current_room_state(room_id, cached, rows)
+
+
+def _fetch_user_and_room_state(
+    room_id: int, token: str
+) -> Optional[tuple[Optional[RoomState], int]]:
+    # token ごとに結果が違うので、ルーム状態の読み出しを他のリクエストと共有しない
+    cached = room_cache.peek(room_id)
+    row, rows = storage.get_user_and_room_rows(token, room_id, _version_of(cached))
+    me = _safe_user(row)
+    _store_user(token, me)
+    if me is None:
+        return None
+    return _current_room_state(room_id, cached, rows), me.id
+
+
+def _version_of(state: Optional[RoomState]) -> Optional[int]:
+    return None if state is None else state.version
+
+
+def _current_room_state(
+    room_id: int, cached: Optional[RoomState], rows
+) -> Optional[RoomState]:
+    """キャッシュが最新なら (rows が None なら) キャッシュを、古いか無ければ読み直した rows から作って返す"""
+    room_cache.stats.record(rows is None)
+    if rows is None:
+        return cached
+    state = _room_state_from_rows(rows)
+    _store_room_state(room_id, state)
+    return state
+
+
+def wait_room(
+    room_id: int, token: str, as_dict: bool = False
+) -> Optional[tuple[WaitRoomStatus, list]]:
+    """/room/wait 用にルーム状態と参加者一覧を返す。token が不正なら None を返す
+
+    as_dict なら参加者を RoomUser ではなく room_user_dicts() の dict で返す。
+    全員が退出して消えたルームは解散したものとして返す。
+    """
+    result = get_room_state(room_id, token)
+    if result is None:
+        return None
+    state, me_id = result
+    if state is None:
+        return WaitRoomStatus.Dissolution, []
+    if as_dict:
+        return state.status, room_user_dicts(state, me_id)
+    return state.status, room_users(state, me_id)
 
 
 def start_room(room_id: int) -> None:
-    with engine.begin() as conn:
-        _update_room_status(conn, room_id)
-    thread = threading.Thread(
-        target=_timeout_threading, args=(conn, room_id, TIMEOUT_FROM_START)
-    )
-    thread.start()
+    rows = storage.start_room(room_id, TIMEOUT_FROM_START)
+    _store_room_state(room_id, _room_state_from_rows(rows))
+    _publish(RoomEvent(room_id, RoomEventType.Started))
+    room_timer.schedule(room_id, TIMEOUT_FROM_START)
 
 
 def end_room(
     room_id: int, user_id: int, judge_count_list: list[int], score: int
 ) -> None:
-    with engine.begin() as conn:
-        _update_room_member_scores(conn, room_id, user_id, judge_count_list, score)
-        if _get_room_status(conn, room_id) == WaitRoomStatus.LiveStart:
-            thread = threading.Thread(
-                target=_timeout_threading, args=(conn, room_id, TIMEOUT_FROM_END)
-            )
-            thread.start()
+    """判定数とスコアがありえない値なら validation.InvalidScore を投げる"""
+    validation.check_score(_get_live_id(room_id), judge_count_list, score)
+    submission = ScoreSubmission(room_id, user_id, judge_count_list, score)
+    if config.SCORE_WRITE_BEHIND:
+        score_writer.submit(submission)
+    else:
+        _end_rooms([submission])
+
+
+def _get_live_id(room_id: int) -> Optional[int]:
+    # live_id は変わらないので、キャッシュにあれば version を確かめずに使う
+    state = room_cache.peek(room_id)
+    if state is not None:
+        return state.live_id
+    return storage.get_live_id(room_id)
+
+
+def _end_rooms(submissions: list[ScoreSubmission]) -> None:
+    started_room_ids = storage.end_rooms(submissions, TIMEOUT_FROM_END)
+    for s in submissions:
+        _publish(RoomEvent(s.room_id, RoomEventType.ScoreSubmitted, s.user_id))
+    for room_id in started_room_ids:
+        room_timer.schedule(room_id, TIMEOUT_FROM_END)
 
 
 def result_room(room_id: int) -> list[ResultUser]:
-    with engine.begin() as conn:
-        return _get_results_from_room_id(conn, room_id)
+    # 解散後の結果は変わらないので、一度揃ったらDBを見ない
+    result_user_list = result_cache.get(room_id)
+    if result_user_list is not None:
+        return result_user_list
+    return result_flight.do(room_id, _collect_results, room_id)
+
+
+def _collect_results(room_id: int) -> list[ResultUser]:
+    # タイマーを持っていたワーカーが落ちていても期限切れならここで確定させる
+    results = storage.collect_results(room_id)
+    if not results.rows:
+        return []
+    result_user_list = [
+        ResultUser(
+            user_id=row.user_id,
+            judge_count_list=[
+                row.judge_perfect,
+                row.judge_great,
+                row.judge_good,
+                row.judge_bad,
+                row.judge_miss,
+            ],
+            score=row.score,
+        )
+        for row in results.rows
+    ]
+    result_cache.set(room_id, result_user_list)
+    room_timer.cancel(room_id)
+    room_cache.pop(room_id)
+    if results.dissolved:
+        # 結果が確定したルームだけを一度だけランキングに数える。
+        # 解散と一緒に書けなかった (ランキングと別のシャードの) 結果はここで書く
+        plays = [ranking.Play(*play) for play in results.plays]
+        if results.saved:
+            ranking.leaderboards.apply(plays)
+        else:
+            ranking.record_plays(plays)
+        _publish(RoomEvent(room_id, RoomEventType.Dissolved))
+    return result_user_list
 
 
 def leave_room(room_id: int, user_id: int) -> None:
-    with engine.begin() as conn:
-        _delete_room_member(conn, room_id, user_id)
-        if _get_number_of_room_members(conn, room_id) == 0:
-            _delete_room(conn, room_id)
-        elif _get_host_id(conn, room_id) == user_id:
-            _change_host(conn, room_id)
+    left = storage.leave_room(room_id, user_id)
+    if left is None:
+        return
+    deleted, rows = left
+    _store_room_state(room_id, _room_state_from_rows(rows))
+    _publish(RoomEvent(room_id, RoomEventType.Left, user_id))
+    if deleted:
+        room_timer.cancel(room_id)
+
+
+def get_ranking(
+    live_id: int, difficulty: LiveDifficulty, limit: int
+) -> tuple[list[RankingUser], ranking.ScoreStats]:
+    """自己ベストの上位 limit 件と、その曲・難易度の集計"""
+    entries, stats = ranking.get_ranking(live_id, int(difficulty), limit)
+    users = get_users([entry.user_id for entry in entries])
+    ranking_users = []
+    rank = 0
+    for i, entry in enumerate(entries):
+        if i == 0 or entry.score != entries[i - 1].score:
+            rank = i + 1
+        user = users.get(entry.user_id)
+        if user is None:
+            continue
+        ranking_users.append(
+            RankingUser(
+                rank=rank,
+                user_id=user.id,
+                name=user.name,
+                leader_card_id=user.leader_card_id,
+                score=entry.score,
+            )
+        )
+    return ranking_users, stats
 
 
-def _insert_into_room_member(
-    conn, room_id: int, user_id: int, select_difficulty: LiveDifficulty
-) -> None:
-    query = "INSERT INTO `room_member` (room_id, user_id, select_difficulty) VALUES (:room_id, :user_id, :select_difficulty)"
-    conn.execute(
-        text(query),
-        {
-            "room_id": room_id,
-            "user_id": user_id,
-            "select_difficulty": int(select_difficulty),
-        },
-    )
-
+def _room_state_from_rows(
+    rows, profiles: Optional[dict[int, SafeUser]] = None
+) -> Optional[RoomState]:
+    """シャードのトランザクションを閉じてから呼ぶ (ユーザーはシャード 0 から引く)
 
-def _get_room_status(conn, room_id: int) -> Optional[WaitRoomStatus]:
-    query = "SELECT `status` FROM `room` WHERE `id`=:room_id"
-    result = conn.execute(text(query), {"room_id": room_id})
-    try:
-        return result.scalar()
-    except NoResultFound:
+    プロフィールを JOIN した行 (シャード 0 のルーム) なら引き直さないので、トランザクションの中でもよい。
+    作ったルーム状態は room.version と組でキャッシュするので、プロフィールは profile_cache を
+    見ずに引き直す。他のワーカーで名前が変わると room.version は上がるが、このワーカーの
+    profile_cache は TTL まで古いままなので、それを使うと古い名前が次の version まで残る。
+    """
+    if not rows or rows[0].version is None:
         return None
+    if profiles is None and "name" in rows[0]._fields:
+        profiles = _profiles_from_rows(rows)
+    elif profiles is None:
+        user_ids = [row.user_id for row in rows if row.user_id is not None]
+        profiles = get_users(user_ids, cached=False)
+    return RoomState(
+        version=rows[0].version,
+        status=WaitRoomStatus(rows[0].status),
+        live_id=rows[0].live_id,
+        host_id=rows[0].host_id,
+        members=tuple(
+            RoomMember(
+                user_id=row.user_id,
+                name=profiles[row.user_id].name,
+                leader_card_id=profiles[row.user_id].leader_card_id,
+                select_difficulty=LiveDifficulty(row.select_difficulty),
+            )
+            for row in rows
+            if row.user_id in profiles
+        ),
+    )
 
 
-def _get_number_of_room_members(conn, room_id: int) -> int:
-    query = (
-        "SELECT COUNT(`room_id`) FROM `room_member` WHERE `room_id`=:room_id FOR UPDATE"
+def _profiles_from_rows(rows) -> dict[int, SafeUser]:
+    profiles = {}
+    for row in rows:
+        if row.user_id is None or row.name is None:
+            continue
+        user = profiles[row.user_id] = SafeUser(
+            id=row.user_id, name=row.name, leader_card_id=row.leader_card_id
+        )
+        profile_cache.set(user.id, user)
+    return profiles
+
+
+def _store_room_state(room_id: int, state: Optional[RoomState]) -> None:
+    if state is None or state.status == WaitRoomStatus.Dissolution:
+        room_cache.pop(room_id)
+        return
+    # 他のリクエストがより新しい状態を入れていれば上書きしない
+    # (ここで競合しても次の読み出しで version の不一致として検出される)
+    current = room_cache.peek(room_id)
+    if current is None or current.version < state.version:
+        room_cache.set(room_id, state)
+
+
+def warm_room_cache(limit: int = ROOM_CACHE_SIZE) -> int:
+    """未解散のルームを新しい順に各シャード limit 件まで room_cache に読み込み、読み込んだ数を返す"""
+    rows_by_room = defaultdict(list)
+    for row in storage.load_live_room_rows(limit):
+        rows_by_room[row.id].append(row)
+    # 参加者のプロフィールをまとめて引いておき、ルームごとには引かない
+    profiles = get_users(
+        [
+            row.user_id
+            for rows in rows_by_room.values()
+            for row in rows
+            if row.user_id is not None
+        ],
+        cached=False,
     )
-    result = conn.execute(text(query), {"room_id": room_id})
-    return result.scalar()
+    for room_id, rows in rows_by_room.items():
+        _store_room_state(room_id, _room_state_from_rows(rows, profiles))
+    return len(rows_by_room)
 
 
-def _get_room_users(conn, room_id: int, req_user_id: int = None) -> list[RoomUser]:
-    query = "SELECT `user_id`,`name`,  `leader_card_id`,`select_difficulty` FROM `user`,`room_member` WHERE `id`=`user_id` AND `room_id`=:room_id"
-    result = conn.execute(text(query), {"room_id": room_id})
+def count_rooms() -> list[tuple[WaitRoomStatus, int, int]]:
+    """(状態, 参加人数, ルーム数) の一覧"""
+    return [
+        (WaitRoomStatus(status), joined, count)
+        for status, joined, count in storage.count_rooms()
+    ]
 
-    host_id = _get_host_id(conn, room_id)
 
+def room_users(state: RoomState, req_user_id: Optional[int]) -> list[RoomUser]:
+    """キャッシュしたルーム状態から RoomUser の一覧を作る"""
     return [
         RoomUser(
-            user_id=row.user_id,
-            name=row.name,
-            leader_card_id=row.leader_card_id,
-            select_difficulty=row.select_difficulty,
-            is_me=(req_user_id == row.user_id),
-            is_host=(host_id == row.user_id),
+            user_id=member.user_id,
+            name=member.name,
+            leader_card_id=member.leader_card_id,
+            select_difficulty=member.select_difficulty,
+            is_me=(req_user_id == member.user_id),
+            is_host=(state.host_id == member.user_id),
         )
-        for row in result.fetchall()
+        for member in state.members
     ]
 
 
-def _update_room_status(conn, room_id: int) -> None:
-    query = "UPDATE `room` SET `status`=:status WHERE `id`=:room_id"
-    conn.execute(
-        text(query), {"status": int(WaitRoomStatus.LiveStart), "room_id": room_id}
-    )
+def room_user_dicts(state: RoomState, req_user_id: Optional[int]) -> list[dict]:
+    """room_users() と同じ内容を、RoomUser を作らずにそのまま JSON にできる dict で返す"""
+    return [
+        {
+            "user_id": member.user_id,
+            "name": member.name,
+            "leader_card_id": member.leader_card_id,
+            "select_difficulty": member.select_difficulty,
+            "is_me": req_user_id == member.user_id,
+            "is_host": state.host_id == member.user_id,
+        }
+        for member in state.members
+    ]
 
 
-def _update_room_member_scores(
-    conn, room_id: int, user_id: int, judge_count_list: list[int], score: int
-) -> None:
-    query = "UPDATE `room_member` SET `judge_perfect`=:judge_perfect, `judge_great`=:judge_great, `judge_good`=:judge_good, `judge_bad`=:judge_bad, `judge_miss`=:judge_miss, `score`=:score WHERE `room_id`=:room_id AND `user_id`=:user_id"
-    conn.execute(
-        text(query),
-        {
-            "room_id": room_id,
-            "user_id": user_id,
-            "judge_perfect": judge_count_list[0],
-            "judge_great": judge_count_list[1],
-            "judge_good": judge_count_list[2],
-            "judge_bad": judge_count_list[3],
-            "judge_miss": judge_count_list[4],
-            "score": score,
-        },
-    )
+def _on_room_timeout(room_ids: list[int]) -> None:
+    storage.expire_rooms(room_ids)
+    for room_id in room_ids:
+        _publish(RoomEvent(room_id, RoomEventType.TimedOut))
 
 
-def _timeout_threading(conn, room_id: int, timeout: int):
-    time.sleep(timeout)
-    with engine.begin() as conn:
-        _update_null_to_zero(conn, room_id)
+room_timer = RoomTimer(_on_room_timeout)
 
 
-def _update_null_to_zero(conn, room_id: int):
-    query = "UPDATE `room_member` SET `judge_perfect`=:judge_perfect, `judge_great`=:judge_great, `judge_good`=:judge_good, `judge_bad`=:judge_bad, `judge_miss`=:judge_miss, `score`=:score WHERE `room_id`=:room_id AND `score` IS NULL"
-    conn.execute(
-        text(query),
-        {
-            "room_id": room_id,
-            "judge_perfect": 0,
-            "judge_great": 0,
-            "judge_good": 0,
-            "judge_bad": 0,
-            "judge_miss": 0,
-            "score": 0,
-        },
-    )
+def sweep_expired_rooms() -> int:
+    """期限切れのルームをまとめて確定させ、処理したルーム数を返す"""
+    room_ids = storage.sweep_expired_rooms()
+    for room_id in room_ids:
+        room_timer.cancel(room_id)
+        _publish(RoomEvent(room_id, RoomEventType.TimedOut))
+    return len(room_ids)
 
 
-def _get_results_from_room_id(conn, room_id: int) -> list[ResultUser]:
-    result_user_list = []
-    for room_user in _get_room_users(conn, room_id):
-        query = "SELECT `user_id`, `judge_perfect`, `judge_great`, `judge_good`, `judge_bad`, `judge_miss`, `score` FROM `room_member` WHERE `room_id`=:room_id AND `user_id`=:user_id"
-        result = conn.execute(
-            text(query), {"room_id": room_id, "user_id": room_user.user_id}
-        )
+room_sweeper = PeriodicTask(sweep_expired_rooms, SWEEP_INTERVAL)
 
-        row = result.one()
+# SCORE_WRITE_BEHIND が有効なときに /room/end のスコアをまとめて書き込む
+score_writer: WriteBehindQueue[ScoreSubmission] = WriteBehindQueue(
+    _end_rooms,
+    config.SCORE_WRITE_BEHIND_INTERVAL,
+    config.SCORE_WRITE_BEHIND_BATCH_SIZE,
+    config.SCORE_WRITE_BEHIND_MAX_PENDING,
+)
 
-        if row.score is None:
-            return []
 
-        result_user_list.append(
-            ResultUser(user_id=row.user_id, judge_count_list=row[1:-1], score=row.score)
-        )
-    query = "UPDATE `room` SET `status`=:status WHERE `id`=:room_id"
-    conn.execute(
-        text(query), {"room_id": room_id, "status": int(WaitRoomStatus.Dissolution)}
-    )
+class ReapResult(NamedTuple):
+    expired: int  # 放置されていたので解散したルーム数
+    archived_rooms: int  # アーカイブに移したルーム数
+    archived_members: int  # アーカイブに移した room_member の行数
+    oldest_live_room_age: Optional[float]  # 未解散で最も古いルームの経過秒数
 
-    return result_user_list
 
+class ReaperStats:
+    """reap_rooms() の累計"""
+
+    def __init__(self):
+        self.runs = 0
+        self.expired = 0
+        self.archived_rooms = 0
+        self.archived_members = 0
+        self.last: Optional[ReapResult] = None
 
-def _delete_room_member(conn, room_id: int, user_id: int) -> None:
-    query = "DELETE FROM `room_member` WHERE `room_id`=:room_id AND `user_id`=:user_id"
-    conn.execute(text(query), {"room_id": room_id, "user_id": user_id})
+    def record(self, result: ReapResult) -> None:
+        self.runs += 1
+        self.expired += result.expired
+        self.archived_rooms += result.archived_rooms
+        self.archived_members += result.archived_members
+        self.last = result
 
 
-def _delete_room(conn, room_id: int) -> None:
-    query = "DELETE FROM `room` WHERE `id`=:room_id"
-    conn.execute(text(query), {"room_id": room_id})
+reaper_stats = ReaperStats()
 
 
-def _get_host_id(conn, room_id: int) -> int:
-    query = "SELECT `host_id` FROM `room` WHERE `id`=:room_id"
-    result = conn.execute(text(query), {"room_id": room_id})
-    return result.scalar()
+def reap_rooms() -> ReapResult:
+    """放置されたルームを解散させ、解散済みのルームを結果ごとアーカイブに移す"""
+    expired_room_ids, archived_rooms, archived_members, age = storage.reap_rooms(
+        [
+            (WaitRoomStatus.Waiting, WAITING_ROOM_TTL),
+            (WaitRoomStatus.LiveStart, LIVE_ROOM_TTL),
+        ],
+        ARCHIVE_DELAY,
+    )
+    for room_id in expired_room_ids:
+        room_timer.cancel(room_id)
+        room_cache.pop(room_id)
+        _publish(RoomEvent(room_id, RoomEventType.Dissolved))
+    result = ReapResult(len(expired_room_ids), archived_rooms, archived_members, age)
+    reaper_stats.record(result)
+    return result
 
 
-def _change_host(conn, room_id: int) -> None:
-    query = "SELECT `user_id` FROM `room_member` WHERE `room_id`=:room_id"
-    result = conn.execute(text(query), {"room_id": room_id})
-    row = result.first()
-    query = "UPDATE `room` SET `host_id`=:new_host WHERE `id`=:room_id"
-    conn.execute(text(query), {"new_host": row.user_id, "room_id": room_id})
+room_reaper = PeriodicTask(reap_rooms, REAP_INTERVAL)
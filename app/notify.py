@@ -0,0 +1,83 @@
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from .events import RoomEvent, event_bus
+
+
+class RoomListener:
+    """1つのルームの変更通知を待つ"""
+
+    def __init__(self, hub: "RoomHub", room_id: int):
+        self._hub = hub
+        self._room_id = room_id
+        self._event = hub._arm(room_id)
+
+    async def wait(self, timeout: float) -> bool:
+        """通知が来れば True、timeout 秒経っても来なければ False を返す"""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+            notified = True
+        except asyncio.TimeoutError:
+            notified = False
+        # 次の通知を受け取れるようにしてから呼び出し元に状態を読み直させる
+        self._event = self._hub._arm(self._room_id)
+        return notified
+
+
+class RoomHub:
+    """ルームの状態が変わったことを、それを待っているリクエストに知らせる
+
+    publish() はどのスレッドからでも呼べる。待ち受けはイベントループ上で行う。
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._events: dict[int, asyncio.Event] = {}
+        self._listeners: defaultdict[int, int] = defaultdict(int)
+
+    @property
+    def listening_rooms(self) -> int:
+        """待ち受け中のリクエストがあるルーム数"""
+        return len(self._listeners)
+
+    @asynccontextmanager
+    async def listen(self, room_id: int) -> AsyncIterator[RoomListener]:
+        self._loop = asyncio.get_running_loop()
+        self._listeners[room_id] += 1
+        try:
+            yield RoomListener(self, room_id)
+        finally:
+            self._listeners[room_id] -= 1
+            if self._listeners[room_id] == 0:
+                del self._listeners[room_id]
+                self._events.pop(room_id, None)
+
+    def publish(self, room_id: int) -> None:
+        """room_id を待っているリクエストを起こす"""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        loop.call_soon_threadsafe(self._notify, room_id)
+
+    def _arm(self, room_id: int) -> asyncio.Event:
+        event = self._events.get(room_id)
+        if event is None:
+            event = self._events[room_id] = asyncio.Event()
+        return event
+
+    def _notify(self, room_id: int) -> None:
+        event = self._events.pop(room_id, None)
+        if event is not None:
+            event.set()
+
+
+room_hub = RoomHub()
+
+
+def _on_room_event(event: RoomEvent) -> None:
+    room_hub.publish(event.room_id)
+
+
+event_bus.subscribe(_on_room_event)
@@ -0,0 +1,246 @@
+"""live_id・難易度ごとのランキングと自己ベスト
+
+result_room でルームの結果が確定したときに personal_best (自己ベスト) と
+live_score_stats (曲ごとの集計) を更新する。読み書きは storage を通し、SQL ではどちらもシャード 0 に置く。
+storage が解散と一緒に足し込めたもの (シャード 0 のルーム) はそのまま leaderboards に反映し、
+他のシャードのルームは解散をコミットした後に record_plays() する。
+後者で書き込めなかった結果は play_retries に溜めて書き直す。
+
+/ranking/{live_id} は各プロセスが持つ上位 RANKING_SIZE 件 (TopK) から返す。
+TopK は初めて引かれたときに personal_best の上位から読み込み、以後は自分のプロセスで
+確定した結果で更新する。他のワーカーで確定した結果は RANKING_REFRESH 秒ごとの読み直しで拾う。
+
+アーカイブから作り直すには
+
+    python -m app.ranking --batch-size 1000
+"""
+
+import argparse
+import bisect
+import logging
+import threading
+from collections import defaultdict
+from typing import Iterable, NamedTuple, Optional
+
+from .cache import LRUCache
+from .storage import storage
+from .write_behind import WriteBehindQueue
+
+logger = logging.getLogger(__name__)
+
+RANKING_SIZE: int = 100  # 1曲・1難易度あたりメモリに持つ上位の件数
+RANKING_REFRESH: float = 5.0  # 他のワーカーの記録を拾うために読み直す間隔 (秒)
+RANKING_CACHE_SIZE: int = 10000  # メモリに持つ live_id・難易度の組の数
+REBUILD_BATCH_SIZE: int = 1000
+RETRY_INTERVAL: float = 1.0  # 書き込めなかった結果を書き直す間隔 (秒)
+RETRY_MAX_PENDING: int = 10000  # 書き直しを待つルーム数の上限
+
+
+class Play(NamedTuple):
+    """確定した1人分の結果"""
+
+    live_id: int
+    difficulty: int
+    user_id: int
+    score: int
+
+
+class RankedScore(NamedTuple):
+    user_id: int
+    score: int
+
+
+class ScoreStats(NamedTuple):
+    play_count: int = 0
+    score_sum: int = 0
+    max_score: int = 0
+
+    def merge(self, other: "ScoreStats") -> "ScoreStats":
+        return ScoreStats(
+            self.play_count + other.play_count,
+            self.score_sum + other.score_sum,
+            max(self.max_score, other.max_score),
+        )
+
+
+class PersonalBest(NamedTuple):
+    live_id: int
+    difficulty: int
+    score: int
+    play_count: int
+
+
+class TopK:
+    """自己ベストの上位 k 件。1人1件で、スコアの降順・同点は user_id の昇順"""
+
+    def __init__(self, k: int, entries: Iterable[RankedScore] = ()):
+        self.k = k
+        self._keys: list[tuple[int, int]] = []  # (-score, user_id) の昇順
+        self._scores: dict[int, int] = {}  # user_id -> score
+        for entry in entries:
+            self.offer(entry.user_id, entry.score)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def offer(self, user_id: int, score: int) -> bool:
+        """score が自己ベストを超えていれば入れる。順位表が変わったら True を返す"""
+        current = self._scores.get(user_id)
+        if current is not None and current >= score:
+            return False
+        key = (-score, user_id)
+        if current is None and len(self._keys) >= self.k and key > self._keys[-1]:
+            return False
+        if current is not None:
+            del self._keys[bisect.bisect_left(self._keys, (-current, user_id))]
+        bisect.insort(self._keys, key)
+        self._scores[user_id] = score
+        if len(self._keys) > self.k:
+            _, dropped = self._keys.pop()
+            del self._scores[dropped]
+        return True
+
+    def entries(self, limit: Optional[int] = None) -> list[RankedScore]:
+        return [RankedScore(user_id, -score) for score, user_id in self._keys[:limit]]
+
+
+class _Board:
+    def __init__(self, top: TopK, stats: ScoreStats):
+        self.top = top
+        self.stats = stats
+
+
+class Leaderboards:
+    """live_id・難易度ごとの TopK と集計をメモリに持つ
+
+    エントリは RANKING_REFRESH 秒で失効し、次に引かれたときに DB から読み直す。
+    """
+
+    def __init__(
+        self,
+        size: int = RANKING_SIZE,
+        refresh: float = RANKING_REFRESH,
+        maxsize: int = RANKING_CACHE_SIZE,
+    ):
+        self.size = size
+        self.cache: LRUCache[_Board] = LRUCache(maxsize, ttl=refresh)
+        self._lock = threading.Lock()
+
+    def get(
+        self, live_id: int, difficulty: int, limit: Optional[int] = None
+    ) -> tuple[list[RankedScore], ScoreStats]:
+        """上位 limit 件 (既定は全件) と集計を返す"""
+        key = (live_id, difficulty)
+        board = self.cache.get(key)
+        if board is None:
+            board = _load_board(live_id, difficulty, self.size)
+            self.cache.set(key, board)
+        with self._lock:
+            return board.top.entries(limit), board.stats
+
+    def apply(self, plays: list[Play]) -> None:
+        """DB に書いた結果を、メモリに持っている順位表にも反映する"""
+        with self._lock:
+            for (live_id, difficulty), group in _group_plays(plays).items():
+                board = self.cache.peek((live_id, difficulty))
+                if board is None:
+                    continue
+                for play in group:
+                    board.top.offer(play.user_id, play.score)
+                board.stats = board.stats.merge(_stats_of(group))
+
+    def clear(self) -> None:
+        self.cache.clear()
+
+
+leaderboards = Leaderboards()
+
+
+def record_plays(plays: list[Play]) -> None:
+    """確定した結果を自己ベストと集計に足し込む
+
+    解散をコミットした後に呼ぶので、書き込めなければ捨てずに play_retries で書き直す。
+    """
+    if not plays:
+        return
+    try:
+        _write_plays([plays])
+    except Exception:
+        logger.exception(
+            "ranking: failed to record %d plays, retrying later", len(plays)
+        )
+        play_retries.submit(plays)
+
+
+def _write_plays(batches: list[list[Play]]) -> None:
+    plays = [play for batch in batches for play in batch]
+    storage.save_plays(plays)
+    leaderboards.apply(plays)
+
+
+# record_plays() で書き込めなかったルームごとの結果
+play_retries: WriteBehindQueue[list[Play]] = WriteBehindQueue(
+    _write_plays, RETRY_INTERVAL, 100, RETRY_MAX_PENDING
+)
+
+
+def get_ranking(
+    live_id: int, difficulty: int, limit: Optional[int] = None
+) -> tuple[list[RankedScore], ScoreStats]:
+    return leaderboards.get(live_id, difficulty, limit)
+
+
+def get_personal_bests(
+    user_id: int, live_id: Optional[int] = None
+) -> list[PersonalBest]:
+    rows = storage.get_personal_bests(user_id, live_id)
+    return [PersonalBest(*row) for row in rows]
+
+
+def _group_plays(plays: Iterable[Play]) -> dict[tuple[int, int], list[Play]]:
+    groups = defaultdict(list)
+    for play in plays:
+        groups[play.live_id, play.difficulty].append(play)
+    return groups
+
+
+def _stats_of(plays: list[Play]) -> ScoreStats:
+    scores = [play.score for play in plays]
+    return ScoreStats(len(scores), sum(scores), max(scores))
+
+
+def _load_board(live_id: int, difficulty: int, size: int) -> _Board:
+    rows, stats = storage.load_ranking(live_id, difficulty, size)
+    top = TopK(size, (RankedScore(*row) for row in rows))
+    return _Board(top, ScoreStats(*stats) if stats is not None else ScoreStats())
+
+
+# アーカイブからの作り直し
+
+
+class RebuildResult(NamedTuple):
+    plays: int
+    batches: int
+
+
+def rebuild(batch_size: int = REBUILD_BATCH_SIZE) -> RebuildResult:
+    """personal_best と live_score_stats を確定済みの結果から作り直す
+
+    アーカイブと、解散済みでまだアーカイブされていないルームを batch_size 件ずつ足し込む。
+    作り直している間に確定した結果は play_count を二重に数えうる (自己ベストは変わらない)。
+    """
+    plays, batches = storage.rebuild_ranking(batch_size)
+    leaderboards.clear()
+    return RebuildResult(plays, batches)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ランキングをアーカイブから作り直す")
+    parser.add_argument("--batch-size", type=int, default=REBUILD_BATCH_SIZE)
+    args = parser.parse_args()
+    result = rebuild(args.batch_size)
+    print(f"rebuilt from {result.plays} plays in {result.batches} batches")
+
+
+if __name__ == "__main__":
+    main()
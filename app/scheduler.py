@@ -0,0 +1,142 @@
+import heapq
+import logging
+import math
+import threading
+import time
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RoomTimer:
+    """全ルームのタイムアウトを1本のワーカースレッドで管理するスケジューラ
+
+    期限は tick 単位に丸め、同じ tick に期限を迎えたルームはまとめて
+    ``on_expire`` に渡す。
+    """
+
+    def __init__(self, on_expire: Callable[[list[int]], None], tick: float = 1.0):
+        self._on_expire = on_expire
+        self._tick = tick
+        self._cond = threading.Condition()
+        self._heap: list[tuple[float, int]] = []
+        self._deadlines: dict[int, float] = {}  # room_id -> 有効な期限
+        self._thread = None
+        self._stopped = False
+        self.lag: float = 0.0  # 直近に発火したバッチの遅延（秒）
+
+    @property
+    def pending(self) -> int:
+        """発火待ちのタイマー数"""
+        return len(self._deadlines)
+
+    def schedule(self, room_id: int, timeout: float) -> None:
+        """timeout 秒後に room_id を期限切れにする。既存の期限の方が早ければそちらを残す"""
+        deadline = math.ceil((time.monotonic() + timeout) / self._tick) * self._tick
+        with self._cond:
+            current = self._deadlines.get(room_id)
+            if current is not None and current <= deadline:
+                return
+            self._deadlines[room_id] = deadline
+            heapq.heappush(self._heap, (deadline, room_id))
+            self._ensure_started()
+            self._cond.notify()
+
+    def cancel(self, room_id: int) -> None:
+        """ルームが途中で終わったときにタイマーを取り消す"""
+        with self._cond:
+            # heap 上のエントリは発火時に _deadlines と突き合わせて捨てる
+            self._deadlines.pop(room_id, None)
+
+    def stop(self) -> list[int]:
+        """ワーカースレッドを止め、発火していないタイマーの room_id を返す
+
+        止めた後に schedule() されたタイマーは発火しない。
+        """
+        with self._cond:
+            self._stopped = True
+            room_ids = list(self._deadlines)
+            self._deadlines.clear()
+            self._heap.clear()
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        return room_ids
+
+    def _ensure_started(self) -> None:
+        if self._thread is None and not self._stopped:
+            self._thread = threading.Thread(
+                target=self._run, name="room-timer", daemon=True
+            )
+            self._thread.start()
+
+    def _pop_due(self) -> tuple[Optional[list[int]], float]:
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None, 0.0
+                while self._heap and self._deadlines.get(self._heap[0][1]) != (
+                    self._heap[0][0]
+                ):
+                    heapq.heappop(self._heap)  # 取り消し済み・更新済み
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                deadline = self._heap[0][0]
+                if deadline > now:
+                    self._cond.wait(deadline - now)
+                    continue
+                room_ids = []
+                while self._heap and self._heap[0][0] <= deadline:
+                    entry_deadline, room_id = heapq.heappop(self._heap)
+                    if self._deadlines.get(room_id) == entry_deadline:
+                        del self._deadlines[room_id]
+                        room_ids.append(room_id)
+                return room_ids, now - deadline
+
+    def _run(self) -> None:
+        while True:
+            room_ids, lag = self._pop_due()
+            if room_ids is None:
+                return
+            self.lag = lag
+            if not room_ids:
+                continue
+            try:
+                self._on_expire(room_ids)
+            except Exception:
+                logger.exception("room timer: failed to expire %s", room_ids)
+
+
+class PeriodicTask:
+    """fn を interval 秒ごとにバックグラウンドスレッドで実行する"""
+
+    def __init__(self, fn: Callable[[], object], interval: float):
+        self._fn = fn
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name=getattr(self._fn, "__name__", "task"), daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self._interval):
+            try:
+                self._fn()
+            except Exception:
+                logger.exception("%s failed", threading.current_thread().name)
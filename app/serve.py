@@ -0,0 +1,75 @@
+"""本番用の起動スクリプト
+
+    python -m app.serve --workers 8 --port 8000
+
+uvicorn の親プロセスがポートを開き、workers 個のワーカープロセスがそれぞれ accept する。
+ワーカーは何も共有しない (コネクションプール・キャッシュ・タイマーはプロセスごと)。
+
+- 起動時: プールとキャッシュを温めてから accept を始める (WARM_UP)
+- SIGTERM: 新しい接続を受けなくなり、処理中のリクエストを最大 graceful_timeout 秒待ってから
+  溜まっている /room/end のスコアを書き出して終わる。発火していないタイムアウトは
+  room.deadline_at を見る他のワーカーの room_sweeper が引き継ぐ
+
+このモジュールは親プロセスでも読み込まれるので、DB に繋ぐモジュールを読み込まないこと。
+"""
+
+import argparse
+import sys
+
+import uvicorn
+
+from . import config
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=config.WEB_HOST)
+    parser.add_argument("--port", type=int, default=config.WEB_PORT)
+    parser.add_argument("--workers", type=int, default=config.WEB_WORKERS)
+    parser.add_argument("--backlog", type=int, default=config.WEB_BACKLOG)
+    parser.add_argument(
+        "--keep-alive",
+        type=int,
+        default=config.WEB_KEEP_ALIVE,
+        help="アイドルな keep-alive 接続を閉じるまでの秒数",
+    )
+    parser.add_argument(
+        "--graceful-timeout", type=int, default=config.WEB_GRACEFUL_TIMEOUT
+    )
+    parser.add_argument("--log-level", default="warning")
+    return parser
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.workers > 1 and config.STORAGE in ("sqlite_memory", "memory"):
+        parser.error(f"STORAGE={config.STORAGE} cannot be shared between workers")
+    if config.ASYNC_DB and config.SHARDS > 1:
+        parser.error("ASYNC_DB=1 cannot be combined with SHARDS > 1")
+    if config.STORAGE == "memory" and (config.ASYNC_DB or config.EVENT_BUS == "mysql"):
+        parser.error(
+            "STORAGE=memory cannot be combined with ASYNC_DB=1 or EVENT_BUS=mysql"
+        )
+    if args.workers > 1 and config.EVENT_BUS == "local":
+        # ロングポーリングや SSE は timeout のたびに読み直すので、遅れるだけで動きはする
+        print(
+            "warning: with EVENT_BUS=local, room updates made by other workers "
+            "reach long polls only on timeout",
+            file=sys.stderr,
+        )
+    uvicorn.run(
+        "app.api:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        backlog=args.backlog,
+        timeout_keep_alive=args.keep_alive,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        log_level=args.log_level,
+        access_log=False,
+    )
+
+
+if __name__ == "__main__":
+    main()
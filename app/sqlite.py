@@ -0,0 +1,101 @@
+"""MySQL 向けに書いたクエリと schema.sql を SQLite で動かすための変換
+
+モデルのクエリは MySQL の方言のまま書き、SQLite で実行する直前に書き換える。
+STORAGE=sqlite / sqlite_memory はテストと開発のためのバックエンドで、専用のストレージ層ではない。
+SQLite は書き込みが1つずつなので、プロセス内では全ルームの処理を1つのロックで順番に行う。
+"""
+
+import re
+from datetime import datetime
+from pathlib import Path
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+
+SCHEMA_PATH = Path(__file__).resolve().parent.parent / "schema.sql"
+
+_INTERVAL = re.compile(r"NOW\(\) ([+-]) INTERVAL (\?) SECOND")
+_KEY = re.compile(r",\s*(UNIQUE )?KEY `(\w+)` \(([^)]*)\)")
+_CREATE_TABLE = re.compile(r"CREATE TABLE `(\w+)`")
+_INSERT_ROOM = "INSERT INTO `room` ("
+_VALUES_REF = re.compile(r"VALUES\((`\w+`)\)")
+
+
+def translate(statement: str, shard: int = 0, shards: int = 1) -> str:
+    """1つのクエリを SQLite で通る形に書き換える"""
+    if shards > 1 and statement.startswith(_INSERT_ROOM):
+        statement = _assign_room_id(statement, shard, shards)
+    # SQLite はデータベース全体をロックするので行ロックは要らない
+    statement = statement.replace(" FOR UPDATE SKIP LOCKED", "")
+    statement = statement.replace(" FOR UPDATE", "")
+    statement = _INTERVAL.sub(r"datetime(NOW(), '\1' || \2 || ' seconds')", statement)
+    # 主キーの衝突先は SQLite 3.35 から省略できる
+    statement = statement.replace(
+        " ON DUPLICATE KEY UPDATE ", " ON CONFLICT DO UPDATE SET "
+    )
+    statement = _VALUES_REF.sub(r"excluded.\1", statement)
+    statement = statement.replace("GREATEST(", "MAX(")
+    return statement.replace("LEAST(", "MIN(")
+
+
+def _assign_room_id(statement: str, shard: int, shards: int) -> str:
+    # MySQL の auto_increment_increment/offset の代わりに、最後に払い出した id より大きく
+    # shards で割って shard + 1 余る最小の id を明示して INSERT する
+    last_id = "COALESCE((SELECT `seq` FROM `sqlite_sequence` WHERE `name`='room'), 0)"
+    offset = (shard + 1) % shards
+    next_id = f"{last_id} + ((({offset} - {last_id} - 1) % {shards}) + {shards}) % {shards} + 1"
+    statement = statement.replace(_INSERT_ROOM, _INSERT_ROOM + "id, ", 1)
+    return statement.replace("VALUES (", f"VALUES (({next_id}), ", 1)
+
+
+def schema_statements(schema: str) -> list[str]:
+    """schema.sql を SQLite の CREATE TABLE / CREATE INDEX に書き換える"""
+    statements = []
+    for statement in schema.split(";"):
+        statement = re.sub(r"^--.*$", "", statement, flags=re.MULTILINE).strip()
+        if "AUTO_INCREMENT" in statement:
+            statement = statement.replace(
+                "bigint NOT NULL AUTO_INCREMENT", "INTEGER PRIMARY KEY AUTOINCREMENT"
+            )
+            statement = re.sub(r",\s*PRIMARY KEY \(`id`\)", "", statement)
+        match = _CREATE_TABLE.search(statement)
+        if match is None:
+            if statement:
+                statements.append(statement)
+            continue
+        table = match.group(1)
+        indexes = []
+        for unique, name, columns in _KEY.findall(statement):
+            indexes.append(
+                f"CREATE {unique}INDEX `{table}_{name}` ON `{table}` ({columns})"
+            )
+        statements.append(_KEY.sub("", statement))
+        statements.extend(indexes)
+    return statements
+
+
+def _now() -> str:
+    # CURRENT_TIMESTAMP と揃えて UTC にする
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def setup(engine: Engine, shard: int = 0, shards: int = 1) -> None:
+    """engine のクエリを書き換えるようにし、テーブルが無ければ作る
+
+    shards > 1 なら、このシャードのルームには shards で割って shard + 1 余る id を振る。
+    """
+
+    @event.listens_for(engine, "connect")
+    def _connect(dbapi_conn, record):
+        dbapi_conn.create_function("NOW", 0, _now)
+
+    @event.listens_for(engine, "before_cursor_execute", retval=True)
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        return translate(statement, shard, shards), parameters
+
+    with engine.begin() as conn:
+        query = "SELECT COUNT(*) FROM `sqlite_master` WHERE `type`='table' AND `name`='room'"
+        if conn.execute(text(query)).scalar():
+            return
+        for statement in schema_statements(SCHEMA_PATH.read_text()):
+            conn.exec_driver_sql(statement)
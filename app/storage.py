@@ -0,0 +1,1525 @@
+"""ユーザー・ルーム・ランキングの読み書き
+
+model はキャッシュ・イベント・タイマーを受け持ち、読み書きはここの storage を通して行う。
+STORAGE で実装を選ぶ。
+
+- SQLStorage (mysql / sqlite / sqlite_memory): MySQL の方言の SQL。ルームは room_id でシャードに分ける
+- MemoryStorage (memory): DB を使わずプロセス内に持つ。ルームごとのロックで読み書きするので、
+  別のルームへの操作は互いに待たない。プロセスが終わると消え、ワーカーは1つのみ
+
+どちらも SQL の列名と同じ属性を持つ行を返す。
+"""
+
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from enum import IntEnum
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import IntegrityError, NoResultFound
+
+from . import config
+from .db import begin, shard_of
+
+MAX_USER_COUNT: int = 4
+SWEEP_BATCH_SIZE: int = 1000
+REAP_BATCH_SIZE: int = 500
+REAP_MAX_BATCHES: int = 20  # 1回の実行で1シャードあたり処理するバッチ数の上限
+
+
+class LiveDifficulty(IntEnum):
+    normal = 1
+    hard = 2
+
+
+class JoinRoomResult(IntEnum):
+    Ok = 1  # 入場OK
+    RoomFull = 2  # 満員
+    Disbanded = 3  # 解散済み
+    OtherError = 4  # その他エラー
+
+
+class WaitRoomStatus(IntEnum):
+    Waiting = 1  # ホストがライブ開始ボタン押すのを待っている
+    LiveStart = 2  # ライブ画面遷移OK
+    Dissolution = 3  # 解散された
+
+
+class ScoreSubmission(NamedTuple):
+    room_id: int
+    user_id: int
+    judge_count_list: list[int]
+    score: int
+
+
+class RoomResults(NamedTuple):
+    rows: list  # (user_id, judge_perfect, ..., judge_miss, score)。全員のスコアが揃っていなければ空
+    dissolved: bool  # この呼び出しで解散させたか
+    plays: list  # 解散させたときの (live_id, difficulty, user_id, score)
+    saved: bool  # plays を解散と一緒に自己ベストと集計に足し込んだか
+
+
+class DuplicateToken(Exception):
+    """insert_users() の token が既存のものと衝突した"""
+
+
+class Storage:
+    """ユーザー・ルーム・ランキングの読み書き
+
+    ルームの行は (version, status, live_id, host_id, user_id, select_difficulty) を
+    参加者ごとに返す。参加者がいなければ user_id が None の行を1つ、ルームが無ければ空を返す。
+    name と leader_card_id も持つ行なら、model はプロフィールを引き直さない。
+    """
+
+    # ユーザー
+
+    def insert_users(self, users: list[tuple[str, int]], tokens: list[str]) -> None:
+        """(name, leader_card_id) のユーザーを同じ順の token で入れる
+
+        token が衝突したら1人も入れずに DuplicateToken を投げる。
+        """
+        raise NotImplementedError
+
+    def get_user_by_token(self, token: str):
+        """(id, name, leader_card_id) の行。無ければ None"""
+        raise NotImplementedError
+
+    def get_users(self, user_ids: list[int]) -> list:
+        """(id, name, leader_card_id) の行。存在しない id は含まない"""
+        raise NotImplementedError
+
+    def update_user(self, token: str, name: str, leader_card_id: int):
+        """更新した後のユーザーの行を返す。無ければ None"""
+        raise NotImplementedError
+
+    def bump_rooms_of_user(self, user_id: int) -> None:
+        """参加中のルームの version を上げ、キャッシュした名前を読み直させる"""
+        raise NotImplementedError
+
+    # ルーム
+
+    def create_room(self, live_id: int, host_id: int) -> int:
+        raise NotImplementedError
+
+    def create_matched_room(
+        self, live_id: int, members: list[tuple[int, LiveDifficulty]]
+    ) -> tuple[int, list]:
+        """先頭のメンバーをホストにして全員入ったルームを作り、(room_id, ルームの行) を返す"""
+        raise NotImplementedError
+
+    def list_rooms(
+        self, live_id: int, limit: Optional[int], cursor: Optional[int]
+    ) -> list:
+        """入場可能なルームの (id, live_id, joined_user_count) を id 順に返す"""
+        raise NotImplementedError
+
+    def join_room(
+        self, room_id: int, user_id: int, select_difficulty: LiveDifficulty
+    ) -> tuple[JoinRoomResult, list]:
+        """空きがあれば入室して (Ok, ルームの行) を、無ければ (理由, []) を返す"""
+        raise NotImplementedError
+
+    def get_room_status(self, room_id: int) -> Optional[int]:
+        raise NotImplementedError
+
+    def get_room_rows(self, room_id: int, version: Optional[int] = None):
+        """ルームの行。version が今の version と同じなら読まずに None を返す"""
+        raise NotImplementedError
+
+    def users_colocated(self, room_id: int) -> bool:
+        """get_user_and_room_rows() の方が認証とルームの読み出しを別々に行うより安いか"""
+        return False
+
+    def get_user_and_room_rows(
+        self, token: str, room_id: int, version: Optional[int] = None
+    ) -> tuple:
+        """(ユーザーの行, get_room_rows() の結果)。ユーザーがいなければ (None, None)"""
+        user = self.get_user_by_token(token)
+        if user is None:
+            return None, None
+        return user, self.get_room_rows(room_id, version)
+
+    def get_live_id(self, room_id: int) -> Optional[int]:
+        raise NotImplementedError
+
+    def start_room(self, room_id: int, timeout: int) -> list:
+        """ライブを開始して timeout 秒後を期限にし、ルームの行を返す"""
+        raise NotImplementedError
+
+    def end_rooms(self, submissions: list[ScoreSubmission], timeout: int) -> list[int]:
+        """スコアを書き込み、ライブ中だったルームの期限を timeout 秒後までに縮めてその id を返す"""
+        raise NotImplementedError
+
+    def collect_results(self, room_id: int) -> RoomResults:
+        """全員のスコアが揃っているか期限切れならルームを解散させて結果を返す
+
+        期限切れなら未送信のスコアを0で確定させる。
+        """
+        raise NotImplementedError
+
+    def leave_room(self, room_id: int, user_id: int) -> Optional[tuple[bool, list]]:
+        """退室して (ルームを消したか, ルームの行) を返す。参加していなければ None"""
+        raise NotImplementedError
+
+    def expire_rooms(self, room_ids: list[int]) -> None:
+        """未送信のスコアを0で確定させ、期限を消す"""
+        raise NotImplementedError
+
+    def sweep_expired_rooms(self) -> list[int]:
+        """期限を過ぎたルームを expire_rooms() と同じく確定させ、その id を返す"""
+        raise NotImplementedError
+
+    def reap_rooms(
+        self, ttls: list[tuple[WaitRoomStatus, int]], archive_delay: int
+    ) -> tuple[list[int], int, int, Optional[float]]:
+        """作られてから ttl 秒経ったその状態のルームを解散させ、解散から archive_delay 秒経った
+        ルームをアーカイブに移す
+
+        (解散させた id, アーカイブしたルーム数, アーカイブしたメンバー数, 未解散で最も古いルームの経過秒数)
+        を返す。
+        """
+        raise NotImplementedError
+
+    def count_rooms(self) -> list[tuple[int, int, int]]:
+        """(状態, 参加人数, ルーム数) の一覧"""
+        raise NotImplementedError
+
+    def load_live_room_rows(self, limit: int) -> list:
+        """未解散のルームを新しい方から limit 件まで、id 付きのルームの行で返す"""
+        raise NotImplementedError
+
+    # ランキング
+
+    def save_plays(self, plays: list) -> None:
+        """(live_id, difficulty, user_id, score) を自己ベストと集計に足し込む"""
+        raise NotImplementedError
+
+    def get_personal_bests(self, user_id: int, live_id: Optional[int] = None) -> list:
+        """(live_id, difficulty, score, play_count) を live_id・difficulty 順に返す"""
+        raise NotImplementedError
+
+    def load_ranking(self, live_id: int, difficulty: int, size: int) -> tuple:
+        """自己ベストの上位 size 件の (user_id, score) と、(play_count, score_sum, max_score) の集計
+
+        集計が無ければ None を返す。
+        """
+        raise NotImplementedError
+
+    def rebuild_ranking(self, batch_size: int) -> tuple[int, int]:
+        """自己ベストと集計を確定済みの結果から作り直し、(結果の数, バッチ数) を返す"""
+        raise NotImplementedError
+
+
+def _aggregate_plays(plays: Iterable) -> tuple[dict, dict]:
+    """同じ人が同じ曲を何度も遊んでいても1つにまとめる
+
+    ((live_id, difficulty, user_id) -> (score, play_count),
+    (live_id, difficulty) -> (play_count, score_sum, max_score)) を返す。
+    """
+    bests: dict[tuple[int, int, int], tuple[int, int]] = {}
+    stats: dict[tuple[int, int], tuple[int, int, int]] = {}
+    for live_id, difficulty, user_id, score in plays:
+        key = (live_id, difficulty, user_id)
+        best, play_count = bests.get(key, (score, 0))
+        bests[key] = (max(best, score), play_count + 1)
+        play_count, score_sum, max_score = stats.get((live_id, difficulty), (0, 0, 0))
+        stats[live_id, difficulty] = (
+            play_count + 1,
+            score_sum + score,
+            max(max_score, score),
+        )
+    return bests, stats
+
+
+# SQL
+
+
+# 新しいルームを置くシャードを順番に選ぶ
+_shard_counter = itertools.count()
+# list_rooms などで全シャードに同時に問い合わせる。
+# 同時に来た呼び出しが待たされないよう、全シャードのプールのコネクション数だけスレッドを用意する
+_shard_executor = (
+    ThreadPoolExecutor(
+        config.SHARDS * (config.DB_POOL_SIZE + config.DB_MAX_OVERFLOW),
+        thread_name_prefix="shard",
+    )
+    if config.SHARDS > 1 and config.STORAGE != "memory"
+    else None
+)
+
+
+def _next_shard() -> int:
+    return next(_shard_counter) % config.SHARDS
+
+
+def _scatter(fn, *args) -> list:
+    """fn(shard, *args) を全シャードで実行し、シャード順に結果を返す
+
+    track_queries() などの contextvars は呼び出し元のものを引き継ぐ。
+    """
+    if _shard_executor is None:
+        return [fn(0, *args)]
+    futures = [
+        _shard_executor.submit(contextvars.copy_context().run, fn, shard, *args)
+        for shard in range(config.SHARDS)
+    ]
+    return [future.result() for future in futures]
+
+
+def _group_by_shard(room_ids) -> dict[int, list[int]]:
+    groups = defaultdict(list)
+    for room_id in room_ids:
+        groups[shard_of(room_id)].append(room_id)
+    return groups
+
+
+class SQLStorage(Storage):
+    """MySQL (と SQLite) に読み書きする。ユーザーとランキングはシャード 0 に置く"""
+
+    def insert_users(self, users: list[tuple[str, int]], tokens: list[str]) -> None:
+        values = ", ".join(
+            f"(:name_{i}, :token_{i}, :leader_card_id_{i})" for i in range(len(users))
+        )
+        query = f"INSERT INTO `user` (name, token, leader_card_id) VALUES {values}"
+        args = {}
+        for i, ((name, leader_card_id), token) in enumerate(zip(users, tokens)):
+            args[f"name_{i}"] = name
+            args[f"token_{i}"] = token
+            args[f"leader_card_id_{i}"] = leader_card_id
+        try:
+            with begin() as conn:
+                conn.execute(text(query), args)
+        except IntegrityError as e:
+            raise DuplicateToken() from e
+
+    def get_user_by_token(self, token: str):
+        with begin() as conn:
+            return _get_user_by_token(conn, token)
+
+    def get_users(self, user_ids: list[int]) -> list:
+        query = (
+            "SELECT `id`,`name`,`leader_card_id` FROM `user` WHERE `id` IN :user_ids"
+        )
+        with begin() as conn:
+            result = conn.execute(
+                text(query).bindparams(bindparam("user_ids", expanding=True)),
+                {"user_ids": user_ids},
+            )
+            return result.fetchall()
+
+    def update_user(self, token: str, name: str, leader_card_id: int):
+        with begin() as conn:
+            conn.execute(
+                text(
+                    "UPDATE `user` SET `name`=:name, `leader_card_id`=:leader_card_id WHERE `token`=:token"
+                ),
+                {"token": token, "name": name, "leader_card_id": leader_card_id},
+            )
+            return _get_user_by_token(conn, token)
+
+    def bump_rooms_of_user(self, user_id: int) -> None:
+        query = "UPDATE `room` SET `version`=`version`+1 WHERE `id` IN (SELECT `room_id` FROM `room_member` WHERE `user_id`=:user_id)"
+        for shard in range(config.SHARDS):
+            with begin(shard) as conn:
+                conn.execute(text(query), {"user_id": user_id})
+
+    def create_room(self, live_id: int, host_id: int) -> int:
+        with begin(_next_shard()) as conn:
+            query = "INSERT INTO `room` (live_id, host_id, status) VALUES (:live_id, :host_id, :status)"
+            result = conn.execute(
+                text(query),
+                {
+                    "live_id": live_id,
+                    "host_id": host_id,
+                    "status": int(WaitRoomStatus.Waiting),
+                },
+            )
+        return result.lastrowid
+
+    def create_matched_room(
+        self, live_id: int, members: list[tuple[int, LiveDifficulty]]
+    ) -> tuple[int, list]:
+        with begin(_next_shard()) as conn:
+            query = "INSERT INTO `room` (live_id, host_id, status, joined_user_count) VALUES (:live_id, :host_id, :status, :joined_user_count)"
+            result = conn.execute(
+                text(query),
+                {
+                    "live_id": live_id,
+                    "host_id": members[0][0],
+                    "status": int(WaitRoomStatus.Waiting),
+                    "joined_user_count": len(members),
+                },
+            )
+            room_id = result.lastrowid
+            query = "INSERT INTO `room_member` (room_id, user_id, select_difficulty) VALUES (:room_id, :user_id, :select_difficulty)"
+            conn.execute(
+                text(query),
+                [
+                    {
+                        "room_id": room_id,
+                        "user_id": user_id,
+                        "select_difficulty": int(select_difficulty),
+                    }
+                    for user_id, select_difficulty in members
+                ],
+            )
+            return room_id, _load_room_rows(conn, room_id)
+
+    def list_rooms(
+        self, live_id: int, limit: Optional[int], cursor: Optional[int]
+    ) -> list:
+        # 各シャードから room_id 順に limit 件ずつ集めて併合する
+        shard_rows = _scatter(_list_room_rows, live_id, limit, cursor)
+        return list(heapq.merge(*shard_rows, key=lambda row: row.id))[:limit]
+
+    def join_room(
+        self, room_id: int, user_id: int, select_difficulty: LiveDifficulty
+    ) -> tuple[JoinRoomResult, list]:
+        with begin(shard_of(room_id)) as conn:
+            # 空きがあるときだけ人数を1増やす。行ロックはこの文からコミットまでしか持たない
+            query = "UPDATE `room` SET `joined_user_count`=`joined_user_count`+1, `version`=`version`+1 WHERE `id`=:room_id AND `status`=:status AND `joined_user_count`<:max_user_count"
+            result = conn.execute(
+                text(query),
+                {
+                    "room_id": room_id,
+                    "status": int(WaitRoomStatus.Waiting),
+                    "max_user_count": MAX_USER_COUNT,
+                },
+            )
+            if result.rowcount == 0:
+                return _get_join_failure(conn, room_id), []
+            _insert_into_room_member(conn, room_id, user_id, select_difficulty)
+            return JoinRoomResult.Ok, _load_room_rows(conn, room_id)
+
+    def get_room_status(self, room_id: int) -> Optional[int]:
+        with begin(shard_of(room_id)) as conn:
+            return _get_room_status(conn, room_id)
+
+    def get_room_rows(self, room_id: int, version: Optional[int] = None):
+        with begin(shard_of(room_id)) as conn:
+            return _read_room_rows(conn, room_id, version)
+
+    def users_colocated(self, room_id: int) -> bool:
+        # ユーザーと同じシャードのルームなら1つのコネクションで読める
+        return shard_of(room_id) == 0
+
+    def get_user_and_room_rows(
+        self, token: str, room_id: int, version: Optional[int] = None
+    ) -> tuple:
+        with begin() as conn:
+            user = _get_user_by_token(conn, token)
+            if user is None:
+                return None, None
+            return user, _read_room_rows(conn, room_id, version)
+
+    def get_live_id(self, room_id: int) -> Optional[int]:
+        query = "SELECT `live_id` FROM `room` WHERE `id`=:room_id"
+        with begin(shard_of(room_id)) as conn:
+            return conn.execute(text(query), {"room_id": room_id}).scalar()
+
+    def start_room(self, room_id: int, timeout: int) -> list:
+        with begin(shard_of(room_id)) as conn:
+            _update_room_status(conn, room_id)
+            _set_room_deadline(conn, [room_id], timeout)
+            _bump_room_version(conn, room_id)
+            return _load_room_rows(conn, room_id)
+
+    def end_rooms(self, submissions: list[ScoreSubmission], timeout: int) -> list[int]:
+        by_shard = defaultdict(list)
+        for s in submissions:
+            by_shard[shard_of(s.room_id)].append(s)
+        started_room_ids = []
+        for shard, shard_submissions in by_shard.items():
+            started_room_ids += _end_shard_rooms(shard, shard_submissions, timeout)
+        return started_room_ids
+
+    def collect_results(self, room_id: int) -> RoomResults:
+        shard = shard_of(room_id)
+        with begin(shard) as conn:
+            rows = _get_result_rows(conn, room_id)
+            if not rows:
+                return RoomResults([], False, [], False)
+            # タイマーを持っていたワーカーが落ちていても期限切れならここで確定させる
+            if any(row.expired for row in rows):
+                _expire_rooms(conn, [room_id])
+            dissolved = _dissolve_room(conn, room_id)
+            # 結果が確定したルームだけを一度だけランキングに数える
+            plays = _get_room_plays(conn, room_id) if dissolved else []
+            # ランキングと同じシャードなら解散と一緒にコミットし、結果を取りこぼさない
+            saved = bool(plays) and shard == 0
+            if saved:
+                self._save_plays(conn, plays)
+        return RoomResults(rows, dissolved, plays, saved)
+
+    def leave_room(self, room_id: int, user_id: int) -> Optional[tuple[bool, list]]:
+        with begin(shard_of(room_id)) as conn:
+            # 参加していないユーザーや2回目の退室で人数を減らさない
+            if not _delete_room_member(conn, room_id, user_id):
+                return None
+            _add_joined_user_count(conn, room_id, -1)
+            if _get_number_of_room_members(conn, room_id) == 0:
+                _delete_room(conn, room_id)
+                return True, []
+            if _get_host_id(conn, room_id) == user_id:
+                _change_host(conn, room_id)
+            _bump_room_version(conn, room_id)
+            return False, _load_room_rows(conn, room_id)
+
+    def expire_rooms(self, room_ids: list[int]) -> None:
+        for shard, shard_room_ids in _group_by_shard(room_ids).items():
+            with begin(shard) as conn:
+                _expire_rooms(conn, shard_room_ids)
+
+    def sweep_expired_rooms(self) -> list[int]:
+        return [
+            room_id
+            for shard_room_ids in _scatter(_sweep_shard)
+            for room_id in shard_room_ids
+        ]
+
+    def reap_rooms(
+        self, ttls: list[tuple[WaitRoomStatus, int]], archive_delay: int
+    ) -> tuple[list[int], int, int, Optional[float]]:
+        # ロックを短く保つため、REAP_BATCH_SIZE 件ずつ別のトランザクションで処理する
+        expired_room_ids = []
+        archived_rooms = archived_members = 0
+        ages = []
+        for shard_expired, shard_rooms, shard_members, age in _scatter(
+            _reap_shard, ttls, archive_delay
+        ):
+            expired_room_ids += shard_expired
+            archived_rooms += shard_rooms
+            archived_members += shard_members
+            if age is not None:
+                ages.append(age)
+        return (
+            expired_room_ids,
+            archived_rooms,
+            archived_members,
+            max(ages) if ages else None,
+        )
+
+    def count_rooms(self) -> list[tuple[int, int, int]]:
+        counts = defaultdict(int)
+        for rows in _scatter(_count_shard_rooms):
+            for row in rows:
+                counts[(row.status, row.joined_user_count)] += row.count
+        return [(status, joined, count) for (status, joined), count in counts.items()]
+
+    def load_live_room_rows(self, limit: int) -> list:
+        return [row for rows in _scatter(_load_live_rooms_rows, limit) for row in rows]
+
+    def save_plays(self, plays: list) -> None:
+        with begin() as conn:
+            self._save_plays(conn, plays)
+
+    def _save_plays(self, conn, plays: list) -> None:
+        """conn (シャード 0) のトランザクションで足し込む"""
+        bests, stats = _aggregate_plays(plays)
+        query = "INSERT INTO `personal_best` (live_id, difficulty, user_id, score, play_count) VALUES (:live_id, :difficulty, :user_id, :score, :play_count) ON DUPLICATE KEY UPDATE `score`=GREATEST(`score`, VALUES(`score`)), `play_count`=`play_count`+VALUES(`play_count`)"
+        conn.execute(
+            text(query),
+            [
+                {
+                    "live_id": live_id,
+                    "difficulty": difficulty,
+                    "user_id": user_id,
+                    "score": score,
+                    "play_count": play_count,
+                }
+                for (live_id, difficulty, user_id), (score, play_count) in bests.items()
+            ],
+        )
+        query = "INSERT INTO `live_score_stats` (live_id, difficulty, play_count, score_sum, max_score) VALUES (:live_id, :difficulty, :play_count, :score_sum, :max_score) ON DUPLICATE KEY UPDATE `play_count`=`play_count`+VALUES(`play_count`), `score_sum`=`score_sum`+VALUES(`score_sum`), `max_score`=GREATEST(`max_score`, VALUES(`max_score`))"
+        conn.execute(
+            text(query),
+            [
+                {
+                    "live_id": live_id,
+                    "difficulty": difficulty,
+                    "play_count": play_count,
+                    "score_sum": score_sum,
+                    "max_score": max_score,
+                }
+                for (live_id, difficulty), (
+                    play_count,
+                    score_sum,
+                    max_score,
+                ) in stats.items()
+            ],
+        )
+
+    def get_personal_bests(self, user_id: int, live_id: Optional[int] = None) -> list:
+        query = "SELECT `live_id`, `difficulty`, `score`, `play_count` FROM `personal_best` WHERE `user_id`=:user_id ORDER BY `live_id`, `difficulty`"
+        args = {"user_id": user_id}
+        if live_id is not None:
+            query = "SELECT `live_id`, `difficulty`, `score`, `play_count` FROM `personal_best` WHERE `live_id`=:live_id AND `user_id`=:user_id ORDER BY `difficulty`"
+            args["live_id"] = live_id
+        with begin() as conn:
+            return conn.execute(text(query), args).fetchall()
+
+    def load_ranking(self, live_id: int, difficulty: int, size: int) -> tuple:
+        args = {"live_id": live_id, "difficulty": difficulty, "limit": size}
+        with begin() as conn:
+            query = "SELECT `user_id`, `score` FROM `personal_best` WHERE `live_id`=:live_id AND `difficulty`=:difficulty ORDER BY `score` DESC, `user_id` LIMIT :limit"
+            rows = conn.execute(text(query), args).fetchall()
+            query = "SELECT `play_count`, `score_sum`, `max_score` FROM `live_score_stats` WHERE `live_id`=:live_id AND `difficulty`=:difficulty"
+            stats = conn.execute(text(query), args).first()
+        return rows, stats
+
+    def rebuild_ranking(self, batch_size: int) -> tuple[int, int]:
+        # 各シャードのアーカイブと、解散済みでまだアーカイブされていないルームを batch_size 行ずつ
+        # 読んで足し込むので、メモリに載るのは1バッチ分だけで済む
+        with begin() as conn:
+            conn.execute(text("DELETE FROM `personal_best`"))
+            conn.execute(text("DELETE FROM `live_score_stats`"))
+        plays = batches = 0
+        for shard in range(config.SHARDS):
+            for query in [_ARCHIVED_PLAYS, _DISSOLVED_PLAYS]:
+                for batch in _iter_plays(shard, query, batch_size):
+                    with begin() as conn:
+                        self._save_plays(conn, batch)
+                    plays += len(batch)
+                    batches += 1
+        return plays, batches
+
+
+def _get_user_by_token(conn, token: str):
+    # TODO: 実装
+    result = conn.execute(
+        text("SELECT `id`,`name`,`leader_card_id` FROM `user` WHERE `token`=:token"),
+        dict(token=token),
+    )
+    try:
+        return result.one()
+    except NoResultFound:
+        return None
+
+
+def _list_room_rows(
+    shard: int, live_id: int, limit: Optional[int], cursor: Optional[int]
+) -> list:
+    with begin(shard) as conn:
+        args = {
+            "status": int(WaitRoomStatus.Waiting),
+            "max_user_count": MAX_USER_COUNT,
+        }
+        query = "SELECT `id`,`live_id`,`joined_user_count` FROM `room` WHERE `status`=:status "
+        if live_id != 0:
+            query += "AND `live_id`=:live_id "
+            args["live_id"] = live_id
+        if cursor is not None:
+            query += "AND `id`>:cursor "
+            args["cursor"] = cursor
+        query += (
+            "AND `joined_user_count` BETWEEN 1 AND :max_user_count - 1 ORDER BY `id`"
+        )
+        if limit is not None:
+            query += " LIMIT :limit"
+            args["limit"] = limit
+        return conn.execute(text(query), args).fetchall()
+
+
+def _get_join_failure(conn, room_id: int) -> JoinRoomResult:
+    """入室できなかった理由を調べる"""
+    query = "SELECT `status`, `joined_user_count` FROM `room` WHERE `id`=:room_id"
+    row = conn.execute(text(query), {"room_id": room_id}).one_or_none()
+    if row is None or row.status == WaitRoomStatus.Dissolution:
+        return JoinRoomResult.Disbanded
+    if row.status != WaitRoomStatus.Waiting:
+        return JoinRoomResult.OtherError
+    if row.joined_user_count >= MAX_USER_COUNT:
+        return JoinRoomResult.RoomFull
+    return JoinRoomResult.OtherError
+
+
+def _read_room_rows(conn, room_id: int, version: Optional[int]):
+    if version is not None:
+        query = "SELECT `version` FROM `room` WHERE `id`=:room_id"
+        if conn.execute(text(query), {"room_id": room_id}).scalar() == version:
+            return None
+    return _load_room_rows(conn, room_id)
+
+
+def _end_shard_rooms(
+    shard: int, submissions: list[ScoreSubmission], timeout: int
+) -> list[int]:
+    """1つのシャードのスコアを書き込み、ライブ中だったルームの id を返す"""
+    with begin(shard) as conn:
+        _update_room_member_scores(conn, submissions)
+        query = "SELECT `id` FROM `room` WHERE `id` IN :room_ids AND `status`=:status"
+        result = conn.execute(
+            text(query).bindparams(bindparam("room_ids", expanding=True)),
+            {
+                "room_ids": list({s.room_id for s in submissions}),
+                "status": int(WaitRoomStatus.LiveStart),
+            },
+        )
+        started_room_ids = [row.id for row in result.fetchall()]
+        if started_room_ids:
+            _set_room_deadline(conn, started_room_ids, timeout)
+    return started_room_ids
+
+
+def _add_joined_user_count(conn, room_id: int, delta: int) -> None:
+    query = "UPDATE `room` SET `joined_user_count`=`joined_user_count`+:delta WHERE `id`=:room_id"
+    conn.execute(text(query), {"room_id": room_id, "delta": delta})
+
+
+def _bump_room_version(conn, room_id: int) -> None:
+    query = "UPDATE `room` SET `version`=`version`+1 WHERE `id`=:room_id"
+    conn.execute(text(query), {"room_id": room_id})
+
+
+def _load_room_rows(conn, room_id: int) -> list:
+    """ユーザーと同じシャード 0 のルームはプロフィールも JOIN して引く
+
+    他のシャードのルームはプロフィールを後で model がシャード 0 から引く。
+    """
+    if shard_of(room_id) == 0:
+        query = "SELECT `room`.`version`, `room`.`status`, `room`.`live_id`, `room`.`host_id`, `room_member`.`user_id`, `room_member`.`select_difficulty`, `user`.`name`, `user`.`leader_card_id` FROM `room` LEFT JOIN `room_member` ON `room_member`.`room_id`=`room`.`id` LEFT JOIN `user` ON `user`.`id`=`room_member`.`user_id` WHERE `room`.`id`=:room_id"
+    else:
+        query = "SELECT `room`.`version`, `room`.`status`, `room`.`live_id`, `room`.`host_id`, `room_member`.`user_id`, `room_member`.`select_difficulty` FROM `room` LEFT JOIN `room_member` ON `room_member`.`room_id`=`room`.`id` WHERE `room`.`id`=:room_id"
+    return conn.execute(text(query), {"room_id": room_id}).fetchall()
+
+
+def _load_live_rooms_rows(shard: int, limit: int) -> list:
+    with begin(shard) as conn:
+        query = "SELECT `id` FROM `room` WHERE `status`!=:status ORDER BY `id` DESC LIMIT :limit"
+        result = conn.execute(
+            text(query), {"status": int(WaitRoomStatus.Dissolution), "limit": limit}
+        )
+        room_ids = [row.id for row in result.fetchall()]
+        if not room_ids:
+            return []
+        query = "SELECT `room`.`id`, `room`.`version`, `room`.`status`, `room`.`live_id`, `room`.`host_id`, `room_member`.`user_id`, `room_member`.`select_difficulty` FROM `room` LEFT JOIN `room_member` ON `room_member`.`room_id`=`room`.`id` WHERE `room`.`id` IN :room_ids"
+        result = conn.execute(
+            text(query).bindparams(bindparam("room_ids", expanding=True)),
+            {"room_ids": room_ids},
+        )
+        return result.fetchall()
+
+
+def _count_shard_rooms(shard: int) -> list:
+    query = "SELECT `status`, `joined_user_count`, COUNT(*) AS `count` FROM `room` GROUP BY `status`, `joined_user_count`"
+    with begin(shard) as conn:
+        return conn.execute(text(query)).fetchall()
+
+
+def _insert_into_room_member(
+    conn, room_id: int, user_id: int, select_difficulty: LiveDifficulty
+) -> None:
+    query = "INSERT INTO `room_member` (room_id, user_id, select_difficulty) VALUES (:room_id, :user_id, :select_difficulty)"
+    conn.execute(
+        text(query),
+        {
+            "room_id": room_id,
+            "user_id": user_id,
+            "select_difficulty": int(select_difficulty),
+        },
+    )
+
+
+def _get_room_status(conn, room_id: int) -> Optional[WaitRoomStatus]:
+    query = "SELECT `status` FROM `room` WHERE `id`=:room_id"
+    result = conn.execute(text(query), {"room_id": room_id})
+    try:
+        return result.scalar()
+    except NoResultFound:
+        return None
+
+
+def _get_number_of_room_members(conn, room_id: int) -> int:
+    query = (
+        "SELECT COUNT(`room_id`) FROM `room_member` WHERE `room_id`=:room_id FOR UPDATE"
+    )
+    result = conn.execute(text(query), {"room_id": room_id})
+    return result.scalar()
+
+
+def _update_room_status(conn, room_id: int) -> None:
+    query = "UPDATE `room` SET `status`=:status WHERE `id`=:room_id"
+    conn.execute(
+        text(query), {"status": int(WaitRoomStatus.LiveStart), "room_id": room_id}
+    )
+
+
+def _update_room_member_scores(conn, submissions: list[ScoreSubmission]) -> None:
+    query = "UPDATE `room_member` SET `judge_perfect`=:judge_perfect, `judge_great`=:judge_great, `judge_good`=:judge_good, `judge_bad`=:judge_bad, `judge_miss`=:judge_miss, `score`=:score WHERE `room_id`=:room_id AND `user_id`=:user_id"
+    conn.execute(
+        text(query),
+        [
+            {
+                "room_id": s.room_id,
+                "user_id": s.user_id,
+                "judge_perfect": s.judge_count_list[0],
+                "judge_great": s.judge_count_list[1],
+                "judge_good": s.judge_count_list[2],
+                "judge_bad": s.judge_count_list[3],
+                "judge_miss": s.judge_count_list[4],
+                "score": s.score,
+            }
+            for s in submissions
+        ],
+    )
+
+
+def _set_room_deadline(conn, room_ids: list[int], timeout: int) -> None:
+    # 既に設定されている期限の方が早ければそちらを残す
+    query = "UPDATE `room` SET `deadline_at`=LEAST(COALESCE(`deadline_at`, NOW() + INTERVAL :timeout SECOND), NOW() + INTERVAL :timeout SECOND) WHERE `id` IN :room_ids"
+    conn.execute(
+        text(query).bindparams(bindparam("room_ids", expanding=True)),
+        {"room_ids": room_ids, "timeout": timeout},
+    )
+
+
+def _expire_rooms(conn, room_ids: list[int]) -> None:
+    _update_null_to_zero(conn, room_ids)
+    query = "UPDATE `room` SET `deadline_at`=NULL WHERE `id` IN :room_ids"
+    conn.execute(
+        text(query).bindparams(bindparam("room_ids", expanding=True)),
+        {"room_ids": room_ids},
+    )
+
+
+def _sweep_shard(shard: int) -> list[int]:
+    with begin(shard) as conn:
+        query = "SELECT `id` FROM `room` WHERE `deadline_at` <= NOW() ORDER BY `deadline_at` LIMIT :limit FOR UPDATE SKIP LOCKED"
+        result = conn.execute(text(query), {"limit": SWEEP_BATCH_SIZE})
+        room_ids = [row.id for row in result.fetchall()]
+        if room_ids:
+            _expire_rooms(conn, room_ids)
+    return room_ids
+
+
+def _reap_shard(
+    shard: int, ttls: list[tuple[WaitRoomStatus, int]], archive_delay: int
+) -> tuple[list[int], int, int, Optional[float]]:
+    expired_room_ids = []
+    for status, ttl in ttls:
+        for _ in range(REAP_MAX_BATCHES):
+            with begin(shard) as conn:
+                room_ids = _dissolve_idle_rooms(conn, status, ttl)
+            expired_room_ids += room_ids
+            if len(room_ids) < REAP_BATCH_SIZE:
+                break
+    archived_rooms = archived_members = 0
+    for _ in range(REAP_MAX_BATCHES):
+        with begin(shard) as conn:
+            rooms, members = _archive_dissolved_rooms(conn, archive_delay)
+        archived_rooms += rooms
+        archived_members += members
+        if rooms < REAP_BATCH_SIZE:
+            break
+    with begin(shard) as conn:
+        age = _get_oldest_live_room_age(conn)
+    return expired_room_ids, archived_rooms, archived_members, age
+
+
+def _dissolve_idle_rooms(conn, status: WaitRoomStatus, ttl: int) -> list[int]:
+    query = "SELECT `id` FROM `room` WHERE `status`=:status AND `created_at` <= NOW() - INTERVAL :ttl SECOND ORDER BY `created_at` LIMIT :limit FOR UPDATE SKIP LOCKED"
+    result = conn.execute(
+        text(query), {"status": int(status), "ttl": ttl, "limit": REAP_BATCH_SIZE}
+    )
+    room_ids = [row.id for row in result.fetchall()]
+    if room_ids:
+        query = "UPDATE `room` SET `status`=:status, `version`=`version`+1, `dissolved_at`=NOW() WHERE `id` IN :room_ids"
+        conn.execute(
+            text(query).bindparams(bindparam("room_ids", expanding=True)),
+            {"room_ids": room_ids, "status": int(WaitRoomStatus.Dissolution)},
+        )
+    return room_ids
+
+
+def _archive_dissolved_rooms(conn, delay: int) -> tuple[int, int]:
+    """解散から delay 秒経ったルームを1バッチ分アーカイブに移し、(ルーム数, メンバー数) を返す"""
+    query = "SELECT `id` FROM `room` WHERE `status`=:status AND `dissolved_at` <= NOW() - INTERVAL :delay SECOND ORDER BY `dissolved_at` LIMIT :limit FOR UPDATE SKIP LOCKED"
+    result = conn.execute(
+        text(query),
+        {
+            "status": int(WaitRoomStatus.Dissolution),
+            "delay": delay,
+            "limit": REAP_BATCH_SIZE,
+        },
+    )
+    room_ids = [row.id for row in result.fetchall()]
+    if not room_ids:
+        return 0, 0
+    args = {"room_ids": room_ids}
+    queries = [
+        "INSERT INTO `room_archive` (id, live_id, host_id, created_at, dissolved_at) SELECT `id`, `live_id`, `host_id`, `created_at`, `dissolved_at` FROM `room` WHERE `id` IN :room_ids",
+        "INSERT INTO `room_member_archive` (room_id, user_id, select_difficulty, judge_perfect, judge_great, judge_good, judge_bad, judge_miss, score) SELECT `room_id`, `user_id`, `select_difficulty`, `judge_perfect`, `judge_great`, `judge_good`, `judge_bad`, `judge_miss`, `score` FROM `room_member` WHERE `room_id` IN :room_ids",
+        "DELETE FROM `room_member` WHERE `room_id` IN :room_ids",
+        "DELETE FROM `room` WHERE `id` IN :room_ids",
+    ]
+    rowcounts = [
+        conn.execute(
+            text(query).bindparams(bindparam("room_ids", expanding=True)), args
+        ).rowcount
+        for query in queries
+    ]
+    return len(room_ids), rowcounts[1]
+
+
+def _get_oldest_live_room_age(conn) -> Optional[float]:
+    query = "SELECT MIN(`created_at`) AS `oldest`, NOW() AS `now` FROM `room` WHERE `status`!=:status"
+    row = conn.execute(text(query), {"status": int(WaitRoomStatus.Dissolution)}).one()
+    if row.oldest is None:
+        return None
+    return (_as_datetime(row.now) - _as_datetime(row.oldest)).total_seconds()
+
+
+def _as_datetime(value) -> datetime:
+    # SQLite は日時を文字列で返す
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _update_null_to_zero(conn, room_ids: list[int]):
+    query = "UPDATE `room_member` SET `judge_perfect`=:judge_perfect, `judge_great`=:judge_great, `judge_good`=:judge_good, `judge_bad`=:judge_bad, `judge_miss`=:judge_miss, `score`=:score WHERE `room_id` IN :room_ids AND `score` IS NULL"
+    conn.execute(
+        text(query).bindparams(bindparam("room_ids", expanding=True)),
+        {
+            "room_ids": room_ids,
+            "judge_perfect": 0,
+            "judge_great": 0,
+            "judge_good": 0,
+            "judge_bad": 0,
+            "judge_miss": 0,
+            "score": 0,
+        },
+    )
+
+
+def _get_result_rows(conn, room_id: int) -> list:
+    """全員のスコアが揃っているか期限切れなら、期限切れか (expired) を付けた結果の行を返す
+
+    期限切れのルームは未送信のスコアを0として扱う。
+    """
+    query = "SELECT `room_member`.`user_id`, COALESCE(`judge_perfect`, 0) AS `judge_perfect`, COALESCE(`judge_great`, 0) AS `judge_great`, COALESCE(`judge_good`, 0) AS `judge_good`, COALESCE(`judge_bad`, 0) AS `judge_bad`, COALESCE(`judge_miss`, 0) AS `judge_miss`, COALESCE(`score`, 0) AS `score`, COALESCE(`room`.`deadline_at` <= NOW(), 0) AS `expired` FROM `room` JOIN `room_member` ON `room_member`.`room_id`=`room`.`id` WHERE `room`.`id`=:room_id AND (`room`.`deadline_at` <= NOW() OR NOT EXISTS (SELECT 1 FROM `room_member` AS `unscored` WHERE `unscored`.`room_id`=`room`.`id` AND `unscored`.`score` IS NULL)) ORDER BY `room_member`.`user_id`"
+    return conn.execute(text(query), {"room_id": room_id}).fetchall()
+
+
+def _get_room_plays(conn, room_id: int) -> list:
+    query = "SELECT `room`.`live_id`, `room_member`.`select_difficulty` AS `difficulty`, `room_member`.`user_id`, `room_member`.`score` FROM `room` JOIN `room_member` ON `room_member`.`room_id`=`room`.`id` WHERE `room`.`id`=:room_id"
+    return conn.execute(text(query), {"room_id": room_id}).fetchall()
+
+
+def _dissolve_room(conn, room_id: int) -> bool:
+    """ルームを解散する。既に解散済みなら何もせず False を返す"""
+    query = "UPDATE `room` SET `status`=:status, `version`=`version`+1, `dissolved_at`=NOW() WHERE `id`=:room_id AND `status`!=:status"
+    result = conn.execute(
+        text(query), {"room_id": room_id, "status": int(WaitRoomStatus.Dissolution)}
+    )
+    return result.rowcount > 0
+
+
+def _delete_room_member(conn, room_id: int, user_id: int) -> bool:
+    """参加者を削除し、削除したかどうかを返す"""
+    query = "DELETE FROM `room_member` WHERE `room_id`=:room_id AND `user_id`=:user_id"
+    result = conn.execute(text(query), {"room_id": room_id, "user_id": user_id})
+    return result.rowcount == 1
+
+
+def _delete_room(conn, room_id: int) -> None:
+    query = "DELETE FROM `room` WHERE `id`=:room_id"
+    conn.execute(text(query), {"room_id": room_id})
+
+
+def _get_host_id(conn, room_id: int) -> int:
+    query = "SELECT `host_id` FROM `room` WHERE `id`=:room_id"
+    result = conn.execute(text(query), {"room_id": room_id})
+    return result.scalar()
+
+
+def _change_host(conn, room_id: int) -> None:
+    query = "SELECT `user_id` FROM `room_member` WHERE `room_id`=:room_id"
+    result = conn.execute(text(query), {"room_id": room_id})
+    row = result.first()
+    query = "UPDATE `room` SET `host_id`=:new_host WHERE `id`=:room_id"
+    conn.execute(text(query), {"new_host": row.user_id, "room_id": room_id})
+
+
+# (room_id, user_id) の順に読み進める。アーカイブ前のルームは解散済みのものだけを読む
+_ARCHIVED_PLAYS = "SELECT `r`.`live_id`, `m`.`select_difficulty`, `m`.`user_id`, `m`.`score`, `m`.`room_id` FROM `room_member_archive` AS `m` JOIN `room_archive` AS `r` ON `r`.`id`=`m`.`room_id` WHERE `m`.`score` IS NOT NULL AND (`m`.`room_id` > :room_id OR (`m`.`room_id`=:room_id AND `m`.`user_id` > :user_id)) ORDER BY `m`.`room_id`, `m`.`user_id` LIMIT :limit"
+_DISSOLVED_PLAYS = "SELECT `r`.`live_id`, `m`.`select_difficulty`, `m`.`user_id`, `m`.`score`, `m`.`room_id` FROM `room_member` AS `m` JOIN `room` AS `r` ON `r`.`id`=`m`.`room_id` WHERE `r`.`dissolved_at` IS NOT NULL AND `m`.`score` IS NOT NULL AND (`m`.`room_id` > :room_id OR (`m`.`room_id`=:room_id AND `m`.`user_id` > :user_id)) ORDER BY `m`.`room_id`, `m`.`user_id` LIMIT :limit"
+
+
+def _iter_plays(shard: int, query: str, batch_size: int) -> Iterable[list[tuple]]:
+    args = {"room_id": 0, "user_id": 0, "limit": batch_size}
+    while True:
+        with begin(shard) as conn:
+            rows = conn.execute(text(query), args).fetchall()
+        if not rows:
+            return
+        yield [tuple(row[:4]) for row in rows]
+        if len(rows) < batch_size:
+            return
+        args["room_id"], args["user_id"] = rows[-1].room_id, rows[-1].user_id
+
+
+# メモリ
+
+
+class UserRow(NamedTuple):
+    id: int
+    name: str
+    leader_card_id: int
+
+
+class RoomRow(NamedTuple):
+    version: int
+    status: int
+    live_id: int
+    host_id: int
+    user_id: Optional[int]
+    select_difficulty: Optional[int]
+    name: Optional[str]
+    leader_card_id: Optional[int]
+
+
+class LiveRoomRow(NamedTuple):
+    id: int
+    version: int
+    status: int
+    live_id: int
+    host_id: int
+    user_id: Optional[int]
+    select_difficulty: Optional[int]
+
+
+class RoomListRow(NamedTuple):
+    id: int
+    live_id: int
+    joined_user_count: int
+
+
+class ResultRow(NamedTuple):
+    user_id: int
+    judge_perfect: int
+    judge_great: int
+    judge_good: int
+    judge_bad: int
+    judge_miss: int
+    score: int
+
+
+class PlayRow(NamedTuple):
+    live_id: int
+    difficulty: int
+    user_id: int
+    score: int
+
+
+_ZERO_JUDGE_COUNTS = (0, 0, 0, 0, 0)
+
+
+class _Member:
+    __slots__ = ("select_difficulty", "judge_count_list", "score")
+
+    def __init__(self, select_difficulty: int):
+        self.select_difficulty = select_difficulty
+        self.judge_count_list: Optional[tuple[int, ...]] = None
+        self.score: Optional[int] = None
+
+
+class _Room:
+    """MemoryStorage のルーム1つ分。作った後は lock を持っている間だけ読み書きする"""
+
+    __slots__ = (
+        "id",
+        "live_id",
+        "host_id",
+        "status",
+        "version",
+        "members",
+        "created_at",
+        "deadline_at",
+        "dissolved_at",
+        "lock",
+    )
+
+    def __init__(self, room_id: int, live_id: int, host_id: int):
+        self.id = room_id
+        self.live_id = live_id
+        self.host_id = host_id
+        self.status = int(WaitRoomStatus.Waiting)
+        self.version = 0
+        self.members: dict[int, _Member] = {}  # user_id -> _Member
+        self.created_at = time.time()
+        self.deadline_at: Optional[float] = None
+        self.dissolved_at: Optional[float] = None
+        self.lock = threading.Lock()
+
+    def rows(self, users: dict[int, UserRow]) -> list[RoomRow]:
+        if not self.members:
+            return [
+                RoomRow(
+                    self.version,
+                    self.status,
+                    self.live_id,
+                    self.host_id,
+                    None,
+                    None,
+                    None,
+                    None,
+                )
+            ]
+        rows = []
+        for user_id in sorted(self.members):
+            user = users.get(user_id)
+            rows.append(
+                RoomRow(
+                    self.version,
+                    self.status,
+                    self.live_id,
+                    self.host_id,
+                    user_id,
+                    self.members[user_id].select_difficulty,
+                    None if user is None else user.name,
+                    None if user is None else user.leader_card_id,
+                )
+            )
+        return rows
+
+    def results(self) -> list[ResultRow]:
+        return [
+            ResultRow(
+                user_id,
+                *(member.judge_count_list or _ZERO_JUDGE_COUNTS),
+                member.score or 0,
+            )
+            for user_id, member in sorted(self.members.items())
+        ]
+
+    def plays(self, unscored_as_zero: bool = False) -> list[PlayRow]:
+        """スコアを送っていない参加者は unscored_as_zero なら0点として、そうでなければ除いて返す"""
+        return [
+            PlayRow(self.live_id, member.select_difficulty, user_id, member.score or 0)
+            for user_id, member in sorted(self.members.items())
+            if member.score is not None or unscored_as_zero
+        ]
+
+
+class MemoryStorage(Storage):
+    """プロセス内の dict に持つ
+
+    ルームは _Room ごとのロックで読み書きし、別のルームへの操作は互いに待たない。
+    ロックは ルーム → _rooms_lock・_users_lock の順に取り、_rooms_lock を持ったままルームのロックは取らない。
+    ユーザー・ランキングの行は NamedTuple を差し替えるので、ロック無しで読める。
+    """
+
+    def __init__(self):
+        self._users_lock = threading.Lock()
+        self._user_ids = itertools.count(1)
+        self._users: dict[int, UserRow] = {}
+        self._tokens: dict[str, int] = {}  # token -> user_id
+        self._user_rooms: dict[int, set[int]] = defaultdict(set)  # 参加中の room_id
+        self._rooms_lock = threading.Lock()
+        self._room_ids = itertools.count(1)
+        self._rooms: dict[int, _Room] = {}
+        self._waiting: dict[int, _Room] = {}  # 待機中のルーム (id 順)
+        self._deadlines: dict[int, _Room] = {}  # 期限のあるルーム
+        self._archive: list[_Room] = []  # アーカイブに移したルーム
+        self._ranking_lock = threading.Lock()
+        # user_id -> (live_id, difficulty) -> (score, play_count)
+        self._personal_bests: dict[int, dict[tuple[int, int], tuple[int, int]]] = (
+            defaultdict(dict)
+        )
+        # (live_id, difficulty) -> user_id -> score
+        self._scores: dict[tuple[int, int], dict[int, int]] = defaultdict(dict)
+        # (live_id, difficulty) -> (play_count, score_sum, max_score)
+        self._score_stats: dict[tuple[int, int], tuple[int, int, int]] = {}
+
+    @contextmanager
+    def _locked(self, room_id: int) -> Iterator[Optional[_Room]]:
+        """ルームのロックを取って渡す。ルームが無い (消された) なら None を渡す"""
+        room = self._rooms.get(room_id)
+        if room is None:
+            yield None
+            return
+        with room.lock:
+            yield room if self._rooms.get(room_id) is room else None
+
+    def _snapshot(self, rooms: dict[int, _Room]) -> list[_Room]:
+        with self._rooms_lock:
+            return list(rooms.values())
+
+    # ユーザー
+
+    def insert_users(self, users: list[tuple[str, int]], tokens: list[str]) -> None:
+        with self._users_lock:
+            if len(set(tokens)) < len(tokens) or any(t in self._tokens for t in tokens):
+                raise DuplicateToken()
+            for (name, leader_card_id), token in zip(users, tokens):
+                user_id = next(self._user_ids)
+                self._users[user_id] = UserRow(user_id, name, leader_card_id)
+                self._tokens[token] = user_id
+
+    def get_user_by_token(self, token: str) -> Optional[UserRow]:
+        user_id = self._tokens.get(token)
+        return None if user_id is None else self._users[user_id]
+
+    def get_users(self, user_ids: list[int]) -> list[UserRow]:
+        users = (self._users.get(user_id) for user_id in user_ids)
+        return [user for user in users if user is not None]
+
+    def update_user(
+        self, token: str, name: str, leader_card_id: int
+    ) -> Optional[UserRow]:
+        with self._users_lock:
+            user_id = self._tokens.get(token)
+            if user_id is None:
+                return None
+            user = self._users[user_id] = UserRow(user_id, name, leader_card_id)
+            return user
+
+    def bump_rooms_of_user(self, user_id: int) -> None:
+        with self._users_lock:
+            room_ids = list(self._user_rooms.get(user_id, ()))
+        for room_id in room_ids:
+            with self._locked(room_id) as room:
+                if room is not None:
+                    room.version += 1
+
+    def _add_member(self, room: _Room, user_id: int, select_difficulty: int) -> None:
+        room.members[user_id] = _Member(int(select_difficulty))
+        with self._users_lock:
+            self._user_rooms[user_id].add(room.id)
+
+    def _remove_member(self, room: _Room, user_id: int) -> bool:
+        if room.members.pop(user_id, None) is None:
+            return False
+        with self._users_lock:
+            self._forget_user_room(user_id, room.id)
+        return True
+
+    def _forget_user_room(self, user_id: int, room_id: int) -> None:
+        room_ids = self._user_rooms.get(user_id)
+        if room_ids is not None:
+            room_ids.discard(room_id)
+            if not room_ids:
+                del self._user_rooms[user_id]
+
+    # ルーム
+
+    def _add_room(self, room: _Room) -> None:
+        with self._rooms_lock:
+            self._rooms[room.id] = room
+            self._waiting[room.id] = room
+
+    def create_room(self, live_id: int, host_id: int) -> int:
+        room = _Room(next(self._room_ids), live_id, host_id)
+        self._add_room(room)
+        return room.id
+
+    def create_matched_room(
+        self, live_id: int, members: list[tuple[int, LiveDifficulty]]
+    ) -> tuple[int, list]:
+        # 全員入れてから他の呼び出しに見えるようにする
+        room = _Room(next(self._room_ids), live_id, members[0][0])
+        with room.lock:
+            for user_id, select_difficulty in members:
+                self._add_member(room, user_id, select_difficulty)
+            self._add_room(room)
+            return room.id, room.rows(self._users)
+
+    def list_rooms(
+        self, live_id: int, limit: Optional[int], cursor: Optional[int]
+    ) -> list[RoomListRow]:
+        # 人数はロックを取らずに読むので、読んでいる間の入退室は反映されないことがある
+        rows = []
+        for room in self._snapshot(self._waiting):
+            if live_id != 0 and room.live_id != live_id:
+                continue
+            if cursor is not None and room.id <= cursor:
+                continue
+            joined_user_count = len(room.members)
+            if 1 <= joined_user_count < MAX_USER_COUNT:
+                rows.append(RoomListRow(room.id, room.live_id, joined_user_count))
+                if limit is not None and len(rows) >= limit:
+                    break
+        return rows
+
+    def join_room(
+        self, room_id: int, user_id: int, select_difficulty: LiveDifficulty
+    ) -> tuple[JoinRoomResult, list]:
+        with self._locked(room_id) as room:
+            if room is None or room.status == WaitRoomStatus.Dissolution:
+                return JoinRoomResult.Disbanded, []
+            if room.status != WaitRoomStatus.Waiting:
+                return JoinRoomResult.OtherError, []
+            if len(room.members) >= MAX_USER_COUNT:
+                return JoinRoomResult.RoomFull, []
+            if user_id in room.members:
+                # SQL では room_member の主キーの重複で失敗する
+                return JoinRoomResult.OtherError, []
+            self._add_member(room, user_id, select_difficulty)
+            room.version += 1
+            return JoinRoomResult.Ok, room.rows(self._users)
+
+    def get_room_status(self, room_id: int) -> Optional[int]:
+        room = self._rooms.get(room_id)
+        return None if room is None else room.status
+
+    def get_room_rows(
+        self, room_id: int, version: Optional[int] = None
+    ) -> Optional[list[RoomRow]]:
+        with self._locked(room_id) as room:
+            if room is None:
+                return []
+            if room.version == version:
+                return None
+            return room.rows(self._users)
+
+    def get_live_id(self, room_id: int) -> Optional[int]:
+        room = self._rooms.get(room_id)
+        return None if room is None else room.live_id
+
+    def _set_deadline(self, room: _Room, timeout: int) -> None:
+        # 既に設定されている期限の方が早ければそちらを残す
+        deadline_at = time.time() + timeout
+        if room.deadline_at is None or deadline_at < room.deadline_at:
+            room.deadline_at = deadline_at
+        with self._rooms_lock:
+            self._deadlines[room.id] = room
+
+    def start_room(self, room_id: int, timeout: int) -> list[RoomRow]:
+        with self._locked(room_id) as room:
+            if room is None:
+                return []
+            room.status = int(WaitRoomStatus.LiveStart)
+            self._set_deadline(room, timeout)
+            room.version += 1
+            with self._rooms_lock:
+                self._waiting.pop(room_id, None)
+            return room.rows(self._users)
+
+    def end_rooms(self, submissions: list[ScoreSubmission], timeout: int) -> list[int]:
+        by_room = defaultdict(list)
+        for s in submissions:
+            by_room[s.room_id].append(s)
+        started_room_ids = []
+        for room_id, room_submissions in by_room.items():
+            with self._locked(room_id) as room:
+                if room is None:
+                    continue
+                for s in room_submissions:
+                    member = room.members.get(s.user_id)
+                    if member is not None:
+                        member.judge_count_list = tuple(s.judge_count_list)
+                        member.score = s.score
+                if room.status == WaitRoomStatus.LiveStart:
+                    self._set_deadline(room, timeout)
+                    started_room_ids.append(room_id)
+        return started_room_ids
+
+    def collect_results(self, room_id: int) -> RoomResults:
+        with self._locked(room_id) as room:
+            if room is None or not room.members:
+                return RoomResults([], False, [], False)
+            now = time.time()
+            expired = room.deadline_at is not None and room.deadline_at <= now
+            if not expired and any(m.score is None for m in room.members.values()):
+                return RoomResults([], False, [], False)
+            rows = room.results()
+            dissolved = room.status != WaitRoomStatus.Dissolution
+            plays = room.plays(unscored_as_zero=True) if dissolved else []
+            # 書き込めなければルームに手を付けずに失敗させる (SQL のロールバックと同じ)
+            if plays:
+                self._save_plays(plays)
+            if expired:
+                self._expire(room)
+            if dissolved:
+                self._dissolve(room, now)
+        return RoomResults(rows, dissolved, plays, bool(plays))
+
+    def leave_room(
+        self, room_id: int, user_id: int
+    ) -> Optional[tuple[bool, list[RoomRow]]]:
+        with self._locked(room_id) as room:
+            # 参加していないユーザーや2回目の退室で人数を減らさない
+            if room is None or not self._remove_member(room, user_id):
+                return None
+            if not room.members:
+                self._remove_room(room)
+                return True, []
+            if room.host_id == user_id:
+                room.host_id = min(room.members)
+            room.version += 1
+            return False, room.rows(self._users)
+
+    def _remove_room(self, room: _Room) -> None:
+        with self._rooms_lock:
+            del self._rooms[room.id]
+            self._waiting.pop(room.id, None)
+            self._deadlines.pop(room.id, None)
+
+    def _expire(self, room: _Room) -> None:
+        for member in room.members.values():
+            if member.score is None:
+                member.judge_count_list = _ZERO_JUDGE_COUNTS
+                member.score = 0
+        room.deadline_at = None
+        with self._rooms_lock:
+            self._deadlines.pop(room.id, None)
+
+    def _dissolve(self, room: _Room, now: float) -> None:
+        room.status = int(WaitRoomStatus.Dissolution)
+        room.version += 1
+        room.dissolved_at = now
+        with self._rooms_lock:
+            self._waiting.pop(room.id, None)
+
+    def expire_rooms(self, room_ids: list[int]) -> None:
+        for room_id in room_ids:
+            with self._locked(room_id) as room:
+                if room is not None:
+                    self._expire(room)
+
+    def sweep_expired_rooms(self) -> list[int]:
+        now = time.time()
+        room_ids = []
+        for candidate in self._snapshot(self._deadlines):
+            with self._locked(candidate.id) as room:
+                if room is None or room.deadline_at is None or room.deadline_at > now:
+                    continue
+                self._expire(room)
+                room_ids.append(room.id)
+        return room_ids
+
+    def reap_rooms(
+        self, ttls: list[tuple[WaitRoomStatus, int]], archive_delay: int
+    ) -> tuple[list[int], int, int, Optional[float]]:
+        now = time.time()
+        ttl_of = {int(status): ttl for status, ttl in ttls}
+        expired_room_ids = []
+        archived_rooms = archived_members = 0
+        oldest = None
+        for candidate in self._snapshot(self._rooms):
+            with self._locked(candidate.id) as room:
+                if room is None:
+                    continue
+                ttl = ttl_of.get(room.status)
+                if ttl is not None and room.created_at <= now - ttl:
+                    self._dissolve(room, now)
+                    expired_room_ids.append(room.id)
+                if room.status != WaitRoomStatus.Dissolution:
+                    if oldest is None or room.created_at < oldest:
+                        oldest = room.created_at
+                elif room.dissolved_at <= now - archive_delay:
+                    self._archive_room(room)
+                    archived_rooms += 1
+                    archived_members += len(room.members)
+        return (
+            expired_room_ids,
+            archived_rooms,
+            archived_members,
+            None if oldest is None else now - oldest,
+        )
+
+    def _archive_room(self, room: _Room) -> None:
+        # アーカイブしたルームの参加者は参加中として数えない
+        with self._users_lock:
+            for user_id in room.members:
+                self._forget_user_room(user_id, room.id)
+        self._remove_room(room)
+        with self._rooms_lock:
+            self._archive.append(room)
+
+    def count_rooms(self) -> list[tuple[int, int, int]]:
+        counts = Counter(
+            (room.status, len(room.members)) for room in self._snapshot(self._rooms)
+        )
+        return [(status, joined, count) for (status, joined), count in counts.items()]
+
+    def load_live_room_rows(self, limit: int) -> list[LiveRoomRow]:
+        rows = []
+        rooms = 0
+        for candidate in reversed(self._snapshot(self._rooms)):
+            if rooms >= limit:
+                break
+            with self._locked(candidate.id) as room:
+                if room is None or room.status == WaitRoomStatus.Dissolution:
+                    continue
+                rooms += 1
+                rows += [
+                    LiveRoomRow(room.id, *row[:6]) for row in room.rows(self._users)
+                ]
+        return rows
+
+    # ランキング
+
+    def save_plays(self, plays: list) -> None:
+        self._save_plays(plays)
+
+    def _save_plays(self, plays: list) -> None:
+        bests, stats = _aggregate_plays(plays)
+        with self._ranking_lock:
+            for (live_id, difficulty, user_id), (score, play_count) in bests.items():
+                user_bests = self._personal_bests[user_id]
+                best, count = user_bests.get((live_id, difficulty), (score, 0))
+                best = max(best, score)
+                user_bests[live_id, difficulty] = (best, count + play_count)
+                self._scores[live_id, difficulty][user_id] = best
+            for key, (play_count, score_sum, max_score) in stats.items():
+                count, total, best = self._score_stats.get(key, (0, 0, 0))
+                self._score_stats[key] = (
+                    count + play_count,
+                    total + score_sum,
+                    max(best, max_score),
+                )
+
+    def get_personal_bests(
+        self, user_id: int, live_id: Optional[int] = None
+    ) -> list[tuple[int, int, int, int]]:
+        with self._ranking_lock:
+            user_bests = sorted(self._personal_bests.get(user_id, {}).items())
+        return [
+            (key[0], key[1], score, play_count)
+            for key, (score, play_count) in user_bests
+            if live_id is None or key[0] == live_id
+        ]
+
+    def load_ranking(self, live_id: int, difficulty: int, size: int) -> tuple:
+        key = (live_id, difficulty)
+        with self._ranking_lock:
+            rows = heapq.nsmallest(
+                size,
+                self._scores.get(key, {}).items(),
+                key=lambda item: (-item[1], item[0]),
+            )
+            return rows, self._score_stats.get(key)
+
+    def rebuild_ranking(self, batch_size: int) -> tuple[int, int]:
+        with self._ranking_lock:
+            self._personal_bests.clear()
+            self._scores.clear()
+            self._score_stats.clear()
+        with self._rooms_lock:
+            archived = list(self._archive)
+        plays = [play for room in archived for play in room.plays()]
+        for candidate in self._snapshot(self._rooms):
+            with self._locked(candidate.id) as room:
+                if room is not None and room.dissolved_at is not None:
+                    plays += room.plays()
+        batches = 0
+        for start in range(0, len(plays), batch_size):
+            self._save_plays(plays[start : start + batch_size])
+            batches += 1
+        return len(plays), batches
+
+
+def create_storage() -> Storage:
+    if config.STORAGE == "memory":
+        return MemoryStorage()
+    return SQLStorage()
+
+
+storage = create_storage()
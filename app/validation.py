@@ -0,0 +1,83 @@
+"""/room/end で送られた判定数とスコアの検証
+
+楽曲ごとのノーツ数とスコアの理論値の表を起動時に LIVE_NOTES_PATH の CSV から読み込む。
+
+    live_id,note_count,max_score
+    1001,15,1000000
+
+どの楽曲も判定数とスコアが 0 以上 MAX_COLUMN_VALUE 以下であることを確かめ、
+表にある楽曲はさらに判定数の合計がノーツ数と一致し、スコアが理論値以下であることを確かめる。
+ファイルが無い・空のときは楽曲ごとの確認はしない。書式は conf/live_notes.sample.csv を参照。
+"""
+
+import csv
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from . import config
+
+# room_member の判定数・スコアの列 (int) に入る最大値
+MAX_COLUMN_VALUE = 2**31 - 1
+
+
+class LiveNotes(NamedTuple):
+    note_count: int
+    max_score: int
+
+
+class InvalidScore(Exception):
+    """ありえない判定数・スコア。reason はメトリクスのラベルに使う"""
+
+    def __init__(self, reason: str, detail: str):
+        super().__init__(detail)
+        self.reason = reason
+
+
+# live_id -> LiveNotes。load_live_notes() で丸ごと差し替える
+live_notes: dict[int, LiveNotes] = {}
+
+
+def load_live_notes(path: Optional[str] = None) -> int:
+    """ノーツ数の表を読み込み、楽曲数を返す。ファイルが無ければ空の表にする"""
+    global live_notes
+    path = Path(config.LIVE_NOTES_PATH if path is None else path)
+    table = {}
+    if path.exists():
+        with path.open(newline="") as f:
+            for row in csv.DictReader(f):
+                table[int(row["live_id"])] = LiveNotes(
+                    int(row["note_count"]), int(row["max_score"])
+                )
+    live_notes = table
+    return len(table)
+
+
+def check_score(
+    live_id: Optional[int], judge_count_list: list[int], score: int
+) -> None:
+    """ありえない組み合わせなら InvalidScore を投げる"""
+    if any(count < 0 for count in judge_count_list):
+        raise InvalidScore("negative_judge_count", "Judge counts must not be negative.")
+    if score < 0:
+        raise InvalidScore("negative_score", "Score must not be negative.")
+    if any(count > MAX_COLUMN_VALUE for count in judge_count_list):
+        raise InvalidScore(
+            "judge_count_too_large",
+            f"Judge counts must not exceed {MAX_COLUMN_VALUE}.",
+        )
+    if score > MAX_COLUMN_VALUE:
+        raise InvalidScore(
+            "score_too_large", f"Score must not exceed {MAX_COLUMN_VALUE}."
+        )
+    notes = live_notes.get(live_id)
+    if notes is None:
+        return
+    if sum(judge_count_list) != notes.note_count:
+        raise InvalidScore(
+            "note_count_mismatch",
+            f"The sum of judge_count_list must be {notes.note_count}.",
+        )
+    if score > notes.max_score:
+        raise InvalidScore(
+            "score_above_max", f"Score must not exceed {notes.max_score}."
+        )
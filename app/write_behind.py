@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Generic, TypeVar
+
+from .db import is_transient_error
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class WriteBehindQueue(Generic[T]):
+    """submit() された項目を溜めておき、まとめて flush に渡す
+
+    interval 秒ごと、または batch_size 件溜まった時点で書き出す。
+    溜まっている件数 (書き出し中を含む) が max_pending に達すると submit() は書き出しを待つので、
+    プロセスが落ちたときに失われうるのは高々 max_pending 件・interval 秒分になる。
+    retryable なエラー (接続断など) で失敗したバッチは先頭に戻し、interval から倍々に
+    max_backoff 秒まで間を空けて書き出し直す。同じバッチを何度か渡しうるので flush は冪等であること。
+    それ以外のエラーは項目の値のせいなので、やり直さずに1件ずつ書き出し直し、
+    それでも書けない項目は dead_letters に移して後続の項目を詰まらせない。
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[list[T]], None],
+        interval: float,
+        batch_size: int,
+        max_pending: int,
+        max_backoff: float = 30.0,
+        stop_retries: int = 3,
+        retryable: Callable[[Exception], bool] = is_transient_error,
+        max_dead_letters: int = 1000,
+    ):
+        self._flush = flush
+        self._interval = interval
+        self._batch_size = batch_size
+        self._max_pending = max_pending
+        self._max_backoff = max_backoff
+        self._stop_retries = stop_retries
+        self._retryable = retryable
+        self._cond = threading.Condition()
+        self._items: list[T] = []
+        self._writing = 0  # 書き出し中の件数
+        self._stopped = False
+        self._thread = None
+        self.batches = 0  # 書き出した回数
+        self.flushed = 0  # 書き出した件数
+        self.failures = 0  # 続けて失敗した回数
+        self.dropped = 0  # 書き出せずに捨てた件数
+        # 書き出せずに捨てた項目 (新しい方から max_dead_letters 件)
+        self.dead_letters: deque[T] = deque(maxlen=max_dead_letters)
+
+    @property
+    def pending(self) -> int:
+        return len(self._items) + self._writing
+
+    def submit(self, item: T) -> None:
+        with self._cond:
+            while self.pending >= self._max_pending and not self._stopped:
+                self._cond.wait()
+            self._items.append(item)
+            if self._thread is None and not self._stopped:
+                self._thread = threading.Thread(
+                    target=self._run, name="write-behind", daemon=True
+                )
+                self._thread.start()
+            if len(self._items) >= self._batch_size:
+                self._cond.notify_all()
+        if self._stopped:
+            self.flush()
+
+    def flush(self) -> bool:
+        """溜まっている項目を全て書き出す。やり直せる失敗ならその分を先頭に戻して False を返す"""
+        while True:
+            with self._cond:
+                batch = self._items[: self._batch_size]
+                del self._items[: self._batch_size]
+                self._writing += len(batch)
+            if not batch:
+                return True
+            if not self._write(batch):
+                return False
+
+    def stop(self) -> None:
+        """ワーカーを止め、残りを書き出す。失敗したら stop_retries 回まで書き出し直す"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        for _ in range(self._stop_retries):
+            if self.flush():
+                return
+            time.sleep(self._backoff())
+        if not self.flush():
+            logger.error(
+                "write-behind: gave up flushing %d items on stop", self.pending
+            )
+
+    def _backoff(self) -> float:
+        return min(self._interval * 2 ** max(self.failures - 1, 0), self._max_backoff)
+
+    def _write(self, batch: list[T]) -> bool:
+        retry = self._write_items(batch)
+        with self._cond:
+            if retry:
+                # 受け付け済みの項目なので捨てずに先頭に戻す
+                self._items[:0] = retry
+                self.failures += 1
+            else:
+                self.failures = 0
+            self._writing -= len(batch)
+            self._cond.notify_all()
+        return not retry
+
+    def _write_items(self, items: list[T]) -> list[T]:
+        """items を書き出し、retryable なエラーで書き出せなかった項目を返す"""
+        try:
+            self._flush(items)
+        except Exception as e:
+            if self._retryable(e):
+                logger.exception("write-behind: failed to flush %d items", len(items))
+                return items
+            if len(items) == 1:
+                logger.exception("write-behind: dropped %r", items[0])
+                self.dead_letters.append(items[0])
+                self.dropped += 1
+                return []
+            logger.exception(
+                "write-behind: failed to flush %d items, retrying one by one",
+                len(items),
+            )
+        else:
+            self.batches += 1
+            self.flushed += len(items)
+            return []
+        for i, item in enumerate(items):
+            if self._write_items([item]):
+                return items[i:]
+        return []
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if self.failures:
+                    # submit() の通知では起きずに、間を空けてから書き出し直す
+                    deadline = time.monotonic() + self._backoff()
+                    while not self._stopped and time.monotonic() < deadline:
+                        self._cond.wait(deadline - time.monotonic())
+                elif len(self._items) < self._batch_size and not self._stopped:
+                    self._cond.wait(self._interval)
+                if self._stopped:
+                    return
+            self.flush()
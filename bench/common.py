@@ -0,0 +1,102 @@
+"""ベンチマーク共通のヘルパー
+
+MySQL に schema.sql を流した状態で ``python -m bench.<name>`` として実行する。
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+import httpx
+
+
+@contextmanager
+def server(
+    port: int = 8100, env: Optional[dict] = None, workers: int = 1, serve: bool = False
+):
+    """uvicorn を別プロセスで起動し、応答するようになったら base_url を返す
+
+    serve=True なら本番用の python -m app.serve で起動する。
+    """
+    command = (
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "app.api:app",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+            "--no-access-log",
+        ]
+        if not serve
+        else [
+            sys.executable,
+            "-m",
+            "app.serve",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+        ]
+    )
+    proc = subprocess.Popen(command, env={**os.environ, **(env or {})})
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        # ワーカーがプールとキャッシュを温め終わるまで待つ
+        for _ in range(300):
+            try:
+                httpx.get(base_url + "/")
+                break
+            except httpx.TransportError:
+                time.sleep(0.1)
+        yield base_url
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def auth_header(token: str) -> dict:
+    return {"Authorization": f"bearer {token}"}
+
+
+def create_users(client: httpx.Client, n: int, prefix: str = "bench") -> list[str]:
+    tokens = []
+    for i in range(n):
+        response = client.post(
+            "/user/create", json={"user_name": f"{prefix}_{i}", "leader_card_id": 1000}
+        )
+        tokens.append(response.json()["user_token"])
+    return tokens
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summarize(latencies: list[float], elapsed: float) -> dict:
+    """レイテンシ(秒)の一覧からスループットとパーセンタイル(ms)をまとめる"""
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def emit(name: str, result: dict) -> None:
+    """1行1レコードの JSON で結果を出力する"""
+    print(json.dumps({"bench": name, **result}, ensure_ascii=False), flush=True)
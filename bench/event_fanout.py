@@ -0,0 +1,71 @@
+"""イベントバスの fan-out レイテンシ
+
+多数のルームに待ち受けを張った状態で全ルームにイベントを publish し、
+publish から待ち受けが起きるまでの時間を測る。
+
+    python -m bench.event_fanout --rooms 5000
+    EVENT_BUS=mysql python -m bench.event_fanout --rooms 5000
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+
+from app import config
+from app.events import RoomEvent, RoomEventType, event_bus
+from app.notify import room_hub
+
+from .common import emit, summarize
+
+
+async def _listen(room_id: int, ready: asyncio.Event, sent_at: dict, latencies):
+    async with room_hub.listen(room_id) as listener:
+        ready.set()
+        while room_id not in sent_at:
+            await listener.wait(30)
+        latencies.append(time.perf_counter() - sent_at[room_id])
+
+
+def _publish(room_ids: list[int], sent_at: dict) -> None:
+    for room_id in room_ids:
+        sent_at[room_id] = time.perf_counter()
+        event_bus.publish(RoomEvent(room_id, RoomEventType.Started))
+
+
+async def _run(rooms: int) -> dict:
+    # 既存のルームと被らないように大きな id を使う
+    room_ids = list(range(10**12, 10**12 + rooms))
+    sent_at: dict[int, float] = {}
+    latencies: list[float] = []
+    readies = [asyncio.Event() for _ in room_ids]
+    tasks = [
+        asyncio.create_task(_listen(room_id, ready, sent_at, latencies))
+        for room_id, ready in zip(room_ids, readies)
+    ]
+    await asyncio.gather(*(ready.wait() for ready in readies))
+
+    start = time.perf_counter()
+    # モデル関数と同じくイベントループ外のスレッドから publish する
+    publisher = threading.Thread(target=_publish, args=(room_ids, sent_at))
+    publisher.start()
+    await asyncio.gather(*tasks)
+    publisher.join()
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rooms", type=int, default=5000)
+    args = parser.parse_args()
+
+    event_bus.start()
+    try:
+        result = asyncio.run(_run(args.rooms))
+    finally:
+        event_bus.stop()
+    emit("event_fanout", {"backend": config.EVENT_BUS, "rooms": args.rooms, **result})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""1つのルームに N 人が同時に入室しようとしたときの比較
+
+変更前の SELECT ... FOR UPDATE による入室と、条件付き UPDATE 1文による入室を比べる。
+
+    python -m bench.join_contention --joiners 64 --rounds 50
+"""
+
+import argparse
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+
+from app import model, storage
+from app.db import begin
+from app.model import MAX_USER_COUNT, JoinRoomResult, LiveDifficulty, WaitRoomStatus
+
+from .common import emit, summarize
+
+
+def _legacy_join(room_id: int, user_id: int, select_difficulty: LiveDifficulty):
+    """変更前の join_room と同じ文を発行する"""
+    try:
+        with begin() as conn:
+            query = "SELECT * FROM `room` WHERE `id`=:room_id FOR UPDATE"
+            conn.execute(text(query), {"room_id": room_id})
+            status = storage._get_room_status(conn, room_id)
+            if status != WaitRoomStatus.Waiting:
+                return JoinRoomResult.OtherError
+            if storage._get_number_of_room_members(conn, room_id) >= MAX_USER_COUNT:
+                return JoinRoomResult.RoomFull
+            storage._insert_into_room_member(conn, room_id, user_id, select_difficulty)
+            query = "UPDATE `room` SET `joined_user_count`=`joined_user_count`+1, `version`=`version`+1 WHERE `id`=:room_id"
+            conn.execute(text(query), {"room_id": room_id})
+    except Exception:
+        return JoinRoomResult.OtherError
+    return JoinRoomResult.Ok
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--joiners", type=int, default=64)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    user_ids = []
+    for i in range(args.joiners + 1):
+        token = model.create_user(f"bench_join_{i}", 1000)
+        user_ids.append(model.get_user_by_token(token).id)
+    host_id, joiner_ids = user_ids[0], user_ids[1:]
+
+    with ThreadPoolExecutor(args.joiners) as executor:
+        for name, join in [("for_update", _legacy_join), ("atomic", model.join_room)]:
+            latencies = []
+            results = Counter()
+            start = time.perf_counter()
+            for _ in range(args.rounds):
+                room_id = model.create_room(1, host_id)
+                model.join_room(room_id, host_id, LiveDifficulty.normal)
+                futures = [
+                    executor.submit(_timed, join, room_id, user_id, LiveDifficulty.hard)
+                    for user_id in joiner_ids
+                ]
+                round_results = [future.result() for future in futures]
+                oks = sum(r == JoinRoomResult.Ok for r, _ in round_results)
+                assert oks == MAX_USER_COUNT - 1, f"{name}: {oks} joined"
+                for result, latency in round_results:
+                    results[JoinRoomResult(result).name] += 1
+                    latencies.append(latency)
+            emit(
+                "join_contention",
+                {
+                    "path": name,
+                    "joiners": args.joiners,
+                    "results": dict(results),
+                    **summarize(latencies, time.perf_counter() - start),
+                },
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""ルームの一連の流れを仮想プレイヤーで再現する負荷試験
+
+プレイヤーを room_size 人ずつのグループに分け、グループごとに
+create → list → join → wait をポーリング → start → end → result をポーリング → leave
+を rounds 回繰り返す。エンドポイントごとのスループット、p50/p95/p99、
+1リクエストあたりのクエリ数 (X-DB-Queries) を出力する。
+--base-url を渡さないときは DB_QUERY_STATS=1 でサーバーを起動する。
+
+    python -m bench.lifecycle --players 400 --room-size 4 --output run.json
+
+--record で送ったリクエストを JSON Lines に記録し、--replay で同じ時間間隔のまま再送できる。
+記録の1行は {"t": 開始からの秒, "method", "path", "user": プレイヤー番号, "json", "room_id"} で、
+room_id は /room/create の応答。再送時はルームIDを作り直したものに読み替える。
+
+--baseline に以前の --output を渡すと p99 を比べ、threshold 倍を超えて遅くなった
+エンドポイントがあれば終了コード 1 で終わる。
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import defaultdict
+from typing import Optional
+
+import httpx
+
+from .common import auth_header, create_users, emit, server, summarize
+
+# サーバーのコードを読み込まずに動かせるよう、値は app.model の enum から写しておく
+DIFFICULTY_NORMAL = 1  # LiveDifficulty.normal
+STATUS_WAITING = 1  # WaitRoomStatus.Waiting
+JOIN_OK = 1  # JoinRoomResult.Ok
+
+
+class Recorder:
+    """エンドポイントごとのレイテンシとクエリ数を集計し、必要なら記録する"""
+
+    def __init__(self, client: httpx.AsyncClient, tokens: list[str], record=None):
+        self.client = client
+        self.tokens = tokens
+        self.latencies: defaultdict[str, list[float]] = defaultdict(list)
+        self.queries: defaultdict[str, int] = defaultdict(int)
+        self.errors: defaultdict[str, int] = defaultdict(int)
+        self._record = record
+        self._start = time.perf_counter()
+
+    async def call(
+        self,
+        path: str,
+        user: Optional[int] = None,
+        body: Optional[dict] = None,
+        method: str = "POST",
+    ) -> httpx.Response:
+        headers = auth_header(self.tokens[user]) if user is not None else None
+        start = time.perf_counter()
+        response = await self.client.request(method, path, json=body, headers=headers)
+        self.latencies[path].append(time.perf_counter() - start)
+        self.queries[path] += int(response.headers.get("X-DB-Queries", 0))
+        if response.status_code != 200:
+            self.errors[path] += 1
+        if self._record is not None:
+            entry = {"t": start - self._start, "method": method, "path": path}
+            entry.update(user=user, json=body)
+            if path == "/room/create" and response.status_code == 200:
+                entry["room_id"] = response.json()["room_id"]
+            self._record.write(json.dumps(entry) + "\n")
+        return response
+
+    def result(self, elapsed: float) -> dict:
+        endpoints = {}
+        for path, latencies in sorted(self.latencies.items()):
+            summary = summarize(latencies, elapsed)
+            summary["errors"] = self.errors[path]
+            summary["queries_per_request"] = round(
+                self.queries[path] / len(latencies), 2
+            )
+            endpoints[path] = summary
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            "elapsed": round(elapsed, 3),
+            "requests": total,
+            "rps": round(total / elapsed, 1) if elapsed else 0.0,
+            "queries": sum(self.queries.values()),
+            "endpoints": endpoints,
+        }
+
+
+async def _poll(
+    rec: Recorder,
+    path: str,
+    user: int,
+    body: dict,
+    done,
+    interval: float,
+    timeout: float = float("inf"),
+) -> None:
+    deadline = time.perf_counter() + timeout
+    while True:
+        response = await rec.call(path, user, body)
+        if response.status_code == 200 and done(response.json()):
+            return
+        if time.perf_counter() >= deadline:
+            return
+        await asyncio.sleep(interval)
+
+
+async def _play(rec: Recorder, users: list[int], live_id: int, args) -> None:
+    host, *guests = users
+    difficulty = DIFFICULTY_NORMAL
+    response = await rec.call(
+        "/room/create", host, {"live_id": live_id, "select_difficulty": difficulty}
+    )
+    room_id = response.json()["room_id"]
+    room = {"room_id": room_id}
+
+    async def player(user: int) -> None:
+        if user == host:
+            await _poll(
+                rec,
+                "/room/wait",
+                user,
+                room,
+                lambda r: len(r["room_user_list"]) == len(users),
+                args.poll_interval,
+                # 入れなかった人がいても wait_timeout 秒で揃った人だけで始める
+                args.wait_timeout,
+            )
+            await rec.call("/room/start", user, room)
+        else:
+            await rec.call("/room/list", user, {"live_id": live_id})
+            response = await rec.call(
+                "/room/join", user, {**room, "select_difficulty": difficulty}
+            )
+            if response.json().get("join_room_result") != JOIN_OK:
+                return
+            await _poll(
+                rec,
+                "/room/wait",
+                user,
+                room,
+                lambda r: r["status"] != STATUS_WAITING,
+                args.poll_interval,
+            )
+        await asyncio.sleep(args.play_time)
+        await rec.call(
+            "/room/end",
+            user,
+            {**room, "judge_count_list": [50, 10, 5, 2, 1], "score": 100000 + user},
+        )
+        await _poll(
+            rec,
+            "/room/result",
+            user,
+            room,
+            lambda r: len(r["result_user_list"]) > 0,
+            args.poll_interval,
+        )
+        await rec.call("/room/leave", user, room)
+
+    await asyncio.gather(*(player(user) for user in users))
+
+
+async def _run_lifecycle(rec: Recorder, args) -> None:
+    groups = [
+        list(range(i, i + args.room_size))
+        for i in range(0, args.players - args.room_size + 1, args.room_size)
+    ]
+
+    async def group(index: int, users: list[int]) -> None:
+        for _ in range(args.rounds):
+            await _play(rec, users, args.live_id + index % args.lives, args)
+
+    await asyncio.gather(*(group(i, users) for i, users in enumerate(groups)))
+
+
+async def _run_replay(rec: Recorder, entries: list[dict], speed: float) -> None:
+    room_ids: defaultdict[int, asyncio.Future] = defaultdict(
+        lambda: asyncio.get_running_loop().create_future()
+    )
+
+    async def send(entry: dict) -> None:
+        await asyncio.sleep(entry["t"] / speed)
+        body = entry["json"]
+        if body is not None and "room_id" in body:
+            # 記録時のルームIDを、再送で作られたルームのIDに読み替える
+            body = {**body, "room_id": await room_ids[body["room_id"]]}
+        response = await rec.call(entry["path"], entry["user"], body, entry["method"])
+        if "room_id" in entry and not room_ids[entry["room_id"]].done():
+            room_ids[entry["room_id"]].set_result(response.json()["room_id"])
+
+    await asyncio.gather(*(send(entry) for entry in entries))
+
+
+async def _run(base_url: str, tokens: list[str], args, entries) -> dict:
+    limits = httpx.Limits(max_connections=args.connections)
+    record = open(args.record, "w") if args.record else None
+    try:
+        async with httpx.AsyncClient(
+            base_url=base_url, limits=limits, timeout=60
+        ) as client:
+            rec = Recorder(client, tokens, record)
+            start = time.perf_counter()
+            if entries is None:
+                await _run_lifecycle(rec, args)
+            else:
+                await _run_replay(rec, entries, args.speed)
+            return rec.result(time.perf_counter() - start)
+    finally:
+        if record is not None:
+            record.close()
+
+
+def compare(result: dict, baseline: dict, threshold: float) -> list[str]:
+    """baseline より p99 が threshold 倍を超えて悪化したエンドポイント"""
+    regressions = []
+    for path, current in result["endpoints"].items():
+        before = baseline["endpoints"].get(path)
+        if (
+            before
+            and before["p99_ms"]
+            and current["p99_ms"] > before["p99_ms"] * threshold
+        ):
+            regressions.append(path)
+        if before:
+            emit(
+                "lifecycle_compare",
+                {
+                    "path": path,
+                    "baseline_p99_ms": before["p99_ms"],
+                    "p99_ms": current["p99_ms"],
+                    "baseline_queries_per_request": before["queries_per_request"],
+                    "queries_per_request": current["queries_per_request"],
+                },
+            )
+    return regressions
+
+
+def run(base_url: str, args, entries: Optional[list[dict]] = None) -> dict:
+    """ユーザーを作ってから負荷をかけ、結果をまとめる"""
+    players = args.players
+    if entries is not None:
+        players = 1 + max(e["user"] for e in entries if e["user"] is not None)
+    with httpx.Client(base_url=base_url) as client:
+        tokens = create_users(client, players, prefix="bench_lifecycle")
+    result = asyncio.run(_run(base_url, tokens, args, entries))
+    return {"mode": "replay" if entries else "lifecycle", **result}
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--players", type=int, default=400)
+    parser.add_argument("--room-size", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--play-time", type=float, default=0.0)
+    parser.add_argument("--wait-timeout", type=float, default=10.0)
+    parser.add_argument("--live-id", type=int, default=2000)
+    parser.add_argument("--lives", type=int, default=100, help="使う楽曲の種類数")
+    parser.add_argument("--connections", type=int, default=256)
+    parser.add_argument("--base-url", help="省略時はサーバーを起動する")
+    parser.add_argument("--record", help="送ったリクエストを記録するファイル")
+    parser.add_argument("--replay", help="--record で記録したファイル")
+    parser.add_argument("--speed", type=float, default=1.0, help="再送の速度倍率")
+    parser.add_argument("--output", help="結果を JSON で書き出すファイル")
+    parser.add_argument("--baseline", help="比較する以前の --output")
+    parser.add_argument("--threshold", type=float, default=1.2)
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+
+    entries = None
+    if args.replay:
+        with open(args.replay) as f:
+            entries = [json.loads(line) for line in f]
+
+    if args.base_url:
+        result = run(args.base_url, args, entries)
+    else:
+        with server(env={"DB_QUERY_STATS": "1"}) as base_url:
+            result = run(base_url, args, entries)
+
+    for path, summary in result["endpoints"].items():
+        emit("lifecycle", {"path": path, **summary})
+    emit("lifecycle", {k: v for k, v in result.items() if k != "endpoints"})
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), **result}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.threshold)
+        if regressions:
+            print(f"p99 regressed: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
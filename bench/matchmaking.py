@@ -0,0 +1,85 @@
+"""自動マッチングの待ち時間とルームあたりの書き込み数
+
+到着レートごとに、マッチするまでの時間とルーム1つあたりの INSERT/UPDATE 文の数を測る。
+
+    python -m bench.matchmaking --rates 10,100,1000 --duration 10
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from sqlalchemy import event
+
+from app import model
+from app.db import engine
+from app.matchmaker import Matchmaker
+from app.model import LiveDifficulty
+
+from .common import emit, summarize
+
+
+class WriteCounter:
+    def __init__(self):
+        self.writes = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith(("INSERT", "UPDATE", "DELETE")):
+            self.writes += 1
+
+
+async def _player(matchmaker: Matchmaker, user_id: int, latencies: list[float]):
+    difficulty = random.choice(list(LiveDifficulty))
+    start = time.perf_counter()
+    room_id = await matchmaker.matchmake(user_id, 1, difficulty, timeout=30)
+    if room_id is not None:
+        latencies.append(time.perf_counter() - start)
+
+
+async def _run(rate: float, duration: float, user_ids: list[int], counter) -> dict:
+    matchmaker = Matchmaker()
+    matchmaker.start()
+    latencies: list[float] = []
+    players = []
+    counter.writes = 0
+    start = time.perf_counter()
+    for user_id in user_ids[: int(rate * duration)]:
+        players.append(asyncio.create_task(_player(matchmaker, user_id, latencies)))
+        await asyncio.sleep(1 / rate)
+    await asyncio.gather(*players)
+    await matchmaker.stop()
+    elapsed = time.perf_counter() - start
+    rooms = matchmaker.rooms_created
+    result = summarize(latencies, elapsed)
+    return {
+        "rate": rate,
+        "matched": result["requests"],
+        "rooms": rooms,
+        "writes_per_room": round(counter.writes / rooms, 2) if rooms else 0.0,
+        "time_to_match_p50_ms": result["p50_ms"],
+        "time_to_match_p99_ms": result["p99_ms"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rates", default="10,100,1000")
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+
+    rates = [float(rate) for rate in args.rates.split(",")]
+    n = int(max(rates) * args.duration)
+    user_ids = []
+    for i in range(n):
+        token = model.create_user(f"bench_match_{i}", 1000)
+        user_ids.append(model.get_user_by_token(token).id)
+
+    counter = WriteCounter()
+    for rate in rates:
+        emit("matchmaking", asyncio.run(_run(rate, args.duration, user_ids, counter)))
+
+
+if __name__ == "__main__":
+    main()
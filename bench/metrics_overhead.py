@@ -0,0 +1,211 @@
+"""メトリクス記録のオーバーヘッド
+
+ルートのハンドラを包んで記録する処理 (api.instrument_handler) を、何もしないハンドラに
+付けた場合と付けない場合で呼び比べ、1リクエストあたりの増分を測る。
+目標スループットで1コアのうち記録に使う割合が --budget (%) を超えたら終了コード 1 で終わる。
+
+参考として、uvicorn が渡すのと同じ ASGI メッセージでアプリ全体 (ルーティング・検証・ハンドラ) を
+プロセス内から呼び、記録なし (none)・既定 (metrics)・DB_QUERY_STATS=1 相当 (query_stats) の
+1リクエストあたりの時間も出す。こちらは揺らぎが記録の増分より大きいので判定には使わない。
+
+    python -m bench.metrics_overhead --rps 5000 --budget 1
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from fastapi.routing import APIRoute
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import request_response
+
+from app import api
+
+from .common import emit
+
+REQUESTS = [
+    ("GET", "/", None),
+    ("POST", "/room/list", {"live_id": 1}),
+]
+
+
+def _best(variants: dict, measure, rounds: int) -> dict[str, float]:
+    """variant ごとの1回あたりの時間。揺らぎを除くため variant を交互に回して最小を取る"""
+    best = {name: float("inf") for name in variants}
+    for _ in range(rounds):
+        for name, variant in variants.items():
+            best[name] = min(best[name], measure(variant))
+    return best
+
+
+# 記録処理だけの増分
+
+
+def _instrumentation(args) -> dict[str, float]:
+    response = Response(b"")
+
+    async def handler(request):
+        return response
+
+    request = Request({"type": "http", "method": "GET", "path": "/", "headers": []})
+
+    async def call(fn) -> float:
+        start = time.perf_counter()
+        for _ in range(args.calls):
+            await fn(request)
+        return (time.perf_counter() - start) / args.calls
+
+    variants = {
+        "none": handler,
+        "metrics": api.instrument_handler(handler, "/bench"),
+    }
+    return _best(variants, lambda fn: asyncio.run(call(fn)), args.rounds)
+
+
+# アプリ全体
+
+
+def _apps() -> dict:
+    """variant ごとの (ルートの ASGI アプリ, ミドルウェアを組んだ ASGI アプリ)"""
+    routes = [route for route in api.app.routes if isinstance(route, APIRoute)]
+    instrumented = [(route, route.app) for route in routes]
+    plain = [
+        (route, request_response(APIRoute.get_route_handler(route))) for route in routes
+    ]
+    app = api.app
+    original = app.user_middleware
+    try:
+        app.user_middleware = [
+            m for m in original if m.cls is not api.QueryStatsMiddleware
+        ]
+        stack = app.build_middleware_stack()
+        app.user_middleware = app.user_middleware + [
+            Middleware(api.QueryStatsMiddleware)
+        ]
+        query_stats_stack = app.build_middleware_stack()
+    finally:
+        app.user_middleware = original
+    return {
+        "none": (plain, stack),
+        "metrics": (instrumented, stack),
+        "query_stats": (instrumented, query_stats_stack),
+    }
+
+
+async def _request(asgi_app, method: str, path: str, body: bytes) -> int:
+    """サーバーが受け取るのと同じ ASGI メッセージで1リクエストを処理し、ステータスを返す"""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [
+            (b"host", b"bench"),
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+        "client": ("127.0.0.1", 10000),
+        "server": ("127.0.0.1", 8000),
+    }
+    status = 0
+    received = False
+
+    async def receive():
+        nonlocal received
+        if received:
+            # 本文を渡した後はクライアントが切断するまで待つ
+            await asyncio.Event().wait()
+        received = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await asgi_app(scope, receive, send)
+    return status
+
+
+async def _measure(variant, method: str, path: str, body, iterations: int) -> float:
+    route_apps, asgi_app = variant
+    for route, route_app in route_apps:
+        route.app = route_app
+    body = b"" if body is None else json.dumps(body).encode()
+    for _ in range(100):
+        assert await _request(asgi_app, method, path, body) == 200
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await _request(asgi_app, method, path, body)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rps", type=float, default=5000)
+    parser.add_argument("--budget", type=float, default=1.0)  # 1コアに対する %
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    elapsed = _instrumentation(args)
+    overhead = elapsed["metrics"] - elapsed["none"]
+    overhead_percent = overhead * args.rps * 100
+    emit(
+        "metrics_overhead",
+        {
+            "path": "instrument_handler",
+            "overhead_us": round(overhead * 1e6, 2),
+            "overhead_percent_at_rps": round(overhead_percent, 2),
+            "budget_percent": args.budget,
+        },
+    )
+
+    variants = _apps()
+    originals = variants["metrics"][0]
+    try:
+        for method, path, body in REQUESTS:
+            elapsed = _best(
+                variants,
+                lambda variant: asyncio.run(
+                    _measure(variant, method, path, body, args.iterations)
+                ),
+                args.rounds,
+            )
+            for name in ["metrics", "query_stats"]:
+                emit(
+                    "metrics_overhead",
+                    {
+                        "path": path,
+                        "variant": name,
+                        "baseline_us": round(elapsed["none"] * 1e6, 1),
+                        "per_request_us": round(elapsed[name] * 1e6, 1),
+                        "overhead_us": round(
+                            (elapsed[name] - elapsed["none"]) * 1e6, 1
+                        ),
+                    },
+                )
+    finally:
+        for route, route_app in originals:
+            route.app = route_app
+
+    if overhead_percent > args.budget:
+        print(
+            f"metrics overhead {overhead_percent:.2f}% exceeds the {args.budget}% budget",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
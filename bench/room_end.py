@@ -0,0 +1,93 @@
+"""/room/end の書き込みをまとめたときのコミット数とレイテンシ
+
+同時に多数のルームがスコアを送信する状況で、1件ずつコミットする場合と
+SCORE_WRITE_BEHIND でまとめて書き込む場合を比べる。
+
+    python -m bench.room_end --rooms 1000 --concurrency 64
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+
+from app import config, model
+from app.db import engine
+from app.model import LiveDifficulty
+
+from .common import emit, summarize
+
+
+class CommitCounter:
+    def __init__(self):
+        self.commits = 0
+        event.listen(engine, "commit", self._on_commit)
+
+    def _on_commit(self, conn):
+        self.commits += 1
+
+
+def _prepare_rooms(n: int, user_ids: list[int]) -> list[int]:
+    room_ids = []
+    for _ in range(n):
+        room_id = model.create_room(1, user_ids[0])
+        for user_id in user_ids:
+            model.join_room(room_id, user_id, LiveDifficulty.normal)
+        model.start_room(room_id)
+        room_ids.append(room_id)
+    return room_ids
+
+
+def _run(write_behind: bool, rooms: int, concurrency: int, user_ids, counter) -> dict:
+    config.SCORE_WRITE_BEHIND = write_behind
+    room_ids = _prepare_rooms(rooms, user_ids)
+    submissions = [(room_id, user_id) for room_id in room_ids for user_id in user_ids]
+    latencies: list[float] = []
+
+    def submit(args):
+        room_id, user_id = args
+        start = time.perf_counter()
+        model.end_room(room_id, user_id, [1, 0, 0, 0, 0], 1000)
+        latencies.append(time.perf_counter() - start)
+
+    counter.commits = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(submit, submissions))
+    model.score_writer.flush()
+    elapsed = time.perf_counter() - start
+    result = summarize(latencies, elapsed)
+    return {
+        "mode": "write_behind" if write_behind else "direct",
+        "submissions": result["requests"],
+        "commits": counter.commits,
+        "commits_per_sec": round(counter.commits / elapsed, 1),
+        "rps": result["rps"],
+        "p50_ms": result["p50_ms"],
+        "p99_ms": result["p99_ms"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    user_ids = []
+    for i in range(model.MAX_USER_COUNT):
+        token = model.create_user(f"bench_end_{i}", 1000)
+        user_ids.append(model.get_user_by_token(token).id)
+
+    counter = CommitCounter()
+    for write_behind in (False, True):
+        emit(
+            "room_end",
+            _run(write_behind, args.rooms, args.concurrency, user_ids, counter),
+        )
+    model.score_writer.stop()
+
+
+if __name__ == "__main__":
+    main()
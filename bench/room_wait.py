@@ -0,0 +1,71 @@
+"""/room/wait の同期パスと非同期パスの比較
+
+python -m bench.room_wait --clients 200 --duration 10
+"""
+
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from .common import auth_header, create_users, emit, server, summarize
+
+
+async def _poll(base_url: str, token: str, room_id: int, until: float, latencies):
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+        while time.perf_counter() < until:
+            start = time.perf_counter()
+            response = await client.post(
+                "/room/wait", headers=auth_header(token), json={"room_id": room_id}
+            )
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+
+async def _run(base_url: str, clients: int, duration: float) -> dict:
+    with httpx.Client(base_url=base_url) as client:
+        tokens = create_users(client, clients)
+        rooms = []
+        for i in range(0, clients, 4):
+            response = client.post(
+                "/room/create",
+                headers=auth_header(tokens[i]),
+                json={"live_id": 1, "select_difficulty": 1},
+            )
+            room_id = response.json()["room_id"]
+            for token in tokens[i + 1 : i + 4]:
+                client.post(
+                    "/room/join",
+                    headers=auth_header(token),
+                    json={"room_id": room_id, "select_difficulty": 1},
+                )
+            rooms.extend([room_id] * len(tokens[i : i + 4]))
+
+    latencies = []
+    start = time.perf_counter()
+    until = start + duration
+    await asyncio.gather(
+        *(
+            _poll(base_url, token, room_id, until, latencies)
+            for token, room_id in zip(tokens, rooms)
+        )
+    )
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--port", type=int, default=8100)
+    args = parser.parse_args()
+
+    for mode, async_db in [("sync", "0"), ("async", "1")]:
+        with server(args.port, env={"ASYNC_DB": async_db}) as base_url:
+            result = asyncio.run(_run(base_url, args.clients, args.duration))
+        emit("room_wait", {"mode": mode, "clients": args.clients, **result})
+
+
+if __name__ == "__main__":
+    main()
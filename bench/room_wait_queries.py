@@ -0,0 +1,88 @@
+"""/room/wait 1回あたりのクエリ数・コネクション取得数の比較
+
+token・プロフィール・ルーム状態のキャッシュが効いている場合 (warm) と、
+毎回キャッシュを空にした場合 (cold) の両方を測る。
+
+python -m bench.room_wait_queries
+"""
+
+import argparse
+import time
+
+from sqlalchemy import event
+
+from app import model
+from app.db import shard_engines
+
+from .common import emit
+
+
+class QueryCounter:
+    def __init__(self):
+        self.queries = 0
+        self.checkouts = 0
+        for engine in shard_engines:
+            event.listen(engine, "before_cursor_execute", self._on_execute)
+            event.listen(engine.pool, "checkout", self._on_checkout)
+
+    def _on_execute(self, *args):
+        self.queries += 1
+
+    def _on_checkout(self, *args):
+        self.checkouts += 1
+
+    def reset(self):
+        self.queries = self.checkouts = 0
+
+
+def _legacy_wait(room_id: int, token: str):
+    """変更前の /room/wait と同じ呼び出し"""
+    user = model.get_user_by_token(token)
+    status = model.get_room_status(room_id)
+    return status, model.get_room_users(room_id, user.id)
+
+
+def _clear_caches():
+    model.user_cache.clear()
+    model.profile_cache.clear()
+    model.room_cache.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=1000)
+    args = parser.parse_args()
+
+    tokens = [model.create_user(f"bench_{i}", 1000) for i in range(4)]
+    host = model.get_user_by_token(tokens[0])
+    room_id = model.create_room(1, host.id)
+    for token in tokens:
+        user = model.get_user_by_token(token)
+        model.join_room(room_id, user.id, model.LiveDifficulty.normal)
+
+    counter = QueryCounter()
+    for cache in ["warm", "cold"]:
+        for name, fn in [("legacy", _legacy_wait), ("combined", model.wait_room)]:
+            assert fn(room_id, tokens[1]) == _legacy_wait(room_id, tokens[1])
+            counter.reset()
+            elapsed = 0.0
+            for _ in range(args.iterations):
+                if cache == "cold":
+                    _clear_caches()
+                start = time.perf_counter()
+                fn(room_id, tokens[1])
+                elapsed += time.perf_counter() - start
+            emit(
+                "room_wait_queries",
+                {
+                    "path": name,
+                    "cache": cache,
+                    "queries_per_request": counter.queries / args.iterations,
+                    "checkouts_per_request": counter.checkouts / args.iterations,
+                    "mean_ms": round(elapsed / args.iterations * 1000, 3),
+                },
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""ワーカー数ごとのスループット
+
+python -m app.serve をワーカー数を変えて起動し、読み出し中心の負荷 (/room/wait と /room/list) を
+複数のクライアントプロセスからかけて RPS を比べる。クライアントが先に詰まらないよう、
+クライアントはサーバーとは別に --client-processes 個のプロセスで動かす。
+
+    python -m bench.scaling --workers 1,2,4,8 --duration 10
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import httpx
+
+from .common import auth_header, create_users, emit, server, summarize
+
+
+def _setup(base_url: str, n: int) -> list[tuple[str, int]]:
+    """n 人を4人ずつルームに入れ、(token, room_id) の一覧を返す"""
+    with httpx.Client(base_url=base_url) as client:
+        tokens = create_users(client, n, prefix="bench_scaling")
+        players = []
+        for i in range(0, len(tokens), 4):
+            response = client.post(
+                "/room/create",
+                headers=auth_header(tokens[i]),
+                json={"live_id": 1, "select_difficulty": 1},
+            )
+            room_id = response.json()["room_id"]
+            for token in tokens[i + 1 : i + 4]:
+                client.post(
+                    "/room/join",
+                    headers=auth_header(token),
+                    json={"room_id": room_id, "select_difficulty": 1},
+                )
+            players += [(token, room_id) for token in tokens[i : i + 4]]
+    return players
+
+
+async def _poll(client: httpx.AsyncClient, token: str, room_id: int, until, latencies):
+    # 待機中のクライアントと同じく wait 4回につき list を1回投げる
+    i = 0
+    while time.perf_counter() < until:
+        start = time.perf_counter()
+        if i % 5 == 4:
+            response = await client.post("/room/list", json={"live_id": 1})
+        else:
+            response = await client.post(
+                "/room/wait", headers=auth_header(token), json={"room_id": room_id}
+            )
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+        i += 1
+
+
+async def _client(base_url: str, players: list[tuple[str, int]], duration: float):
+    latencies = []
+    limits = httpx.Limits(max_connections=len(players))
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=30
+    ) as client:
+        until = time.perf_counter() + duration
+        await asyncio.gather(
+            *(
+                _poll(client, token, room_id, until, latencies)
+                for token, room_id in players
+            )
+        )
+    return latencies
+
+
+def _run_client(base_url: str, players: list[tuple[str, int]], duration: float):
+    return asyncio.run(_client(base_url, players, duration))
+
+
+def run(base_url: str, args) -> dict:
+    players = _setup(base_url, args.players)
+    processes = args.client_processes
+    with ProcessPoolExecutor(processes) as executor:
+        futures = [
+            executor.submit(_run_client, base_url, players[i::processes], args.duration)
+            for i in range(processes)
+        ]
+        latencies = [latency for future in futures for latency in future.result()]
+    # プロセスの起動にかかった時間は含めない
+    return summarize(latencies, args.duration)
+
+
+def main():
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers",
+        default=",".join(str(n) for n in sorted({1, 2, 4, cpus}) if n <= cpus),
+    )
+    parser.add_argument("--players", type=int, default=400)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--client-processes", type=int, default=max(1, cpus // 2))
+    parser.add_argument("--port", type=int, default=8100)
+    args = parser.parse_args()
+
+    baseline = None
+    for workers in [int(n) for n in args.workers.split(",")]:
+        with server(args.port, workers=workers, serve=True) as base_url:
+            result = run(base_url, args)
+        baseline = baseline or result["rps"]
+        emit(
+            "scaling",
+            {
+                "workers": workers,
+                "speedup": round(result["rps"] / baseline, 2) if baseline else 0.0,
+                **result,
+            },
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""/room/wait・/room/list・/room/result のレスポンスを作るコスト
+
+ハンドラがレスポンスのモデルを作ってから FastAPI が response_model で検証し直して
+JSONResponse にするまで (既定) と、dict から ORJSONResponse にするまで (FAST_JSON=1) を
+DB を介さずに比べる。
+
+    python -m bench.serialization --iterations 20000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+
+from app import api, model
+from app.model import (
+    LiveDifficulty,
+    ResultUser,
+    RoomInfo,
+    RoomMember,
+    RoomState,
+    WaitRoomStatus,
+)
+
+from .common import emit
+
+
+def _response_field(path: str):
+    for route in api.app.routes:
+        if getattr(route, "path", None) == path:
+            return route.response_field
+    raise KeyError(path)
+
+
+def _cases(rooms: int) -> dict:
+    """エンドポイントごとの (既定の処理, FAST_JSON の処理) の組"""
+    state = RoomState(
+        version=1,
+        status=WaitRoomStatus.Waiting,
+        live_id=1,
+        host_id=1,
+        members=tuple(
+            RoomMember(i, f"user_{i}", 1000 + i, LiveDifficulty.normal)
+            for i in range(1, model.MAX_USER_COUNT + 1)
+        ),
+    )
+    room_info_list = [
+        RoomInfo(room_id=i, live_id=1, joined_user_count=2, max_user_count=4)
+        for i in range(rooms)
+    ]
+    result_user_list = [
+        ResultUser(user_id=i, judge_count_list=[50, 10, 5, 2, 1], score=100000 + i)
+        for i in range(1, model.MAX_USER_COUNT + 1)
+    ]
+    return {
+        "/room/wait": (
+            lambda: api.RoomWaitResponse(
+                status=state.status, room_user_list=model.room_users(state, 1)
+            ),
+            lambda: {
+                "status": state.status,
+                "room_user_list": model.room_user_dicts(state, 1),
+            },
+        ),
+        "/room/list": (
+            lambda: api.RoomListResponse(
+                room_info_list=room_info_list, next_cursor=None
+            ),
+            lambda: {
+                "room_info_list": [api._as_dict(info) for info in room_info_list],
+                "next_cursor": None,
+            },
+        ),
+        "/room/result": (
+            lambda: api.RoomResultResponse(result_user_list=result_user_list),
+            lambda: {
+                "result_user_list": [api._as_dict(user) for user in result_user_list]
+            },
+        ),
+    }
+
+
+async def _default(field, build) -> bytes:
+    content = await serialize_response(field=field, response_content=build())
+    return JSONResponse(content).body
+
+
+async def _measure(path: str, default, fast, iterations: int) -> dict:
+    field = _response_field(path)
+    assert json.loads(await _default(field, default)) == json.loads(
+        ORJSONResponse(fast()).body
+    )
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await _default(field, default)
+    default_us = (time.perf_counter() - start) / iterations * 1e6
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        ORJSONResponse(fast()).body
+    fast_us = (time.perf_counter() - start) / iterations * 1e6
+    return {
+        "path": path,
+        "default_us": round(default_us, 2),
+        "fast_json_us": round(fast_us, 2),
+        "speedup": round(default_us / fast_us, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--rooms", type=int, default=20, help="/room/list の件数")
+    args = parser.parse_args()
+
+    for path, (default, fast) in _cases(args.rooms).items():
+        result = asyncio.run(_measure(path, default, fast, args.iterations))
+        emit("serialization", result)
+
+
+if __name__ == "__main__":
+    main()
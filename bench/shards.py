@@ -0,0 +1,56 @@
+"""シャード数ごとのルームのスループット
+
+SHARDS を変えてサーバーを起動し、bench.lifecycle と同じ負荷をかけて比べる。
+--storage mysql の場合はシャード 1 以降の接続先を SHARD_DATABASE_URIS で渡す。
+
+    python -m bench.shards --shards 1,2,4 --storage sqlite --players 400
+"""
+
+import argparse
+import os
+import tempfile
+
+from . import lifecycle
+from .common import emit, server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", default="1,2,4")
+    parser.add_argument("--storage", default="sqlite")
+    parser.add_argument("--players", type=int, default=400)
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    lifecycle_args = lifecycle.build_parser().parse_args(
+        ["--players", str(args.players), "--poll-interval", str(args.poll_interval)]
+    )
+    baseline = None
+    for shards in [int(n) for n in args.shards.split(",")]:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            env = {
+                "STORAGE": args.storage,
+                "SHARDS": str(shards),
+                "SQLITE_PATH": os.path.join(tmpdir, "shard.sqlite3"),
+            }
+            with server(env=env, workers=args.workers) as base_url:
+                result = lifecycle.run(base_url, lifecycle_args)
+        rooms = result["endpoints"]["/room/create"]["requests"]
+        rooms_per_sec = rooms / result["elapsed"]
+        baseline = baseline or rooms_per_sec
+        emit(
+            "shards",
+            {
+                "shards": shards,
+                "rooms_per_sec": round(rooms_per_sec, 1),
+                "speedup": round(rooms_per_sec / baseline, 2),
+                "rps": result["rps"],
+                "join_p99_ms": result["endpoints"]["/room/join"]["p99_ms"],
+                "end_p99_ms": result["endpoints"]["/room/end"]["p99_ms"],
+            },
+        )
+
+
+if __name__ == "__main__":
+    main()
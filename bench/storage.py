@@ -0,0 +1,50 @@
+"""ストレージごとのスループット
+
+STORAGE を切り替えてサーバーを起動し、bench.lifecycle と同じ負荷をかけて比べる。
+mysql は schema.sql を流した MySQL が必要。
+
+    python -m bench.storage --storages mysql,sqlite,sqlite_memory,memory --players 200
+"""
+
+import argparse
+import os
+import tempfile
+
+from . import lifecycle
+from .common import emit, server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--storages", default="mysql,sqlite,sqlite_memory,memory")
+    parser.add_argument("--players", type=int, default=200)
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    args = parser.parse_args()
+
+    lifecycle_args = lifecycle.build_parser().parse_args(
+        ["--players", str(args.players), "--poll-interval", str(args.poll_interval)]
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for storage in args.storages.split(","):
+            env = {
+                "STORAGE": storage,
+                "SQLITE_PATH": os.path.join(tmpdir, f"{storage}.sqlite3"),
+            }
+            with server(env=env) as base_url:
+                result = lifecycle.run(base_url, lifecycle_args)
+            endpoints = result["endpoints"]
+            emit(
+                "storage",
+                {
+                    "storage": storage,
+                    "requests": result["requests"],
+                    "rps": result["rps"],
+                    "wait_p99_ms": endpoints["/room/wait"]["p99_ms"],
+                    "end_p99_ms": endpoints["/room/end"]["p99_ms"],
+                    "join_p99_ms": endpoints["/room/join"]["p99_ms"],
+                },
+            )
+
+
+if __name__ == "__main__":
+    main()
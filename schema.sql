@@ -14,11 +14,59 @@ CREATE TABLE `room` (
   `live_id` int NOT NULL,
   `host_id` bigint NOT NULL,
   `status` int NOT NULL,
-  PRIMARY KEY (`id`)
+  `deadline_at` datetime DEFAULT NULL,
+  `version` int NOT NULL DEFAULT 0,
+  `joined_user_count` int NOT NULL DEFAULT 0,
+  `created_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `dissolved_at` datetime DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `deadline_at` (`deadline_at`),
+  KEY `status_live_id` (`status`, `live_id`),
+  KEY `status_created_at` (`status`, `created_at`),
+  KEY `dissolved_at` (`dissolved_at`)
 );
 
 DROP TABLE IF EXISTS `room_member`;
 CREATE TABLE `room_member` (
+  `room_id` bigint NOT NULL,
+  `user_id` int NOT NULL,
+  `select_difficulty` int NOT NULL,
+  `judge_perfect` int DEFAULT NULL,
+  `judge_great` int DEFAULT NULL,
+  `judge_good` int DEFAULT NULL,
+  `judge_bad` int DEFAULT NULL,
+  `judge_miss` int DEFAULT NULL,
+  `score` int DEFAULT NULL,
+  PRIMARY KEY (`room_id`, `user_id`),
+  KEY `user_id` (`user_id`)
+);
+
+DROP TABLE IF EXISTS `room_event`;
+CREATE TABLE `room_event` (
+  `id` bigint NOT NULL AUTO_INCREMENT,
+  `room_id` bigint NOT NULL,
+  `type` int NOT NULL,
+  `user_id` bigint DEFAULT NULL,
+  `created_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  KEY `created_at` (`created_at`)
+);
+
+-- 解散したルームとその結果。追記のみ
+DROP TABLE IF EXISTS `room_archive`;
+CREATE TABLE `room_archive` (
+  `id` bigint NOT NULL,
+  `live_id` int NOT NULL,
+  `host_id` bigint NOT NULL,
+  `created_at` datetime NOT NULL,
+  `dissolved_at` datetime DEFAULT NULL,
+  `archived_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  KEY `live_id` (`live_id`)
+);
+
+DROP TABLE IF EXISTS `room_member_archive`;
+CREATE TABLE `room_member_archive` (
   `room_id` bigint NOT NULL,
   `user_id` int NOT NULL,
   `select_difficulty` int NOT NULL,
@@ -29,4 +77,28 @@ CREATE TABLE `room_member` (
   `judge_miss` int DEFAULT NULL,
   `score` int DEFAULT NULL,
   PRIMARY KEY (`room_id`, `user_id`)
-);
\ No newline at end of file
+);
+
+-- live_id・難易度ごとの自己ベスト。ランキングはここから上位を引く。シャード 0 にだけ置く
+DROP TABLE IF EXISTS `personal_best`;
+CREATE TABLE `personal_best` (
+  `live_id` int NOT NULL,
+  `difficulty` int NOT NULL,
+  `user_id` bigint NOT NULL,
+  `score` int NOT NULL,
+  `play_count` int NOT NULL,
+  PRIMARY KEY (`live_id`, `difficulty`, `user_id`),
+  KEY `ranking` (`live_id`, `difficulty`, `score`),
+  KEY `user_id` (`user_id`)
+);
+
+-- live_id・難易度ごとのスコアの集計。シャード 0 にだけ置く
+DROP TABLE IF EXISTS `live_score_stats`;
+CREATE TABLE `live_score_stats` (
+  `live_id` int NOT NULL,
+  `difficulty` int NOT NULL,
+  `play_count` bigint NOT NULL,
+  `score_sum` bigint NOT NULL,
+  `max_score` int NOT NULL,
+  PRIMARY KEY (`live_id`, `difficulty`)
+);
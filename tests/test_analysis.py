@@ -0,0 +1,64 @@
+import pytest
+
+from app import analysis, validation
+from app.validation import LiveNotes
+
+np = pytest.importorskip("numpy")
+
+
+def _chunk(rows: list[tuple[int, int, int, list[int], int]]) -> "np.ndarray":
+    """(room_id, user_id, live_id, judge_count_list, score) から難易度 1 のチャンクを作る"""
+    return np.array(
+        [
+            [room_id, user_id, live_id, 1, *judges, score]
+            for room_id, user_id, live_id, judges, score in rows
+        ],
+        dtype=np.int64,
+    )
+
+
+def test_score_distribution():
+    histogram = analysis.ScoreHistogram(bin_width=10)
+    histogram.add(_chunk([(1, i, 1, [1, 0, 0, 0, 0], i) for i in range(100)]))
+    histogram.add(_chunk([(2, i, 2, [1, 0, 0, 0, 0], 500) for i in range(3)]))
+    first, second = histogram.distributions()
+    assert (first.live_id, first.count, first.max) == (1, 100, 99)
+    assert first.mean == pytest.approx(49.5)
+    assert first.std == pytest.approx(np.arange(100).std())
+    assert (first.p50, first.p90, first.p99) == (49, 89, 99)
+    assert (second.live_id, second.count, second.mean, second.std) == (2, 3, 500, 0)
+    assert second.p99 == 500
+
+
+def test_find_outliers(monkeypatch):
+    monkeypatch.setattr(validation, "live_notes", {1: LiveNotes(10, 1000)})
+    rows = [(1, i, 1, [10, 0, 0, 0, 0], 500 + i % 3) for i in range(200)]
+    rows.append((2, 1, 1, [9, 0, 0, 0, 0], 500))  # ノーツ数が合わない
+    rows.append((2, 2, 1, [10, 0, 0, 0, 0], 1001))  # 理論値を超えている
+    rows.append((2, 3, 1, [5, 5, 0, 0, 0], 0))  # 平均から離れている
+    chunk = _chunk(rows)
+    histogram = analysis.ScoreHistogram()
+    histogram.add(chunk)
+    outliers = analysis.find_outliers(chunk, histogram, z=4.0)
+    assert [(o.user_id, o.reason) for o in outliers] == [
+        (1, "note_count_mismatch"),
+        (2, "score_above_max"),
+        (3, "z_score"),
+    ]
+
+
+def test_histogram_caps_forged_score(monkeypatch):
+    monkeypatch.setattr(validation, "live_notes", {1: LiveNotes(10, 1000)})
+    rows = [(1, i, 1, [10, 0, 0, 0, 0], 500 + i % 3) for i in range(200)]
+    rows.append((2, 1, 1, [10, 0, 0, 0, 0], 2**31 - 1))
+    chunk = _chunk(rows)
+    histogram = analysis.ScoreHistogram(bin_width=10, max_score=1000)
+    histogram.add(chunk)
+    # 不正なスコアは最後のビンに入り、ビンの数は増えない
+    assert histogram.counts.shape == (1, 1000 // 10 + 2)
+    assert histogram.counts[0, -1] == 1
+    (distribution,) = histogram.distributions()
+    assert (distribution.count, distribution.max) == (201, 2**31 - 1)
+    assert distribution.p50 == 509
+    outliers = analysis.find_outliers(chunk, histogram)
+    assert [(o.user_id, o.reason) for o in outliers] == [(1, "score_above_max")]
@@ -0,0 +1,67 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.cache import SingleFlight
+
+
+def test_single_flight_shares_result():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    executed = []
+
+    def load(key):
+        executed.append(key)
+        started.set()
+        assert release.wait(2)
+        return [key]
+
+    with ThreadPoolExecutor(5) as executor:
+        leader = executor.submit(flight.do, 1, load, 1)
+        assert started.wait(2)
+        followers = [executor.submit(flight.do, 1, load, 1) for _ in range(3)]
+        other = executor.submit(flight.do, 2, load, 2)
+        while flight.stats.calls < 5:
+            time.sleep(0.01)
+        release.set()
+        results = [f.result() for f in [leader, *followers]]
+
+    assert other.result() == [2]
+    assert all(result is results[0] for result in results)
+    assert sorted(executed) == [1, 2]
+    assert flight.stats.as_dict() == {"calls": 5, "shared": 3, "shared_rate": 0.6}
+
+
+def test_single_flight_shares_error_and_forgets():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def fail():
+        started.set()
+        assert release.wait(2)
+        raise ValueError("boom")
+
+    with ThreadPoolExecutor(2) as executor:
+        leader = executor.submit(flight.do, 1, fail)
+        assert started.wait(2)
+        follower = executor.submit(flight.do, 1, fail)
+        while flight.stats.calls < 2:
+            time.sleep(0.01)
+        # forget() した後の呼び出しは実行中のものに相乗りしない
+        flight.forget(1)
+        assert flight.do(1, lambda: "fresh") == "fresh"
+        release.set()
+        for future in (leader, follower):
+            with pytest.raises(ValueError):
+                future.result()
+    assert flight.stats.shared == 1
+
+
+def test_single_flight_runs_reentrant_call_itself():
+    flight = SingleFlight()
+    assert flight.do(1, lambda: flight.do(1, lambda: "inner") + "!") == "inner!"
+    assert flight.stats.shared == 0
@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+from sqlalchemy import text
+
+from app import config
+from app.db import begin
+from app.events import MySQLEventBus, RoomEvent, RoomEventType
+
+pytestmark = pytest.mark.skipif(
+    config.STORAGE == "memory", reason="STORAGE=memory には room_event テーブルが無い"
+)
+
+
+def test_mysql_event_bus_delivers_across_instances():
+    publisher = MySQLEventBus(poll_interval=0.01)
+    subscriber = MySQLEventBus(poll_interval=0.01, prune_every=1)
+    received = []
+    done = threading.Event()
+
+    def on_event(event):
+        received.append(event)
+        done.set()
+
+    subscriber.subscribe(on_event)
+    with begin() as conn:
+        query = "INSERT INTO `room_event` (room_id, type, created_at) VALUES (:room_id, :type, :created_at)"
+        conn.execute(
+            text(query),
+            {
+                "room_id": 900001,
+                "type": int(RoomEventType.Dissolved),
+                "created_at": "2000-01-01 00:00:00",
+            },
+        )
+
+    subscriber.start()
+    try:
+        event = RoomEvent(900002, RoomEventType.Joined, 7)
+        publisher.publish(event)
+        assert done.wait(2)
+    finally:
+        subscriber.stop()
+    # start() より前のイベントは配らない
+    assert received == [event]
+
+    with begin() as conn:
+        query = "SELECT `room_id` FROM `room_event` WHERE `room_id` IN (900001, 900002)"
+        room_ids = [row.room_id for row in conn.execute(text(query))]
+    # 保持期間を過ぎたイベントだけがポーリングのついでに消える
+    assert room_ids == [900002]
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from app import model
+from app.matchmaker import Matchmaker
+from app.model import LiveDifficulty
+
+
+def _user_ids(n: int) -> list[int]:
+    tokens = [model.create_user(f"matchmaker_{i}", 1000) for i in range(n)]
+    return [model.get_user_by_token(token).id for token in tokens]
+
+
+def test_matchmake_cancelled_before_match():
+    first, second = _user_ids(2)
+
+    async def scenario():
+        matchmaker = Matchmaker(max_wait=0)
+        task = asyncio.create_task(
+            matchmaker.matchmake(first, 2001, LiveDifficulty.normal, 10)
+        )
+        await asyncio.sleep(0)
+        assert matchmaker.waiting == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert matchmaker.waiting == 0
+
+        # 切断したチケットはマッチに使われない
+        other = asyncio.create_task(
+            matchmaker.matchmake(second, 2001, LiveDifficulty.normal, 10)
+        )
+        await asyncio.sleep(0)
+        assert await matchmaker.match_once() == 0
+        other.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_matchmake_cancelled_while_matching():
+    first, second = _user_ids(2)
+
+    async def scenario():
+        matchmaker = Matchmaker(max_wait=0)
+        tasks = [
+            asyncio.create_task(
+                matchmaker.matchmake(user_id, 2002, LiveDifficulty.normal, 10)
+            )
+            for user_id in (first, second)
+        ]
+        await asyncio.sleep(0)
+        matching = asyncio.create_task(matchmaker.match_once())
+        await asyncio.sleep(0)
+        # ルームの作成中に切断する
+        tasks[0].cancel()
+        assert await matching == 1
+        room_id = await tasks[1]
+        with pytest.raises(asyncio.CancelledError):
+            await tasks[0]
+        while matchmaker._leaving:
+            await asyncio.sleep(0.01)
+        return room_id
+
+    room_id = asyncio.run(scenario())
+    # 返せなかった人は入れられたルームから抜けている
+    users = model.get_room_users(room_id, second)
+    assert [user.user_id for user in users] == [second]
+    model.leave_room(room_id, second)
@@ -0,0 +1,61 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+from app import config, db, model
+from app.api import app
+
+client = TestClient(app)
+requires_db = pytest.mark.skipif(
+    config.STORAGE == "memory", reason="STORAGE=memory は DB に繋がない"
+)
+
+
+def test_metrics():
+    response = client.post(
+        "/user/create", json={"user_name": "metrics", "leader_card_id": 1000}
+    )
+    headers = {"Authorization": f"bearer {response.json()['user_token']}"}
+    client.post(
+        "/room/create", json={"live_id": 1100, "select_difficulty": 1}, headers=headers
+    )
+    client.get("/user/me", headers=headers)
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    body = response.text
+    assert 'http_request_duration_seconds_count{method="GET",path="/user/me"}' in body
+    assert 'http_requests_total{method="POST",path="/room/create",status="200"}' in body
+    assert 'rooms{status="Waiting"}' in body
+    assert 'rooms_by_members{members="1"}' in body
+    assert "room_timers_pending" in body
+    assert 'threadpool_tasks{state="waiting"}' in body
+    assert 'singleflight_shared_rate{call="room_state"}' in body
+
+
+@requires_db
+def test_pool_stats():
+    checkouts = db.pool_stats.checkouts
+    with db.begin() as conn:
+        assert db.pool_stats.in_use >= 1
+        conn.execute(text("SELECT 1"))
+    assert db.pool_stats.checkouts == checkouts + 1
+    assert db.pool_stats.max_checkout_time >= 0
+    assert db.pool_stats.in_use == 0
+
+
+def test_metrics_status_of_errors():
+    client.get("/user/me", headers={"Authorization": "bearer metrics-invalid"})
+    client.post("/room/list", json={"live_id": 1, "limit": 0})
+    body = client.get("/metrics").text
+    # ハンドラが例外で返したステータスもそのまま数える
+    assert 'http_requests_total{method="GET",path="/user/me",status="404"}' in body
+    assert 'http_requests_total{method="POST",path="/room/list",status="422"}' in body
+
+
+@requires_db
+def test_track_queries_counts_every_shard():
+    with db.track_queries() as stats:
+        model.count_rooms()
+    # 全シャードへの問い合わせは別のスレッドで実行しても呼び出し元で数える
+    assert stats.queries == len(db.shard_engines)
@@ -0,0 +1,175 @@
+import time
+
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import OperationalError
+
+from app import model, ranking
+from app.api import app
+from app.ranking import PersonalBest, Play, RankedScore, TopK
+from app.storage import storage
+
+client = TestClient(app)
+
+
+def _create_user(i: int) -> str:
+    response = client.post(
+        "/user/create", json={"user_name": f"ranking_user_{i}", "leader_card_id": i}
+    )
+    return response.json()["user_token"]
+
+
+def _auth_header(token: str) -> dict:
+    return {"Authorization": f"bearer {token}"}
+
+
+def _play(live_id: int, tokens: list[str], scores: list[int]) -> None:
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(tokens[0]),
+        json={"live_id": live_id, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    for token in tokens[1:]:
+        client.post(
+            "/room/join",
+            headers=_auth_header(token),
+            json={"room_id": room_id, "select_difficulty": 1},
+        )
+    client.post(
+        "/room/start", headers=_auth_header(tokens[0]), json={"room_id": room_id}
+    )
+    for token, score in zip(tokens, scores):
+        client.post(
+            "/room/end",
+            headers=_auth_header(token),
+            json={"room_id": room_id, "score": score, "judge_count_list": [1] * 5},
+        )
+    response = client.post("/room/result", json={"room_id": room_id})
+    assert len(response.json()["result_user_list"]) == len(tokens)
+    # 2回目の取得では数え直さない
+    client.post("/room/result", json={"room_id": room_id})
+
+
+def test_top_k():
+    top = TopK(3)
+    assert top.offer(1, 100)
+    assert top.offer(2, 300)
+    assert top.offer(3, 200)
+    assert not top.offer(4, 50)  # 入らない
+    assert not top.offer(2, 250)  # 自己ベストを超えていない
+    assert top.offer(1, 400)
+    assert not top.offer(4, 200)  # 同点は user_id の小さい方が上
+    assert top.entries() == [
+        RankedScore(1, 400),
+        RankedScore(2, 300),
+        RankedScore(3, 200),
+    ]
+    assert top.entries(2) == [RankedScore(1, 400), RankedScore(2, 300)]
+    assert len(top) == 3
+
+
+def test_ranking():
+    tokens = [_create_user(i) for i in range(3)]
+    me = client.get("/user/me", headers=_auth_header(tokens[0])).json()
+    # 以前の実行の記録と混ざらないよう、曲はこの実行で作ったユーザーの id で決める
+    live_id = 1_000_000 + me["id"]
+
+    _play(live_id, tokens, [500, 700, 600])
+    # 読み込んだ後の結果はメモリ上の順位表にも反映される
+    response = client.get(f"/ranking/{live_id}")
+    assert [u["score"] for u in response.json()["ranking"]] == [700, 600, 500]
+    _play(live_id, tokens[:2], [800, 600])
+
+    response = client.get(f"/ranking/{live_id}", params={"select_difficulty": 1})
+    assert response.status_code == 200
+    body = response.json()
+    assert [(u["rank"], u["name"], u["score"]) for u in body["ranking"]] == [
+        (1, "ranking_user_0", 800),
+        (2, "ranking_user_1", 700),
+        (3, "ranking_user_2", 600),
+    ]
+    assert body["play_count"] == 5
+    assert body["max_score"] == 800
+    assert body["average_score"] == 3200 / 5
+
+    response = client.get(f"/ranking/{live_id}", params={"limit": 1})
+    assert len(response.json()["ranking"]) == 1
+    response = client.get(f"/ranking/{live_id}", params={"select_difficulty": 2})
+    assert response.json()["ranking"] == []
+
+    response = client.get(
+        "/user/best", headers=_auth_header(tokens[1]), params={"live_id": live_id}
+    )
+    assert response.json() == [
+        {"live_id": live_id, "select_difficulty": 1, "score": 700, "play_count": 2}
+    ]
+
+    # アーカイブに移した後に作り直しても同じになる
+    model.reap_rooms()
+    expected = model.get_ranking(live_id, model.LiveDifficulty.normal, 10)
+    result = ranking.rebuild(batch_size=2)
+    assert result.plays >= 5
+    assert model.get_ranking(live_id, model.LiveDifficulty.normal, 10) == expected
+
+
+def _fail_once(monkeypatch) -> None:
+    """次の1回だけ自己ベストと集計への書き込みを接続断で失敗させる"""
+    save_plays = storage._save_plays
+    failures = [OperationalError("INSERT INTO `personal_best`", {}, Exception("down"))]
+
+    def flaky(*args):
+        if failures:
+            raise failures.pop()
+        save_plays(*args)
+
+    monkeypatch.setattr(storage, "_save_plays", flaky)
+
+
+def _wait_for_retries() -> None:
+    deadline = time.monotonic() + 10
+    while ranking.play_retries.pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert ranking.play_retries.pending == 0
+
+
+def test_record_plays_retries_failed_write(monkeypatch):
+    token = _create_user(10)
+    me = client.get("/user/me", headers=_auth_header(token)).json()
+    live_id = 2_000_000 + me["id"]
+    _fail_once(monkeypatch)
+
+    ranking.record_plays([Play(live_id, 1, me["id"], 900)])
+    _wait_for_retries()
+    assert ranking.get_personal_bests(me["id"], live_id) == [
+        PersonalBest(live_id, 1, 900, 1)
+    ]
+
+
+def test_ranking_keeps_plays_when_write_fails(monkeypatch):
+    token = _create_user(11)
+    me = client.get("/user/me", headers=_auth_header(token)).json()
+    live_id = 3_000_000 + me["id"]
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(token),
+        json={"live_id": live_id, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    client.post("/room/start", headers=_auth_header(token), json={"room_id": room_id})
+    client.post(
+        "/room/end",
+        headers=_auth_header(token),
+        json={"room_id": room_id, "score": 900, "judge_count_list": [1] * 5},
+    )
+    _fail_once(monkeypatch)
+
+    try:
+        model.result_room(room_id)
+    except OperationalError:
+        # ランキングと同じシャードのルームは解散ごとロールバックされ、次の取得で数える
+        assert model.get_room_status(room_id) == model.WaitRoomStatus.LiveStart
+        model.result_room(room_id)
+    _wait_for_retries()
+    assert ranking.get_personal_bests(me["id"], live_id) == [
+        PersonalBest(live_id, 1, 900, 1)
+    ]
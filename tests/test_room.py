@@ -1,6 +1,16 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import event, text
 
+from app import config, db, model, validation
 from app.api import app
+from app.db import begin, shard_of
+from app.events import EventBus
+from app.storage import storage
 
 client = TestClient(app)
 user_tokens = []
@@ -145,3 +155,669 @@ def test_room_2():
         )
         assert response.status_code == 200
         print("room/leave response:", response.json())
+
+
+def test_room_long_poll():
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(6),
+        json={"live_id": 1003, "select_difficulty": 1},
+    )
+    assert response.status_code == 200
+    room_id = response.json()["room_id"]
+
+    response = client.post(
+        "/room/wait/long_poll", headers=_auth_header(6), json={"room_id": room_id}
+    )
+    assert response.status_code == 200
+    version = response.json()["version"]
+    assert len(response.json()["room_user_list"]) == 1
+
+    # 変化がなければ timeout まで待って同じ version を返す
+    response = client.post(
+        "/room/wait/long_poll",
+        headers=_auth_header(6),
+        json={"room_id": room_id, "version": version, "timeout": 0.2},
+    )
+    assert response.status_code == 200
+    assert response.json()["version"] == version
+
+    # 待っている間に入室があればすぐに返る
+    with ThreadPoolExecutor() as executor:
+        future = executor.submit(
+            client.post,
+            "/room/wait/long_poll",
+            headers=_auth_header(6),
+            json={"room_id": room_id, "version": version, "timeout": 10},
+        )
+        time.sleep(0.2)
+        response = client.post(
+            "/room/join",
+            headers=_auth_header(7),
+            json={"room_id": room_id, "select_difficulty": 2},
+        )
+        assert response.json()["join_room_result"] == 1
+        response = future.result(timeout=5)
+    assert response.status_code == 200
+    assert response.json()["version"] != version
+    assert len(response.json()["room_user_list"]) == 2
+
+    for i in [6, 7]:
+        response = client.post(
+            "/room/leave", headers=_auth_header(i), json={"room_id": room_id}
+        )
+        assert response.status_code == 200
+
+
+def test_room_list_pagination():
+    room_ids = []
+    for i in [8, 9]:
+        response = client.post(
+            "/room/create",
+            headers=_auth_header(i),
+            json={"live_id": 1004, "select_difficulty": 1},
+        )
+        assert response.status_code == 200
+        room_ids.append(response.json()["room_id"])
+
+    response = client.post("/room/list", json={"live_id": 1004, "limit": 1})
+    assert response.status_code == 200
+    assert [r["room_id"] for r in response.json()["room_info_list"]] == room_ids[:1]
+    cursor = response.json()["next_cursor"]
+    assert cursor == room_ids[0]
+
+    response = client.post(
+        "/room/list", json={"live_id": 1004, "limit": 1, "cursor": cursor}
+    )
+    assert response.status_code == 200
+    assert [r["room_id"] for r in response.json()["room_info_list"]] == room_ids[1:]
+
+    for limit in [0, -1, 1001]:
+        response = client.post("/room/list", json={"live_id": 1004, "limit": limit})
+        assert response.status_code == 422
+
+    for i, room_id in zip([8, 9], room_ids):
+        response = client.post(
+            "/room/leave", headers=_auth_header(i), json={"room_id": room_id}
+        )
+        assert response.status_code == 200
+
+
+def test_room_join_disbanded():
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(8),
+        json={"live_id": 1005, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    response = client.post(
+        "/room/leave", headers=_auth_header(8), json={"room_id": room_id}
+    )
+    assert response.status_code == 200
+
+    response = client.post(
+        "/room/join",
+        headers=_auth_header(9),
+        json={"room_id": room_id, "select_difficulty": 1},
+    )
+    assert response.status_code == 200
+    assert response.json()["join_room_result"] == 3
+
+
+def test_room_matchmake():
+    with TestClient(app) as matchmake_client:
+        with ThreadPoolExecutor() as executor:
+            futures = [
+                executor.submit(
+                    matchmake_client.post,
+                    "/room/matchmake",
+                    headers=_auth_header(i),
+                    json={"live_id": 1006, "select_difficulty": 2, "timeout": 10},
+                )
+                for i in [0, 1, 2, 3]
+            ]
+            responses = [future.result(timeout=15) for future in futures]
+    assert all(response.status_code == 200 for response in responses)
+    room_ids = {response.json()["room_id"] for response in responses}
+    assert len(room_ids) == 1
+    room_id = room_ids.pop()
+    assert room_id is not None
+
+    response = client.post(
+        "/room/wait", headers=_auth_header(0), json={"room_id": room_id}
+    )
+    assert response.status_code == 200
+    assert len(response.json()["room_user_list"]) == 4
+    assert all(u["select_difficulty"] == 2 for u in response.json()["room_user_list"])
+
+    for i in [0, 1, 2, 3]:
+        response = client.post(
+            "/room/leave", headers=_auth_header(i), json={"room_id": room_id}
+        )
+        assert response.status_code == 200
+
+
+def test_room_reaper(monkeypatch):
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(4),
+        json={"live_id": 1007, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+
+    # 放置された待機中のルームは解散し、一覧に出なくなる
+    monkeypatch.setattr(model, "WAITING_ROOM_TTL", 0)
+    result = model.reap_rooms()
+    assert result.expired >= 1
+    response = client.post("/room/list", json={"live_id": 1007})
+    assert response.json()["room_info_list"] == []
+    response = client.post(
+        "/room/join",
+        headers=_auth_header(5),
+        json={"room_id": room_id, "select_difficulty": 1},
+    )
+    assert response.json()["join_room_result"] == 3
+
+    # 解散したルームはアーカイブに移る
+    monkeypatch.setattr(model, "ARCHIVE_DELAY", 0)
+    result = model.reap_rooms()
+    assert result.archived_rooms >= 1
+    assert result.archived_members >= 1
+    assert model.get_room_status(room_id) is None
+    assert model.reaper_stats.runs >= 2
+
+
+def test_room_end_validation(monkeypatch, tmp_path):
+    path = tmp_path / "live_notes.csv"
+    path.write_text("live_id,note_count,max_score\n1007,15,10000\n")
+    monkeypatch.setattr(validation, "live_notes", {})
+    assert validation.load_live_notes(str(path)) == 1
+
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(),
+        json={"live_id": 1007, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    client.post("/room/start", headers=_auth_header(), json={"room_id": room_id})
+
+    for judge_count_list, score in [
+        ([5, 4, 3, 2, 0], 1234),  # ノーツ数と合わない
+        ([5, 4, 3, 2, 1], 10001),  # 理論値を超えている
+        ([5, 4, 3, 4, -1], 1234),
+        ([5, 4, 3, 2, 1], -1),
+    ]:
+        response = client.post(
+            "/room/end",
+            headers=_auth_header(),
+            json={
+                "room_id": room_id,
+                "score": score,
+                "judge_count_list": judge_count_list,
+            },
+        )
+        assert response.status_code == 400
+
+    response = client.post(
+        "/room/end",
+        headers=_auth_header(),
+        json={"room_id": room_id, "score": 10000, "judge_count_list": [5, 4, 3, 2, 1]},
+    )
+    assert response.status_code == 200
+    response = client.get("/metrics")
+    assert 'scores_rejected_total{reason="note_count_mismatch"} 1.0' in response.text
+
+
+def test_room_end_rejects_values_above_column(monkeypatch):
+    # 表に無い楽曲でも列に入らない値は弾く
+    monkeypatch.setattr(validation, "live_notes", {})
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(),
+        json={"live_id": 1018, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    client.post("/room/start", headers=_auth_header(), json={"room_id": room_id})
+
+    for judge_count_list, score in [
+        ([2**31, 0, 0, 0, 0], 1234),
+        ([5, 4, 3, 2, 1], 2**31),
+        ([5, 4, 3, 2, 1], 2**64),
+    ]:
+        response = client.post(
+            "/room/end",
+            headers=_auth_header(),
+            json={
+                "room_id": room_id,
+                "score": score,
+                "judge_count_list": judge_count_list,
+            },
+        )
+        assert response.status_code == 400
+
+    response = client.post(
+        "/room/end",
+        headers=_auth_header(),
+        json={
+            "room_id": room_id,
+            "score": 2**31 - 1,
+            "judge_count_list": [2**31 - 1, 0, 0, 0, 0],
+        },
+    )
+    assert response.status_code == 200
+    response = client.get("/metrics")
+    assert 'scores_rejected_total{reason="judge_count_too_large"} 1.0' in response.text
+    assert 'scores_rejected_total{reason="score_too_large"} 2.0' in response.text
+
+
+def test_sample_live_notes(monkeypatch):
+    monkeypatch.setattr(validation, "live_notes", {})
+    assert validation.load_live_notes("conf/live_notes.sample.csv") > 0
+    notes = validation.live_notes[1001]
+    assert notes.max_score <= validation.MAX_COLUMN_VALUE
+
+
+def test_room_write_forgets_flights_before_event_arrives(monkeypatch):
+    # EVENT_BUS=mysql のように、自分のイベントがまだポーリングで届いていない状態
+    class PendingEventBus(EventBus):
+        def publish(self, event):
+            pass
+
+    monkeypatch.setattr(model, "event_bus", PendingEventBus())
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(),
+        json={"live_id": 1019, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    started = threading.Event()
+    release = threading.Event()
+
+    def stale_read():
+        started.set()
+        release.wait(5)
+        return model.WaitRoomStatus.Waiting
+
+    with ThreadPoolExecutor(2) as executor:
+        leader = executor.submit(model.room_status_flight.do, room_id, stale_read)
+        assert started.wait(5)
+        model.start_room(room_id)
+        follower = executor.submit(
+            model.room_status_flight.do,
+            room_id,
+            lambda: model.WaitRoomStatus.LiveStart,
+        )
+        try:
+            # 開始より前に始まった読み出しには相乗りしない
+            assert follower.result(5) == model.WaitRoomStatus.LiveStart
+        finally:
+            release.set()
+        leader.result()
+    model.room_timer.cancel(room_id)
+
+
+def test_warm_room_cache():
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(),
+        json={"live_id": 1008, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    client.post(
+        "/room/join",
+        headers=_auth_header(1),
+        json={"room_id": room_id, "select_difficulty": 2},
+    )
+    model.room_cache.clear()
+
+    assert model.warm_room_cache() >= 1
+    state = model.room_cache.peek(room_id)
+    assert state.live_id == 1008
+    assert sorted(m.name for m in state.members) == ["room_user_0", "room_user_1"]
+
+
+def test_room_fast_json(monkeypatch):
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(),
+        json={"live_id": 1009, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    client.post(
+        "/room/join",
+        headers=_auth_header(1),
+        json={"room_id": room_id, "select_difficulty": 2},
+    )
+
+    def responses():
+        wait = client.post(
+            "/room/wait", headers=_auth_header(1), json={"room_id": room_id}
+        )
+        room_list = client.post("/room/list", json={"live_id": 1009, "limit": 1})
+        result = client.post("/room/result", json={"room_id": room_id})
+        return [r.json() for r in (wait, room_list, result)]
+
+    def finish():
+        client.post("/room/start", headers=_auth_header(), json={"room_id": room_id})
+        for i in range(2):
+            client.post(
+                "/room/end",
+                headers=_auth_header(i),
+                json={
+                    "room_id": room_id,
+                    "score": 100 + i,
+                    "judge_count_list": [1] * 5,
+                },
+            )
+        # 結果を取ると解散するので、比べる前に済ませておく
+        client.post("/room/result", json={"room_id": room_id})
+
+    monkeypatch.setattr(config, "FAST_JSON", False)
+    waiting = responses()
+    monkeypatch.setattr(config, "FAST_JSON", True)
+    assert responses() == waiting
+    assert waiting[1]["next_cursor"] == room_id
+
+    finish()
+    monkeypatch.setattr(config, "FAST_JSON", False)
+    finished = responses()
+    monkeypatch.setattr(config, "FAST_JSON", True)
+    assert responses() == finished
+    assert len(finished[2]["result_user_list"]) == 2
+
+    # 全員が退出して消えたルームは解散扱い
+    for i in range(2):
+        client.post("/room/leave", headers=_auth_header(i), json={"room_id": room_id})
+    for fast in [False, True]:
+        monkeypatch.setattr(config, "FAST_JSON", fast)
+        response = client.post(
+            "/room/wait", headers=_auth_header(), json={"room_id": room_id}
+        )
+        assert response.json() == {"status": 3, "room_user_list": []}
+
+
+def test_room_wait_coalesced(monkeypatch):
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(),
+        json={"live_id": 1010, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    for i in range(1, 4):
+        client.post(
+            "/room/join",
+            headers=_auth_header(i),
+            json={"room_id": room_id, "select_difficulty": 1},
+        )
+    model.room_cache.pop(room_id)
+
+    # 最初の読み出しを止めている間に残りの3人が来るようにする
+    get_room_rows = storage.get_room_rows
+    release = threading.Event()
+    loads = []
+
+    def slow_get_room_rows(room_id, version=None):
+        loads.append(room_id)
+        assert release.wait(2)
+        return get_room_rows(room_id, version)
+
+    monkeypatch.setattr(storage, "get_room_rows", slow_get_room_rows)
+    shared = model.room_state_flight.stats.shared
+    with ThreadPoolExecutor(4) as executor:
+        futures = [
+            executor.submit(model.wait_room, room_id, user_tokens[i]) for i in range(4)
+        ]
+        while model.room_state_flight.stats.shared < shared + 3:
+            time.sleep(0.01)
+        release.set()
+        results = [future.result() for future in futures]
+
+    assert loads == [room_id]
+    for i, (status, room_user_list) in enumerate(results):
+        assert status == model.WaitRoomStatus.Waiting
+        me = [user.name for user in room_user_list if user.is_me]
+        assert me == [f"room_user_{i}"]
+
+
+def _joined_user_count(live_id: int, room_id: int) -> int:
+    response = client.post("/room/list", json={"live_id": live_id})
+    for room in response.json()["room_info_list"]:
+        if room["room_id"] == room_id:
+            return room["joined_user_count"]
+    raise AssertionError(f"room {room_id} is not listed")
+
+
+def test_room_leave_not_member():
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(),
+        json={"live_id": 1011, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    client.post(
+        "/room/join",
+        headers=_auth_header(1),
+        json={"room_id": room_id, "select_difficulty": 1},
+    )
+
+    # 参加していないユーザーの退室と、2回目の退室では人数が変わらない
+    response = client.post(
+        "/room/leave", headers=_auth_header(5), json={"room_id": room_id}
+    )
+    assert response.status_code == 200
+    assert _joined_user_count(1011, room_id) == 2
+    for _ in range(2):
+        response = client.post(
+            "/room/leave", headers=_auth_header(1), json={"room_id": room_id}
+        )
+        assert response.status_code == 200
+    model.room_list_cache.clear()
+    assert _joined_user_count(1011, room_id) == 1
+
+    response = client.post(
+        "/room/wait", headers=_auth_header(), json={"room_id": room_id}
+    )
+    assert [u["name"] for u in response.json()["room_user_list"]] == ["room_user_0"]
+    client.post("/room/leave", headers=_auth_header(), json={"room_id": room_id})
+
+
+def test_room_join_capacity_after_bogus_leave():
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(),
+        json={"live_id": 1012, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    # 参加していないユーザーの退室を繰り返しても空きは増えない
+    for _ in range(3):
+        client.post("/room/leave", headers=_auth_header(9), json={"room_id": room_id})
+
+    results = []
+    for i in range(1, 9):
+        response = client.post(
+            "/room/join",
+            headers=_auth_header(i),
+            json={"room_id": room_id, "select_difficulty": 1},
+        )
+        results.append(response.json()["join_room_result"])
+    assert results.count(model.JoinRoomResult.Ok) == model.MAX_USER_COUNT - 1
+    assert results.count(model.JoinRoomResult.RoomFull) == 8 - (
+        model.MAX_USER_COUNT - 1
+    )
+
+    response = client.post(
+        "/room/wait", headers=_auth_header(), json={"room_id": room_id}
+    )
+    assert len(response.json()["room_user_list"]) == model.MAX_USER_COUNT
+    for i in range(model.MAX_USER_COUNT):
+        client.post("/room/leave", headers=_auth_header(i), json={"room_id": room_id})
+
+
+def test_room_wait_after_remote_profile_update():
+    response = client.post(
+        "/user/create", json={"user_name": "before", "leader_card_id": 1}
+    )
+    headers = {"Authorization": f"bearer {response.json()['user_token']}"}
+    response = client.post(
+        "/room/create", headers=headers, json={"live_id": 1013, "select_difficulty": 1}
+    )
+    room_id = response.json()["room_id"]
+    client.post(
+        "/room/join",
+        headers=_auth_header(1),
+        json={"room_id": room_id, "select_difficulty": 1},
+    )
+    client.post("/room/wait", headers=_auth_header(1), json={"room_id": room_id})
+    stale = model.get_users([model.room_cache.peek(room_id).host_id])
+
+    client.post(
+        "/user/update",
+        headers=headers,
+        json={"user_name": "after", "leader_card_id": 2},
+    )
+    # 別のワーカーで更新されたときと同じく、このプロセスの profile_cache は古いまま
+    for user_id, user in stale.items():
+        model.profile_cache.set(user_id, user)
+
+    response = client.post(
+        "/room/wait", headers=_auth_header(1), json={"room_id": room_id}
+    )
+    host = [u for u in response.json()["room_user_list"] if u["is_host"]]
+    assert [(u["name"], u["leader_card_id"]) for u in host] == [("after", 2)]
+    client.post("/room/leave", headers=headers, json={"room_id": room_id})
+    client.post("/room/leave", headers=_auth_header(1), json={"room_id": room_id})
+
+
+def _start_abandoned_room(live_id: int) -> int:
+    """2人で開始して1人だけスコアを送り、タイマーを持っていたワーカーが落ちた状態にする"""
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(),
+        json={"live_id": live_id, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    client.post(
+        "/room/join",
+        headers=_auth_header(1),
+        json={"room_id": room_id, "select_difficulty": 1},
+    )
+    client.post("/room/start", headers=_auth_header(), json={"room_id": room_id})
+    client.post(
+        "/room/end",
+        headers=_auth_header(),
+        json={"room_id": room_id, "score": 1234, "judge_count_list": [5, 4, 3, 2, 1]},
+    )
+    assert _get_deadline(room_id) is not None
+    model.room_timer.cancel(room_id)
+    response = client.post("/room/result", json={"room_id": room_id})
+    assert response.json()["result_user_list"] == []
+    # 期限を過ぎるまで待つ代わりに、永続化された期限を過去にずらす
+    if config.STORAGE == "memory":
+        storage._rooms[room_id].deadline_at = 0
+        return room_id
+    with begin(shard_of(room_id)) as conn:
+        query = "UPDATE `room` SET `deadline_at`=:deadline_at WHERE `id`=:room_id"
+        conn.execute(
+            text(query), {"room_id": room_id, "deadline_at": "2000-01-01 00:00:00"}
+        )
+    return room_id
+
+
+def _get_deadline(room_id: int):
+    if config.STORAGE == "memory":
+        return storage._rooms[room_id].deadline_at
+    with begin(shard_of(room_id)) as conn:
+        query = "SELECT `deadline_at` FROM `room` WHERE `id`=:room_id"
+        return conn.execute(text(query), {"room_id": room_id}).scalar()
+
+
+def _assert_timed_out_result(room_id: int) -> None:
+    response = client.post("/room/result", json={"room_id": room_id})
+    result_user_list = response.json()["result_user_list"]
+    scores = sorted(user["score"] for user in result_user_list)
+    assert scores == [0, 1234]
+    zero = [user for user in result_user_list if user["score"] == 0]
+    assert zero[0]["judge_count_list"] == [0, 0, 0, 0, 0]
+
+
+def test_room_deadline_swept_without_timer():
+    room_id = _start_abandoned_room(1014)
+
+    assert model.sweep_expired_rooms() >= 1
+    # 確定させたルームは期限を消し、次の掃除では拾わない
+    assert _get_deadline(room_id) is None
+    assert room_id not in storage.sweep_expired_rooms()
+    _assert_timed_out_result(room_id)
+
+
+def test_room_deadline_resolved_on_result():
+    room_id = _start_abandoned_room(1015)
+
+    # 掃除が走る前でも /room/result を読んだワーカーが確定させる
+    _assert_timed_out_result(room_id)
+    assert _get_deadline(room_id) is None
+    response = client.post(
+        "/room/wait", headers=_auth_header(1), json={"room_id": room_id}
+    )
+    assert response.json()["status"] == model.WaitRoomStatus.Dissolution
+
+
+@pytest.mark.skipif(
+    config.STORAGE == "memory", reason="STORAGE=memory は DB に繋がない"
+)
+def test_room_wait_cold_cache_single_checkout():
+    host = model.get_user_by_token(user_tokens[0])
+    room_id = model.create_room(1016, host.id)
+    while shard_of(room_id) != 0:
+        room_id = model.create_room(1016, host.id)
+    model.join_room(room_id, host.id, model.LiveDifficulty.normal)
+    model.user_cache.clear()
+    model.room_cache.pop(room_id)
+
+    checkouts = []
+
+    def on_checkout(*args):
+        checkouts.append(args)
+
+    # ユーザーと同じシャードのルームは、認証とルームの読み出しを1つのコネクションで行う
+    event.listen(db.engine, "checkout", on_checkout)
+    try:
+        with db.track_queries() as stats:
+            status, room_user_list = model.wait_room(room_id, user_tokens[0])
+    finally:
+        event.remove(db.engine, "checkout", on_checkout)
+    assert len(checkouts) == 1
+    assert stats.queries == 2
+    assert status == model.WaitRoomStatus.Waiting
+    assert [(u.name, u.is_me) for u in room_user_list] == [("room_user_0", True)]
+    model.leave_room(room_id, host.id)
+
+
+def test_room_join_ok_when_caching_fails(monkeypatch):
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(),
+        json={"live_id": 1017, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+
+    def broken_room_state_from_rows(rows, profiles=None):
+        raise RuntimeError("boom")
+
+    # 入室をコミットした後の失敗は入室の失敗として返さない
+    monkeypatch.setattr(model, "_room_state_from_rows", broken_room_state_from_rows)
+    response = client.post(
+        "/room/join",
+        headers=_auth_header(1),
+        json={"room_id": room_id, "select_difficulty": 1},
+    )
+    assert response.json()["join_room_result"] == model.JoinRoomResult.Ok
+    monkeypatch.undo()
+
+    response = client.post(
+        "/room/wait", headers=_auth_header(1), json={"room_id": room_id}
+    )
+    names = sorted(u["name"] for u in response.json()["room_user_list"])
+    assert names == ["room_user_0", "room_user_1"]
+    for i in range(2):
+        client.post("/room/leave", headers=_auth_header(i), json={"room_id": room_id})
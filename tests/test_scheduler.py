@@ -0,0 +1,67 @@
+import threading
+import time
+
+from app.scheduler import PeriodicTask, RoomTimer
+
+
+def test_room_timer_batches_and_cancels():
+    fired = []
+    done = threading.Event()
+
+    def on_expire(room_ids):
+        fired.append(sorted(room_ids))
+        done.set()
+
+    timer = RoomTimer(on_expire, tick=0.05)
+    timer.schedule(1, 0.01)
+    timer.schedule(2, 0.01)
+    timer.schedule(3, 0.01)
+    timer.cancel(3)
+    assert timer.pending == 2
+
+    assert done.wait(2)
+    assert fired == [[1, 2]]
+    assert timer.pending == 0
+    assert timer.lag >= 0
+
+
+def test_room_timer_keeps_earliest_deadline():
+    done = threading.Event()
+    timer = RoomTimer(lambda room_ids: done.set(), tick=0.05)
+    timer.schedule(1, 60)
+    timer.schedule(1, 0.01)
+    timer.schedule(1, 120)
+    assert timer.pending == 1
+    assert done.wait(2)
+
+
+def test_room_timer_stop_returns_pending():
+    fired = []
+    timer = RoomTimer(fired.append, tick=0.05)
+    timer.schedule(1, 60)
+    timer.schedule(2, 60)
+    assert sorted(timer.stop()) == [1, 2]
+    assert timer.pending == 0
+    timer.schedule(3, 0.01)
+    time.sleep(0.1)
+    assert fired == []
+
+
+def test_periodic_task_keeps_running_after_failure():
+    calls = []
+    done = threading.Event()
+
+    def sweep():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+        done.set()
+
+    task = PeriodicTask(sweep, 0.01)
+    task.start()
+    try:
+        # 1回失敗しても次の周期でまた掃除する
+        assert done.wait(2)
+    finally:
+        task.stop()
+    assert len(calls) >= 2
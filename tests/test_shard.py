@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
+
+from app import sqlite
+
+
+def test_sqlite_shards_assign_disjoint_room_ids():
+    shards = 3
+    engines = [
+        create_engine("sqlite://", poolclass=StaticPool, future=True)
+        for _ in range(shards)
+    ]
+    for shard, engine in enumerate(engines):
+        sqlite.setup(engine, shard, shards)
+
+    query = "INSERT INTO `room` (live_id, host_id, status) VALUES (:live_id, :host_id, :status)"
+    for shard, engine in enumerate(engines):
+        room_ids = []
+        for _ in range(4):
+            with engine.begin() as conn:
+                result = conn.execute(
+                    text(query), {"live_id": 1, "host_id": 1, "status": 1}
+                )
+                room_ids.append(result.lastrowid)
+        # 削除しても同じ id は再利用されない
+        with engine.begin() as conn:
+            conn.execute(text("DELETE FROM `room`"))
+            result = conn.execute(
+                text(query), {"live_id": 1, "host_id": 1, "status": 1}
+            )
+            room_ids.append(result.lastrowid)
+        assert room_ids == sorted(set(room_ids))
+        assert all((room_id - 1) % shards == shard for room_id in room_ids)
+
+
+def test_async_db_refuses_shards():
+    env = {**os.environ, "STORAGE": "sqlite_memory", "ASYNC_DB": "1", "SHARDS": "2"}
+    result = subprocess.run(
+        [sys.executable, "-c", "import app.db"],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode != 0
+    assert "ASYNC_DB=1 cannot be combined with SHARDS > 1" in result.stderr
@@ -0,0 +1,86 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.storage import (
+    MAX_USER_COUNT,
+    JoinRoomResult,
+    LiveDifficulty,
+    MemoryStorage,
+    ScoreSubmission,
+    WaitRoomStatus,
+)
+
+
+def _memory_storage(users: int) -> tuple[MemoryStorage, list[int]]:
+    storage = MemoryStorage()
+    tokens = [f"storage-{i}" for i in range(users)]
+    storage.insert_users([(f"storage_{i}", i) for i in range(users)], tokens)
+    return storage, [storage.get_user_by_token(token).id for token in tokens]
+
+
+def test_memory_storage_join_capacity():
+    storage, user_ids = _memory_storage(32)
+    room_id = storage.create_room(1, user_ids[0])
+
+    with ThreadPoolExecutor(len(user_ids)) as executor:
+        results = list(
+            executor.map(
+                lambda user_id: storage.join_room(
+                    room_id, user_id, LiveDifficulty.normal
+                )[0],
+                user_ids,
+            )
+        )
+    assert results.count(JoinRoomResult.Ok) == MAX_USER_COUNT
+    assert results.count(JoinRoomResult.RoomFull) == len(user_ids) - MAX_USER_COUNT
+    rows = storage.get_room_rows(room_id)
+    assert len(rows) == MAX_USER_COUNT
+    assert storage.list_rooms(0, None, None) == []
+
+
+def test_memory_storage_room_locks_are_independent():
+    storage, user_ids = _memory_storage(2)
+    busy = storage.create_room(1, user_ids[0])
+    free = storage.create_room(1, user_ids[0])
+
+    # 1つのルームのロックを持っていても、別のルームの操作は待たない
+    with storage._rooms[busy].lock:
+        result, rows = storage.join_room(free, user_ids[1], LiveDifficulty.hard)
+        assert result == JoinRoomResult.Ok
+        joined = threading.Event()
+
+        def join_busy():
+            storage.join_room(busy, user_ids[1], LiveDifficulty.hard)
+            joined.set()
+
+        thread = threading.Thread(target=join_busy)
+        thread.start()
+        assert not joined.wait(0.1)
+    thread.join(2)
+    assert joined.is_set()
+    assert [row.name for row in rows] == ["storage_1"]
+
+
+def test_memory_storage_sweeps_expired_rooms():
+    storage, user_ids = _memory_storage(2)
+    room_id = storage.create_room(1, user_ids[0])
+    for user_id in user_ids:
+        storage.join_room(room_id, user_id, LiveDifficulty.normal)
+    storage.start_room(room_id, 150)
+    storage.end_rooms([ScoreSubmission(room_id, user_ids[0], [1] * 5, 500)], 10)
+    assert storage.collect_results(room_id).rows == []
+
+    storage._rooms[room_id].deadline_at = 0
+    assert storage.sweep_expired_rooms() == [room_id]
+    assert storage.sweep_expired_rooms() == []
+    results = storage.collect_results(room_id)
+    assert [(row.user_id, row.score) for row in results.rows] == [
+        (user_ids[0], 500),
+        (user_ids[1], 0),
+    ]
+    assert results.dissolved and results.saved
+    assert storage.get_room_status(room_id) == WaitRoomStatus.Dissolution
+    assert storage.load_ranking(1, 1, 10) == (
+        [(user_ids[0], 500), (user_ids[1], 0)],
+        (2, 500, 500),
+    )
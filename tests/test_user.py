@@ -1,6 +1,10 @@
+import uuid
+
+import pytest
 from fastapi.testclient import TestClient
 
-from app.api import app
+from app import config, model
+from app.api import QueryStatsMiddleware, app
 
 client = TestClient(app)
 
@@ -23,3 +27,89 @@ def test_create_user():
     assert response_data.keys() == {"id", "name", "leader_card_id"}
     assert response_data["name"] == "test1"
     assert response_data["leader_card_id"] == 1000
+
+
+def test_update_user():
+    response = client.post(
+        "/user/create", json={"user_name": "test2", "leader_card_id": 1000}
+    )
+    token = response.json()["user_token"]
+    headers = {"Authorization": f"bearer {token}"}
+
+    # キャッシュに載せてから更新する
+    response = client.get("/user/me", headers=headers)
+    assert response.json()["name"] == "test2"
+
+    response = client.post(
+        "/user/update",
+        headers=headers,
+        json={"user_name": "test3", "leader_card_id": 2000},
+    )
+    assert response.status_code == 200
+
+    response = client.get("/user/me", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["name"] == "test3"
+    assert response.json()["leader_card_id"] == 2000
+
+
+def test_invalid_token():
+    headers = {"Authorization": "bearer invalid-token"}
+    for _ in range(2):
+        response = client.get("/user/me", headers=headers)
+        assert response.status_code == 404
+
+
+@pytest.mark.skipif(
+    config.STORAGE == "memory", reason="STORAGE=memory は DB に繋がない"
+)
+def test_db_query_headers():
+    # DB_QUERY_STATS=1 で起動したときと同じくミドルウェアで包む
+    client = TestClient(QueryStatsMiddleware(app))
+    response = client.post(
+        "/user/create", json={"user_name": "test3", "leader_card_id": 1000}
+    )
+    assert int(response.headers["X-DB-Queries"]) >= 1
+    assert response.headers["Server-Timing"].startswith("db;dur=")
+
+    # キャッシュに載っていればDBを見ない
+    headers = {"Authorization": f"bearer {response.json()['user_token']}"}
+    client.get("/user/me", headers=headers)
+    response = client.get("/user/me", headers=headers)
+    assert response.headers["X-DB-Queries"] == "0"
+
+
+def test_db_query_headers_off_by_default():
+    response = client.get("/")
+    assert "X-DB-Queries" not in response.headers
+    assert "Server-Timing" not in response.headers
+
+
+def test_create_user_batch():
+    users = [{"user_name": f"batch{i}", "leader_card_id": 1000 + i} for i in range(3)]
+    response = client.post("/user/create_batch", json={"users": users})
+    assert response.status_code == 200
+    tokens = response.json()["user_tokens"]
+    assert len(set(tokens)) == 3
+
+    for i, token in enumerate(tokens):
+        response = client.get("/user/me", headers={"Authorization": f"bearer {token}"})
+        assert response.json()["name"] == f"batch{i}"
+        assert response.json()["leader_card_id"] == 1000 + i
+
+    response = client.post("/user/create_batch", json={"users": []})
+    assert response.status_code == 422
+
+
+def test_create_user_retries_token_collision(monkeypatch):
+    response = client.post(
+        "/user/create", json={"user_name": "collision", "leader_card_id": 1000}
+    )
+    existing = response.json()["user_token"]
+
+    # 1回目は既存の token と衝突させる
+    tokens = iter([uuid.UUID(existing), uuid.uuid4()])
+    monkeypatch.setattr(model.uuid, "uuid4", lambda: next(tokens))
+    token = model.create_user("collision2", 1000)
+    assert token != existing
+    assert model.get_user_by_token(token).name == "collision2"
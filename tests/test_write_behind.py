@@ -0,0 +1,147 @@
+import threading
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from app.write_behind import WriteBehindQueue
+
+
+def _database_is_down():
+    return OperationalError("UPDATE", {}, Exception("database is down"))
+
+
+def test_write_behind_flushes_in_batches():
+    batches = []
+    done = threading.Event()
+
+    def flush(batch):
+        batches.append(batch)
+        if sum(len(b) for b in batches) == 5:
+            done.set()
+
+    queue = WriteBehindQueue(flush, interval=0.05, batch_size=2, max_pending=10)
+    for i in range(5):
+        queue.submit(i)
+    assert done.wait(2)
+    assert [i for batch in batches for i in batch] == [0, 1, 2, 3, 4]
+    assert all(len(batch) <= 2 for batch in batches)
+    assert queue.pending == 0
+    assert queue.flushed == 5
+
+
+def test_write_behind_stop_flushes_pending():
+    batches = []
+    queue = WriteBehindQueue(
+        batches.append, interval=60, batch_size=100, max_pending=100
+    )
+    queue.submit(1)
+    queue.submit(2)
+    queue.stop()
+    assert batches == [[1, 2]]
+    # 止めた後の submit() はその場で書き出す
+    queue.submit(3)
+    assert batches == [[1, 2], [3]]
+
+
+def test_write_behind_retries_failed_batches():
+    batches = []
+    attempts = []
+    done = threading.Event()
+    fail = threading.Event()
+    fail.set()
+
+    def flush(batch):
+        attempts.append(list(batch))
+        if fail.is_set():
+            raise _database_is_down()
+        batches.append(batch)
+        done.set()
+
+    queue = WriteBehindQueue(
+        flush, interval=0.01, batch_size=2, max_pending=2, max_backoff=0.05
+    )
+    queue.submit(1)
+    queue.submit(2)
+    # 失敗したバッチは受け付け済みのまま max_pending に数え、submit() を待たせる
+    blocked = threading.Thread(target=queue.submit, args=(3,))
+    blocked.start()
+    while len(attempts) < 3:
+        time.sleep(0.01)
+    assert blocked.is_alive()
+    assert queue.pending == 2
+    assert queue.failures >= 3
+
+    fail.clear()
+    assert done.wait(2)
+    blocked.join(2)
+    queue.stop()
+    assert [i for batch in batches for i in batch] == [1, 2, 3]
+    assert all(attempt == [1, 2] for attempt in attempts[:3])
+    assert queue.failures == 0
+    assert queue.pending == 0
+
+
+def test_write_behind_stop_retries():
+    attempts = []
+
+    def flush(batch):
+        attempts.append(list(batch))
+        if len(attempts) < 3:
+            raise _database_is_down()
+
+    queue = WriteBehindQueue(
+        flush, interval=60, batch_size=100, max_pending=100, max_backoff=0.01
+    )
+    queue.submit(1)
+    queue.stop()
+    assert attempts == [[1], [1], [1]]
+    assert queue.flushed == 1
+
+
+def test_write_behind_drops_bad_items():
+    batches = []
+    done = threading.Event()
+
+    def flush(batch):
+        # スコアが列に収まらないなど、値のせいで何度書いても失敗する項目
+        if 2 in batch:
+            raise ValueError("out of range")
+        batches.append(batch)
+        if sum(len(b) for b in batches) == 3:
+            done.set()
+
+    queue = WriteBehindQueue(flush, interval=0.01, batch_size=4, max_pending=4)
+    for i in [1, 2, 3, 4]:
+        queue.submit(i)
+    # 悪い項目だけを捨て、同じバッチの残りと後続の項目は書き出す
+    assert done.wait(2)
+    assert [i for batch in batches for i in batch] == [1, 3, 4]
+    queue.submit(5)
+    queue.stop()
+    assert batches[-1] == [5]
+    assert list(queue.dead_letters) == [2]
+    assert queue.dropped == 1
+    assert queue.failures == 0
+    assert queue.pending == 0
+
+
+def test_write_behind_retries_transient_failure_while_splitting():
+    attempts = []
+
+    def flush(batch):
+        attempts.append(list(batch))
+        if batch == [1, 2]:
+            raise ValueError("out of range")
+        if batch == [2] and attempts.count([2]) == 1:
+            raise _database_is_down()
+
+    queue = WriteBehindQueue(
+        flush, interval=60, batch_size=2, max_pending=10, max_backoff=0.01
+    )
+    queue.submit(1)
+    queue.submit(2)
+    queue.stop()
+    # 1件ずつ書いている途中の接続断では残りを捨てずにやり直す
+    assert attempts == [[1, 2], [1], [2], [2]]
+    assert queue.flushed == 2
+    assert queue.dropped == 0